@@ -1,8 +1,13 @@
+import hashlib
 import logging
+from typing import Optional, Tuple
+from django.db.models import Count, Max, QuerySet
 from django.http.request import QueryDict
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from rest_framework import status
 from rest_framework.response import Response
-from django.http import HttpRequest
+from django.http import HttpRequest, HttpResponse
 
 logger = logging.getLogger(__name__)
 
@@ -83,16 +88,19 @@ class HelperView():
         )
     
 
-    def request_success_response(self, new_id:str = None) -> Response:
+    def request_success_response(self, new_id:str = None, task_id:str = None) -> Response:
+        """task_id is the ID of the task doing the work, to look up its outcome with."""
         msg = {
             'request': 'Accepted',
             'success': True,
         }
 
+        if new_id or task_id:
+            msg['details'] = {}
         if new_id:
-            msg['details'] = {
-                'resource_id': new_id
-            }
+            msg['details']['resource_id'] = new_id
+        if task_id:
+            msg['details']['task_id'] = task_id
 
         return Response(msg, status=status.HTTP_200_OK)
 
@@ -129,3 +137,48 @@ class HelperView():
         items = str.split(request.get(key), ",")
         logger.debug(items)
         return items
+
+
+    def get_cache_validators(self, queryset:QuerySet, extra:str = "") -> Tuple[Optional[str], Optional[int]]:
+        """
+        Build an ETag and Last-Modified timestamp for a Describe response from a single
+        aggregate query over the `last_modified` column. The row count is included so
+        deletions are picked up and `extra` can carry any state that isn't stored in
+        the database. Returns (None, None) when there are no rows so the view can
+        return its usual not found response.
+        """
+        agg = queryset.aggregate(last_modified=Max('last_modified'), count=Count('pk'))
+        if not agg['count']:
+            return None, None
+
+        last_modified = agg['last_modified']
+        digest = hashlib.md5(f"{last_modified.isoformat()}:{agg['count']}:{extra}".encode("utf-8")).hexdigest()
+        return f'W/"{digest}"', int(last_modified.timestamp())
+
+
+    def not_modified_response(self, request:HttpRequest, etag:str, last_modified:int = None) -> Optional[HttpResponse]:
+        """
+        Returns a 304 Not Modified response if the request's If-None-Match or
+        If-Modified-Since headers match the provided validators, otherwise None.
+        Don't pass `last_modified` if the ETag covers state that isn't reflected
+        in the last_modified column.
+        """
+        if etag is None:
+            return None
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            self.set_cache_validators(response, etag, last_modified)
+        return response
+
+
+    def set_cache_validators(self, response:HttpResponse, etag:str, last_modified:int = None) -> HttpResponse:
+        if etag is None:
+            return response
+
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        # Clients may keep the response but have to revalidate before using it
+        response['Cache-Control'] = 'private, no-cache'
+        return response
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+
+    def ready(self):
+        # Connects the request, database and Celery signal handlers
+        from . import metrics, tracing
+        from echome.tracing import configure_tracing
+        configure_tracing()
@@ -0,0 +1,164 @@
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.http import HttpRequest
+from django.utils.decorators import classonlymethod
+from rest_framework import exceptions, status
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.views import exception_handler
+
+logger = logging.getLogger(__name__)
+
+# Libvirt calls block the calling thread, so they are sent to a bounded
+# pool instead of the event loop. The size caps how many libvirt calls a
+# single API process will have in flight at once.
+LIBVIRT_THREAD_POOL_SIZE = int(os.getenv("LIBVIRT_THREAD_POOL_SIZE", "16"))
+
+libvirt_executor = ThreadPoolExecutor(
+    max_workers=LIBVIRT_THREAD_POOL_SIZE,
+    thread_name_prefix="libvirt"
+)
+
+
+async def run_in_libvirt_pool(func, *args, **kwargs):
+    """Run a blocking libvirt call in the bounded libvirt thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(libvirt_executor, functools.partial(func, *args, **kwargs))
+
+
+def _with_fresh_connections(func):
+    """Make sure database connections opened in a worker thread are
+    closed again once the call is done."""
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return inner
+
+
+async def run_in_db_pool(func, *args, **kwargs):
+    """Run ORM (or other blocking, non-libvirt) code from an async view.
+
+    Calls are not thread sensitive so they don't queue up behind the sync
+    views sharing the main thread when served under ASGI.
+    """
+    return await sync_to_async(_with_fresh_connections(func), thread_sensitive=False)(*args, **kwargs)
+
+
+class AsyncAPIView:
+    """Async counterpart to rest_framework's APIView.
+
+    Handlers (get, post) are coroutines and receive a rest_framework Request
+    that has already been authenticated and permission checked. Responses
+    can be built with the HelperView methods as with any other view.
+    """
+
+    http_method_names = ['get', 'post']
+    authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES
+    permission_classes = api_settings.DEFAULT_PERMISSION_CLASSES
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        async def view(request, *args, **kwargs):
+            self = cls(**initkwargs)
+            return await self.dispatch(request, *args, **kwargs)
+
+        view.view_class = cls
+        view.view_initkwargs = initkwargs
+        # Token authenticated API, same as rest_framework's APIView
+        view.csrf_exempt = True
+        return view
+
+
+    async def dispatch(self, request:HttpRequest, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = Request(
+            request,
+            parsers=[parser() for parser in self.parser_classes],
+            authenticators=[auth() for auth in self.authentication_classes],
+        )
+        self.request = request
+
+        try:
+            await run_in_db_pool(self.initial, request)
+
+            method = request.method.lower()
+            handler = getattr(self, method, None) if method in self.http_method_names else None
+            if handler is None:
+                raise exceptions.MethodNotAllowed(request.method)
+
+            response = await handler(request, *args, **kwargs)
+        except exceptions.APIException as exc:
+            response = self.handle_exception(exc)
+
+        return self.finalize_response(request, response)
+
+
+    def initial(self, request:Request):
+        """Authenticate the request and check permissions. Runs in a worker thread
+        since authentication hits the database."""
+        user = request.user
+        if user.is_authenticated:
+            # Views compare against the account, load it now while we're
+            # still allowed to touch the ORM.
+            user.account
+
+        for permission in [perm() for perm in self.permission_classes]:
+            if not permission.has_permission(request, self):
+                if request.authenticators and not request.successful_authenticator:
+                    raise exceptions.NotAuthenticated()
+                raise exceptions.PermissionDenied()
+
+
+    def handle_exception(self, exc:exceptions.APIException) -> Response:
+        if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+            authenticators = self.request.authenticators
+            if authenticators:
+                exc.auth_header = authenticators[0].authenticate_header(self.request)
+            else:
+                exc.status_code = status.HTTP_403_FORBIDDEN
+
+        context = {
+            'view': self,
+            'args': self.args,
+            'kwargs': self.kwargs,
+            'request': self.request,
+        }
+        response = exception_handler(exc, context)
+        if response is None:
+            raise exc
+
+        if getattr(exc, 'auth_header', None):
+            response['WWW-Authenticate'] = exc.auth_header
+        return response
+
+
+    def finalize_response(self, request:Request, response):
+        if isinstance(response, Response):
+            renderer = self.renderer_classes[0]()
+            response.accepted_renderer = renderer
+            response.accepted_media_type = renderer.media_type
+            response.renderer_context = {
+                'view': self,
+                'args': self.args,
+                'kwargs': self.kwargs,
+                'request': request,
+            }
+        return response
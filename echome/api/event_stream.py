@@ -0,0 +1,113 @@
+import asyncio
+import json
+import logging
+from urllib.parse import parse_qs
+from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed
+from identity.authentication import CachedJWTAuthentication
+from .async_view import run_in_db_pool
+from .events import broker
+
+logger = logging.getLogger(__name__)
+
+# A comment line is sent when nothing else has been, so proxies and
+# clients don't treat an idle stream as dead.
+KEEPALIVE_INTERVAL = 15
+
+
+def _authenticate(authorization:bytes):
+    """Returns the user for a `Bearer <token>` Authorization header or None."""
+    parts = authorization.split()
+    if len(parts) != 2 or parts[0] != b"Bearer":
+        return None
+
+    auth = CachedJWTAuthentication()
+    try:
+        validated_token = auth.get_validated_token(parts[1])
+        user = auth.get_user(validated_token)
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+    return user
+
+
+class EventStream:
+    """ASGI application streaming state changes for the caller's account as
+    server-sent events.
+
+    Each event is a JSON object with the resource `type` (vm or kube), its
+    `id` and new `state`. `?types=vm,kube` limits the stream to the given
+    resource types. This is served outside of Django's request handling,
+    which can't stream from a coroutine.
+    """
+
+    path = "/api/v1/events/stream"
+
+    async def __call__(self, scope, receive, send):
+        headers = dict(scope["headers"])
+        if scope["method"] != "GET":
+            await self._send_error(send, 405, "Method not allowed")
+            return
+
+        user = await run_in_db_pool(_authenticate, headers.get(b"authorization", b""))
+        if user is None:
+            await self._send_error(send, 401, "Authentication credentials were not provided or are invalid.")
+            return
+
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        types = set(",".join(query.get("types", [])).split(",")) - {""}
+
+        account_id = user.account_id
+        queue = broker.subscribe(account_id)
+        disconnected = asyncio.ensure_future(self._wait_for_disconnect(receive))
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/event-stream"),
+                    (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no"),
+                ],
+            })
+            await self._send(send, b": connected\n\n")
+
+            while not disconnected.done():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    await self._send(send, b": keepalive\n\n")
+                    continue
+
+                if types and event["type"] not in types:
+                    continue
+
+                # The same event is put on every subscriber's queue, leave it as it is
+                event = {key: value for key, value in event.items() if key != "account"}
+                message = f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+                await self._send(send, message.encode("utf-8"))
+        except OSError:
+            logger.debug("Event stream client went away")
+        finally:
+            disconnected.cancel()
+            broker.unsubscribe(account_id, queue)
+
+
+    async def _wait_for_disconnect(self, receive):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+
+    async def _send(self, send, body:bytes):
+        await send({"type": "http.response.body", "body": body, "more_body": True})
+
+
+    async def _send_error(self, send, status:int, details:str):
+        body = json.dumps({"success": False, "details": details}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json")],
+        })
+        await send({"type": "http.response.body", "body": body})
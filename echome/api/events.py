@@ -0,0 +1,154 @@
+import asyncio
+import json
+import logging
+import select
+import threading
+from collections import defaultdict
+from typing import Dict, Set
+import psycopg2
+import psycopg2.extensions
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# Postgres channel state change events are sent on. Every API process
+# LISTENs on it, so events published from a Celery worker, the libvirt
+# event watcher or another API process reach every connected client.
+EVENTS_CHANNEL = "echome_events"
+
+# Events are dropped for a subscriber that isn't keeping up instead of
+# letting the queue grow without bound.
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+def publish_event(account_id:str, resource_type:str, resource_id:str, state:str, **details):
+    """Publish a state change for a resource belonging to an account.
+
+    Sent with NOTIFY so it's only delivered once the surrounding transaction
+    commits. A failure to publish is logged and never raised; clients can
+    always fall back to the Describe endpoints.
+    """
+    event = {
+        "account": account_id,
+        "type": resource_type,
+        "id": resource_id,
+        "state": state,
+    }
+    if details:
+        event["details"] = details
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [EVENTS_CHANNEL, json.dumps(event)])
+    except Exception as e:
+        logger.warning(f"Unable to publish {resource_type} event for {resource_id}: {e}")
+
+
+class EventBroker:
+    """Listens for published events on a dedicated database connection and hands
+    them to the subscribers of the matching account.
+
+    One broker (and one listening connection) is shared by every stream in a
+    process. The listener runs in its own thread and is started with the
+    first subscription.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        self._loops: Dict[asyncio.Queue, asyncio.AbstractEventLoop] = {}
+        self._thread = None
+
+
+    def subscribe(self, account_id:str) -> asyncio.Queue:
+        """Returns a queue that will receive every event for the account. Must be
+        called from the event loop the queue will be read from."""
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers[account_id].add(queue)
+            self._loops[queue] = asyncio.get_running_loop()
+            self._start_listener()
+        return queue
+
+
+    def unsubscribe(self, account_id:str, queue:asyncio.Queue):
+        with self._lock:
+            self._subscribers[account_id].discard(queue)
+            if not self._subscribers[account_id]:
+                del self._subscribers[account_id]
+            self._loops.pop(queue, None)
+
+
+    def _start_listener(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._listen, name="event-listener", daemon=True)
+        self._thread.start()
+
+
+    def _connect(self):
+        db = settings.DATABASES["default"]
+        conn = psycopg2.connect(
+            dbname=db["NAME"],
+            user=db["USER"],
+            password=db["PASSWORD"],
+            host=db["HOST"],
+            port=db["PORT"] or None,
+        )
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {EVENTS_CHANNEL};")
+        return conn
+
+
+    def _listen(self):
+        conn = None
+        while True:
+            try:
+                if conn is None:
+                    conn = self._connect()
+                    logger.debug(f"Listening for events on {EVENTS_CHANNEL}")
+
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    continue
+
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    self._dispatch(notify.payload)
+            except psycopg2.Error as e:
+                logger.warning(f"Lost event listener connection, reconnecting: {e}")
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                threading.Event().wait(5)
+
+
+    def _dispatch(self, payload:str):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Ignoring malformed event: {payload}")
+            return
+
+        with self._lock:
+            queues = [(queue, self._loops[queue]) for queue in self._subscribers.get(event.get("account"), ())]
+
+        for queue, loop in queues:
+            try:
+                loop.call_soon_threadsafe(self._put, queue, event)
+            except RuntimeError:
+                # The subscriber's loop has already been closed
+                pass
+
+
+    @staticmethod
+    def _put(queue:asyncio.Queue, event:dict):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            logger.warning(f"Event subscriber is falling behind, dropping event for {event.get('id')}")
+
+
+broker = EventBroker()
@@ -0,0 +1,156 @@
+import inspect
+import logging
+import os
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Callable, Tuple
+import libvirt
+import requests
+from celery import Task
+from celery.utils.time import get_exponential_backoff_interval
+from django.db import transaction
+from django.utils import timezone
+from hvac import exceptions as vault_exceptions
+from vault.exceptions import VaultIsSealedError
+from .models import TaskExecution
+
+logger = logging.getLogger(__name__)
+
+# A task that hasn't finished or been retried within this many seconds is taken to
+# have been lost, and a new submission of the same work may take it over. Must be
+# longer than the slowest task (and RabbitMQ's consumer_timeout must be at least this).
+TASK_LEASE = int(os.getenv("TASK_LEASE", "21600"))
+TASK_MAX_RETRIES = int(os.getenv("TASK_MAX_RETRIES", "5"))
+# Retries wait a random time up to TASK_RETRY_BACKOFF * 2^retries seconds, at most TASK_RETRY_BACKOFF_MAX
+TASK_RETRY_BACKOFF = int(os.getenv("TASK_RETRY_BACKOFF", "5"))
+TASK_RETRY_BACKOFF_MAX = int(os.getenv("TASK_RETRY_BACKOFF_MAX", "300"))
+
+# libvirt errors from losing the connection to libvirtd or a slow domain or guest agent
+TRANSIENT_LIBVIRT_ERRORS = {
+    libvirt.VIR_ERR_NO_CONNECT,
+    libvirt.VIR_ERR_SYSTEM_ERROR,
+    libvirt.VIR_ERR_RPC,
+    libvirt.VIR_ERR_OPERATION_TIMEOUT,
+    libvirt.VIR_ERR_AGENT_UNRESPONSIVE,
+}
+
+# Vault being unreachable, restarting (sealed) or overloaded
+TRANSIENT_VAULT_ERRORS = (
+    VaultIsSealedError,
+    vault_exceptions.VaultDown,
+    vault_exceptions.InternalServerError,
+    vault_exceptions.RateLimitExceeded,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+
+def is_transient(exc:Exception) -> bool:
+    """Whether an error is likely to go away if the task is tried again."""
+    if isinstance(exc, libvirt.libvirtError):
+        return exc.get_error_code() in TRANSIENT_LIBVIRT_ERRORS
+    return isinstance(exc, TRANSIENT_VAULT_ERRORS)
+
+
+class IdempotentTask(Task):
+    """Base for tasks that must do their work at most once however often their
+    message is delivered, and that are retried with backoff on transient errors.
+
+    The work a task does is identified by `idempotency_key`, a format string of
+    the task's arguments, e.g. "terminate:{vm_id}". Its outcome is kept in a
+    TaskExecution under that key. A message for work that has already succeeded,
+    or that another task is doing, returns without running the task again.
+
+    Messages are only acknowledged once the task is done, so a task whose worker
+    dies is delivered again. Tasks have to be able to pick up where a previous
+    attempt left off.
+    """
+    idempotency_key: str = None
+
+    acks_late = True
+    reject_on_worker_lost = True
+    # Callers can look up the outcome with the task ID
+    ignore_result = False
+    max_retries = TASK_MAX_RETRIES
+
+    def __call__(self, *args, **kwargs):
+        key = self.get_idempotency_key(args, kwargs)
+        execution, claimed = claim(key, self.name, self.request.id)
+        if not claimed:
+            logger.info(f"{self.name} {self.request.id}: {key} already {execution.state.lower()} in task {execution.task_id}, skipping")
+            return execution.result
+
+        try:
+            result = super().__call__(*args, **kwargs)
+        except Exception as exc:
+            if self.will_retry(exc):
+                logger.warning(f"{self.name} {self.request.id} failed with a transient error, retrying: {exc}")
+                TaskExecution.objects.filter(pk=execution.pk).update(error=repr(exc), last_modified=timezone.now())
+                raise self.retry(exc=exc, countdown=get_exponential_backoff_interval(
+                    TASK_RETRY_BACKOFF, self.request.retries, TASK_RETRY_BACKOFF_MAX, full_jitter=True))
+
+            finish(execution, TaskExecution.State.FAILED, error=repr(exc))
+            raise
+
+        finish(execution, TaskExecution.State.SUCCEEDED, result=result)
+        return result
+
+
+    def get_idempotency_key(self, args:tuple, kwargs:dict) -> str:
+        if self.idempotency_key is None:
+            # Only redeliveries of the same message are the same work
+            return f"{self.name}:{self.request.id}"
+
+        arguments = inspect.signature(self.run).bind(*args, **kwargs)
+        arguments.apply_defaults()
+        return self.idempotency_key.format(**arguments.arguments)
+
+
+    def will_retry(self, exc:Exception) -> bool:
+        return is_transient(exc) and self.request.retries < self.max_retries
+
+
+    @contextmanager
+    def on_failure_of(self, cleanup:Callable[[], None]):
+        """Run cleanup if the block raises an error the task won't be retried for,
+        e.g. to mark what it was creating as failed."""
+        try:
+            yield
+        except Exception as exc:
+            if not self.will_retry(exc):
+                cleanup()
+            raise
+
+
+def claim(key:str, task_name:str, task_id:str) -> Tuple[TaskExecution, bool]:
+    """Get the TaskExecution for key and whether the task task_id should do the work:
+    it's new, this is a retry or redelivery of the task already doing it, or a
+    previous task failed or was lost."""
+    with transaction.atomic():
+        execution, created = TaskExecution.objects.select_for_update().get_or_create(
+            key=key, defaults={"task_name": task_name, "task_id": task_id, "attempts": 1})
+        if created:
+            return execution, True
+
+        if execution.state == TaskExecution.State.SUCCEEDED:
+            return execution, False
+        if execution.task_id == task_id:
+            # A failed task's message is acknowledged, it shouldn't come back
+            if execution.state == TaskExecution.State.FAILED:
+                return execution, False
+        elif execution.state == TaskExecution.State.RUNNING \
+                and execution.last_modified > timezone.now() - timedelta(seconds=TASK_LEASE):
+            return execution, False
+
+        execution.task_id = task_id
+        execution.state = TaskExecution.State.RUNNING
+        execution.attempts += 1
+        execution.save()
+        return execution, True
+
+
+def finish(execution:TaskExecution, state:str, result=None, error:str = None):
+    execution.state = state
+    execution.result = result
+    execution.error = error
+    execution.save(update_fields=["state", "result", "error", "last_modified"])
@@ -0,0 +1,70 @@
+import time
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+from api.renderers import ORJSONRenderer
+from vmmanager.models import VirtualMachine, Volume, Image
+from vmmanager.serializers import (
+    VirtualMachineSerializer,
+    VirtualMachineValuesSerializer,
+    VolumeSerializer,
+    VolumeValuesSerializer,
+    ImageSerializer,
+    ImageValuesSerializer,
+)
+from kube.models import KubeCluster
+from kube.serializers import KubeClusterSerializer, KubeClusterValuesSerializer
+
+BENCHMARKS = [
+    (VirtualMachine, VirtualMachineSerializer, VirtualMachineValuesSerializer),
+    (Volume, VolumeSerializer, VolumeValuesSerializer),
+    (Image, ImageSerializer, ImageValuesSerializer),
+    (KubeCluster, KubeClusterSerializer, KubeClusterValuesSerializer),
+]
+
+class Command(BaseCommand):
+    help = 'Compare the per-row cost of ModelSerializer + JSONRenderer against .values() + ORJSONRenderer for Describe responses.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--account', help='Only use rows belonging to this account ID')
+        parser.add_argument('--repeat', type=int, default=20, help='Number of times each benchmark is run')
+
+
+    def handle(self, *args, **options):
+        for model, model_serializer, values_serializer in BENCHMARKS:
+            queryset = model.objects.all()
+            if options['account']:
+                queryset = queryset.filter(account_id=options['account'])
+
+            rows = queryset.count()
+            if not rows:
+                self.stdout.write(f"{model.__name__}: no rows, skipping")
+                continue
+
+            def stock():
+                data = [model_serializer(obj).data for obj in queryset.all()]
+                return JSONRenderer().render(data)
+
+            def lightweight():
+                data = values_serializer.serialize(queryset.all())
+                return ORJSONRenderer().render(data)
+
+            stock_time = self._time(stock, options['repeat'])
+            light_time = self._time(lightweight, options['repeat'])
+
+            self.stdout.write(
+                f"{model.__name__} ({rows} rows): "
+                f"ModelSerializer+JSONRenderer {stock_time / rows * 1e6:.1f}us/row, "
+                f".values()+ORJSONRenderer {light_time / rows * 1e6:.1f}us/row "
+                f"({stock_time / light_time:.1f}x)"
+            )
+
+
+    def _time(self, func, repeat:int) -> float:
+        """Returns the best time in seconds out of `repeat` runs. Includes the query."""
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
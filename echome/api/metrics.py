@@ -0,0 +1,205 @@
+import asyncio
+import contextvars
+import glob
+import hmac
+import ipaddress
+import logging
+import os
+import time
+from celery.signals import before_task_publish, task_prerun, task_postrun
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.decorators import sync_and_async_middleware
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+from vmmanager.metrics import ResourceStateCollector
+
+logger = logging.getLogger(__name__)
+
+# Set for each service (api, worker, beat) to its own directory under a shared one.
+# /metrics merges the metrics written by every process of every service.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# /metrics is served on the API's port, only to scrapers from these networks (comma
+# separated) or that send "Authorization: Bearer <METRICS_TOKEN>".
+METRICS_ALLOWED_NETWORKS = [
+    ipaddress.ip_network(network.strip())
+    for network in os.getenv("METRICS_ALLOWED_NETWORKS", "127.0.0.1/32,::1/128").split(",") if network.strip()
+]
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+request_duration = Histogram(
+    "echome_request_duration_seconds",
+    "Latency of API requests",
+    ["view", "method", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+request_queries = Histogram(
+    "echome_request_db_queries",
+    "Database queries made while serving an API request",
+    ["view"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+
+task_duration = Histogram(
+    "echome_celery_task_duration_seconds",
+    "Run time of Celery tasks",
+    ["task", "state"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+# Tasks waiting for a worker: published - started
+tasks_published = Counter(
+    "echome_celery_tasks_published",
+    "Celery tasks sent to the broker",
+    ["task"],
+)
+tasks_started = Counter(
+    "echome_celery_tasks_started",
+    "Celery tasks picked up by a worker",
+    ["task"],
+)
+
+# Queries made while serving the current request, or None outside of one
+_request_queries = contextvars.ContextVar("request_queries", default=None)
+_task_started_at = {}
+
+
+def view_name(request) -> str:
+    """Name of the view that served a request, e.g. DescribeVM."""
+    match = request.resolver_match
+    if match is None:
+        return "unmatched"
+    return getattr(match.func, "view_class", match.func).__name__
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Records the latency and the database queries of every request against
+    the view that served it."""
+
+    def observe(request, response, started):
+        view = view_name(request)
+        request_duration.labels(view, request.method, response.status_code).observe(time.monotonic() - started)
+        request_queries.labels(view).observe(_request_queries.get()[0])
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            started = time.monotonic()
+            token = _request_queries.set([0])
+            try:
+                response = await get_response(request)
+                observe(request, response, started)
+                return response
+            finally:
+                _request_queries.reset(token)
+    else:
+        def middleware(request):
+            started = time.monotonic()
+            token = _request_queries.set([0])
+            try:
+                response = get_response(request)
+                observe(request, response, started)
+                return response
+            finally:
+                _request_queries.reset(token)
+
+    return middleware
+
+
+def _count_query(execute, sql, params, many, context):
+    queries = _request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def _install_query_counter(sender, connection, **kwargs):
+    # Every thread has its own connection, including the ones async views
+    # run queries from. The request's context is copied into those threads.
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+@before_task_publish.connect
+def _task_published(sender=None, **kwargs):
+    tasks_published.labels(sender).inc()
+
+
+@task_prerun.connect
+def _task_started(task_id=None, task=None, **kwargs):
+    tasks_started.labels(task.name).inc()
+    _task_started_at[task_id] = time.monotonic()
+
+
+@task_postrun.connect
+def _task_finished(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started_at.pop(task_id, None)
+    if started is not None:
+        task_duration.labels(task.name, state or "UNKNOWN").observe(time.monotonic() - started)
+
+
+class CeleryQueueCollector:
+    """Messages waiting in each configured Celery queue, read from the broker
+    when metrics are scraped."""
+
+    def collect(self):
+        from echome.celery import app
+
+        gauge = GaugeMetricFamily("echome_celery_queue_messages", "Messages waiting in a Celery queue", labels=["queue"])
+        try:
+            with app.connection_for_read() as conn:
+                for queue in app.amqp.queues:
+                    channel = conn.channel()
+                    try:
+                        _, messages, _ = channel.queue_declare(queue=queue, passive=True)
+                        gauge.add_metric([queue], messages)
+                    except Exception as e:
+                        logger.debug(f"Unable to read the depth of queue {queue}: {e}")
+                    finally:
+                        channel.close()
+        except Exception as e:
+            logger.warning(f"Unable to read Celery queue depths: {e}")
+        yield gauge
+
+
+class SharedDirectoryCollector:
+    """Merges the metrics written by the processes of every service sharing
+    the parent of PROMETHEUS_MULTIPROC_DIR."""
+
+    def __init__(self, path:str) -> None:
+        self.path = path
+
+
+    def collect(self):
+        files = glob.glob(os.path.join(self.path, "*", "*.db"))
+        return MultiProcessCollector.merge(files, accumulate=True)
+
+
+def metrics_allowed(request) -> bool:
+    if METRICS_TOKEN and hmac.compare_digest(
+            request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return True
+
+    try:
+        address = ipaddress.ip_address(request.META.get("REMOTE_ADDR", ""))
+    except ValueError:
+        return False
+    return any(address in network for network in METRICS_ALLOWED_NETWORKS)
+
+
+def metrics_view(request):
+    """Prometheus metrics for the control plane."""
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+
+    registry = CollectorRegistry()
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry.register(SharedDirectoryCollector(os.path.dirname(PROMETHEUS_MULTIPROC_DIR.rstrip("/"))))
+    else:
+        registry.register(REGISTRY)
+    registry.register(ResourceStateCollector())
+    registry.register(CeleryQueueCollector())
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -1,3 +1,28 @@
 from django.db import models
 
-# Create your models here.
+class TaskExecution(models.Model):
+    """The outcome of an idempotent task (api.idempotency.IdempotentTask), stored
+    under a key for the work it does so that it's only done once."""
+    key = models.CharField(max_length=200, unique=True, db_index=True)
+    task_name = models.CharField(max_length=200)
+    # The task running, or that last ran, the work. Its result is also in the result backend.
+    task_id = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True, null=False)
+    last_modified = models.DateTimeField(auto_now=True)
+    attempts = models.IntegerField(default=0)
+    result = models.JSONField(null=True)
+    error = models.TextField(null=True)
+
+    class State(models.TextChoices):
+        RUNNING = 'RUNNING', 'Running'
+        SUCCEEDED = 'SUCCEEDED', 'Succeeded'
+        FAILED = 'FAILED', 'Failed'
+
+    state = models.CharField(
+        max_length=16,
+        choices=State.choices,
+        default=State.RUNNING,
+    )
+
+    def __str__(self) -> str:
+        return self.key
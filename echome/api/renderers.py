@@ -0,0 +1,26 @@
+import orjson
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class ORJSONRenderer(BaseRenderer):
+    """Drop-in replacement for rest_framework's JSONRenderer using orjson.
+
+    orjson natively handles the types that make up most of our responses
+    (dicts, lists, datetimes, UUIDs). Anything else falls back to the
+    rest_framework encoder so output matches JSONRenderer.
+    """
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    # OPT_UTC_Z renders UTC datetimes with a 'Z' suffix, same as rest_framework
+    options = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+    _fallback_encoder = JSONEncoder()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        return orjson.dumps(data, default=self._fallback_encoder.default, option=self.options)
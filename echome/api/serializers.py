@@ -0,0 +1,31 @@
+from typing import List
+from django.db.models import QuerySet
+
+
+class ValuesSerializer:
+    """Read-only serializer for list responses built on QuerySet.values().
+
+    Instead of instantiating a ModelSerializer (and every field) per row, the
+    database returns plain dictionaries that can be handed to the renderer
+    as-is. Output matches a ModelSerializer with the same `exclude` list for
+    concrete fields. Many-to-many fields are always left out since .values()
+    would return one row per relation; serialize those separately.
+    """
+    model = None
+    exclude: List[str] = []
+
+    _field_names: List[str] = None
+
+    @classmethod
+    def field_names(cls) -> List[str]:
+        if cls._field_names is None:
+            cls._field_names = [
+                f.name for f in cls.model._meta.get_fields()
+                if f.concrete and not f.many_to_many and f.name not in cls.exclude
+            ]
+        return cls._field_names
+
+
+    @classmethod
+    def serialize(cls, queryset:QuerySet) -> List[dict]:
+        return list(queryset.values(*cls.field_names()))
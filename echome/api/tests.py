@@ -1,3 +1,255 @@
-from django.test import TestCase
+import asyncio
+import json
+import uuid
+from datetime import datetime, timezone
+from decimal import Decimal
+from unittest import mock
+from django.conf import settings
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+from rest_framework import exceptions
+from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.renderers import JSONRenderer
+from prometheus_client import REGISTRY
+from echome.celery import app
+from identity.models import Account, User
+from vault.exceptions import VaultIsSealedError
+from vmmanager.models import HostMachine, ImageBlob, Volume
+from vmmanager.serializers import VolumeSerializer, VolumeValuesSerializer
+from .api_view import HelperView
+from .async_view import AsyncAPIView
+from .event_stream import EventStream
+from .events import EventBroker
+from .idempotency import IdempotentTask
+from .metrics import metrics_allowed, metrics_middleware
+from .renderers import ORJSONRenderer
+from .models import TaskExecution
+
+# Names passed to flaky_task, one per run
+calls = []
+
+@app.task(bind=True, base=IdempotentTask, idempotency_key="test:{name}")
+def flaky_task(self, name:str, failures:int = 0):
+    calls.append(name)
+    if calls.count(name) <= failures:
+        raise VaultIsSealedError()
+    return {"runs": calls.count(name)}
+
+
+class AuthenticatedView(HelperView, AsyncAPIView):
+    permission_classes = [IsAuthenticated]
+
+    async def get(self, request):
+        return self.success_response()
+
+
+class MissingView(HelperView, AsyncAPIView):
+    permission_classes = [AllowAny]
+
+    async def get(self, request):
+        raise exceptions.NotFound()
+
 
 # Create your tests here.
+class TestMetricsMiddleware(TestCase):
+
+    def sample(self, name:str, labels:dict) -> float:
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+
+    def test_queries_are_counted_per_request(self):
+        def view(request):
+            User.objects.count()
+            User.objects.count()
+            return HttpResponse()
+
+        middleware = metrics_middleware(view)
+        before = self.sample("echome_request_db_queries_sum", {"view": "unmatched"})
+        requests_before = self.sample("echome_request_duration_seconds_count", 
+            {"view": "unmatched", "method": "GET", "status": "200"})
+
+        middleware(RequestFactory().get("/"))
+
+        self.assertEqual(self.sample("echome_request_db_queries_sum", {"view": "unmatched"}) - before, 2)
+        self.assertEqual(self.sample("echome_request_duration_seconds_count", 
+            {"view": "unmatched", "method": "GET", "status": "200"}) - requests_before, 1)
+
+
+    def test_metrics_are_only_served_to_allowed_scrapers(self):
+        factory = RequestFactory()
+        self.assertTrue(metrics_allowed(factory.get("/metrics", REMOTE_ADDR="127.0.0.1")))
+        self.assertFalse(metrics_allowed(factory.get("/metrics", REMOTE_ADDR="203.0.113.5")))
+
+        with mock.patch("api.metrics.METRICS_TOKEN", "secret"):
+            self.assertTrue(metrics_allowed(
+                factory.get("/metrics", REMOTE_ADDR="203.0.113.5", HTTP_AUTHORIZATION="Bearer secret")))
+            self.assertFalse(metrics_allowed(
+                factory.get("/metrics", REMOTE_ADDR="203.0.113.5", HTTP_AUTHORIZATION="Bearer wrong")))
+
+
+class TestAsyncAPIView(TestCase):
+
+    def test_api_errors_are_turned_into_responses(self):
+        factory = RequestFactory()
+
+        response = asyncio.run(AuthenticatedView.as_view()(factory.get("/")))
+        self.assertEqual(response.status_code, 401)
+        self.assertIn("WWW-Authenticate", response)
+
+        response = asyncio.run(MissingView.as_view()(factory.get("/")))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.render().content, b'{"detail":"Not found."}')
+
+        response = asyncio.run(MissingView.as_view()(factory.post("/")))
+        self.assertEqual(response.status_code, 405)
+
+
+class TestORJSONRenderer(TestCase):
+
+    def test_output_matches_json_renderer(self):
+        data = {
+            "id": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+            "created": datetime(2026, 10, 18, 12, 0, 0, 123456, tzinfo=timezone.utc),
+            "size": Decimal("1.5"),
+            "name": "caf\u00e9",
+            "tags": {"a": [1, None, True]},
+        }
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+
+
+    def test_values_serializer_matches_model_serializer(self):
+        account = Account(name="test")
+        account.generate_id()
+        account.save()
+        host = HostMachine(name="host", ip="127.0.0.1")
+        host.generate_id()
+        host.save()
+        blob = ImageBlob.objects.create(digest="a" * 64, path="/store/a.qcow2", size=1, format="qcow2")
+        volume = Volume(account=account, host=host, blob=blob, path="/vm/disk.qcow2", size=2**30, tags={"Name": "disk"})
+        volume.generate_id()
+        volume.save()
+
+        volumes = Volume.objects.filter(account=account)
+        self.assertEqual(
+            ORJSONRenderer().render(VolumeValuesSerializer.serialize(volumes)),
+            JSONRenderer().render(VolumeSerializer(volumes, many=True).data),
+        )
+
+
+class TestCacheValidators(TestCase):
+
+    def test_not_modified_until_a_row_changes(self):
+        account = Account(name="test")
+        account.generate_id()
+        account.save()
+        volumes = Volume.objects.filter(account=account)
+        view = HelperView()
+        self.assertEqual(view.get_cache_validators(volumes), (None, None))
+
+        volume = Volume(account=account, path="/vm/disk.qcow2")
+        volume.generate_id()
+        volume.save()
+        etag, last_modified = view.get_cache_validators(volumes)
+
+        response = view.not_modified_response(RequestFactory().get("/", HTTP_IF_NONE_MATCH=etag), etag, last_modified)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        volume.save()
+        changed, _ = view.get_cache_validators(volumes)
+        self.assertNotEqual(changed, etag)
+        self.assertIsNone(view.not_modified_response(RequestFactory().get("/", HTTP_IF_NONE_MATCH=etag), changed))
+
+
+class TestEventStream(TestCase):
+
+    def test_events_are_only_streamed_to_their_account(self):
+        accounts = {b"Bearer first": "acct-1", b"Bearer second": "acct-1", b"Bearer other": "acct-2"}
+        broker = EventBroker()
+        bodies = {token: [] for token in accounts}
+
+        async def stream():
+            disconnected = asyncio.Event()
+
+            async def receive():
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+
+            def sender(token):
+                async def send(message):
+                    bodies[token].append(message.get("body", b""))
+                return send
+
+            streams = [
+                asyncio.ensure_future(EventStream()(
+                    {"type": "http", "method": "GET", "headers": [(b"authorization", token)]}, receive, sender(token)))
+                for token in accounts
+            ]
+            while sum(len(queues) for queues in broker._subscribers.values()) < len(accounts):
+                await asyncio.sleep(0.01)
+
+            broker._dispatch(json.dumps({"account": "acct-1", "type": "vm", "id": "vm-1", "state": "AVAILABLE"}))
+            await asyncio.sleep(0.1)
+            disconnected.set()
+            await asyncio.gather(*streams)
+
+        with mock.patch("api.event_stream.broker", broker), \
+                mock.patch.object(EventBroker, "_start_listener"), \
+                mock.patch("api.event_stream.KEEPALIVE_INTERVAL", 0.05), \
+                mock.patch("api.event_stream._authenticate", side_effect=lambda token: mock.Mock(account_id=accounts[token])):
+            asyncio.run(stream())
+
+        event = b'event: vm\ndata: {"type": "vm", "id": "vm-1", "state": "AVAILABLE"}\n\n'
+        self.assertIn(event, bodies[b"Bearer first"])
+        self.assertIn(event, bodies[b"Bearer second"])
+        self.assertFalse([body for body in bodies[b"Bearer other"] if body.startswith(b"event:")])
+
+
+class TestTaskRoutes(TestCase):
+
+    def test_every_task_is_routed_to_a_queue(self):
+        app.loader.import_default_modules()
+        queues = {queue.name for queue in settings.CELERY_TASK_QUEUES}
+        tasks = [name for name in app.tasks if name.split(".")[0] in ("vmmanager", "kube", "keys")]
+
+        self.assertTrue(tasks)
+        for name in tasks:
+            self.assertIn(name, settings.CELERY_TASK_ROUTES)
+            self.assertIn(settings.CELERY_TASK_ROUTES[name]["queue"], queues)
+
+
+class TestIdempotentTask(TestCase):
+
+    def setUp(self):
+        calls.clear()
+
+
+    def test_work_is_only_done_once(self):
+        first = flaky_task.apply(args=("a",))
+        second = flaky_task.apply(args=("a",))
+
+        self.assertEqual(first.get(), {"runs": 1})
+        self.assertEqual(second.get(), {"runs": 1})
+        self.assertEqual(calls, ["a"])
+
+        execution = TaskExecution.objects.get(key="test:a")
+        self.assertEqual(execution.state, TaskExecution.State.SUCCEEDED)
+        self.assertEqual(execution.task_id, first.id)
+
+
+    def test_transient_errors_are_retried(self):
+        result = flaky_task.apply(args=("b",), kwargs={"failures": 2})
+
+        self.assertEqual(result.get(), {"runs": 3})
+        execution = TaskExecution.objects.get(key="test:b")
+        self.assertEqual((execution.state, execution.attempts), (TaskExecution.State.SUCCEEDED, 3))
+
+
+    def test_failed_work_can_be_submitted_again(self):
+        result = flaky_task.apply(args=("c",), kwargs={"failures": flaky_task.max_retries + 1})
+
+        self.assertEqual(result.state, "FAILURE")
+        self.assertEqual(calls.count("c"), flaky_task.max_retries + 1)
+        self.assertEqual(TaskExecution.objects.get(key="test:c").state, TaskExecution.State.FAILED)
+
+        self.assertEqual(flaky_task.apply(args=("c",)).get(), {"runs": flaky_task.max_retries + 2})
@@ -0,0 +1,103 @@
+import asyncio
+from celery.signals import before_task_publish, task_prerun, task_postrun
+from django.utils.decorators import sync_and_async_middleware
+from opentelemetry import context, propagate, trace
+from opentelemetry.propagators.textmap import Getter
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from echome.tracing import tracer
+from .metrics import view_name
+
+# Spans of the tasks running in this process, ended when the task is done
+_task_spans = {}
+
+
+def _start_request_span(request):
+    span = tracer.start_span(
+        request.method,
+        context=propagate.extract(request.headers),
+        kind=SpanKind.SERVER,
+        attributes={"http.method": request.method, "http.target": request.path},
+    )
+    return span, context.attach(trace.set_span_in_context(span))
+
+
+def _end_request_span(request, response, span, token):
+    view = view_name(request)
+    span.update_name(f"{request.method} {view}")
+    span.set_attribute("http.route", view)
+    if response is not None:
+        span.set_attribute("http.status_code", response.status_code)
+        if response.status_code >= 500:
+            span.set_status(Status(StatusCode.ERROR))
+    context.detach(token)
+    span.end()
+
+
+@sync_and_async_middleware
+def tracing_middleware(get_response):
+    """Runs every request in a span, continuing the caller's trace if the
+    request has a traceparent header. Tasks queued while serving the request
+    and the commands they run are part of the same trace."""
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            span, token = _start_request_span(request)
+            response = None
+            try:
+                response = await get_response(request)
+                return response
+            finally:
+                _end_request_span(request, response, span, token)
+    else:
+        def middleware(request):
+            span, token = _start_request_span(request)
+            response = None
+            try:
+                response = get_response(request)
+                return response
+            finally:
+                _end_request_span(request, response, span, token)
+
+    return middleware
+
+
+class _TaskRequestGetter(Getter):
+    """Reads the trace context sent in a task's message headers, which
+    Celery sets as attributes of the task's request."""
+
+    def get(self, carrier, key):
+        value = getattr(carrier, key, None)
+        return [value] if value is not None else None
+
+
+    def keys(self, carrier):
+        return []
+
+
+@before_task_publish.connect
+def _inject_trace_context(headers=None, **kwargs):
+    if headers is not None:
+        propagate.inject(headers)
+
+
+@task_prerun.connect
+def _start_task_span(task_id=None, task=None, **kwargs):
+    span = tracer.start_span(
+        f"task {task.name}",
+        context=propagate.extract(task.request, getter=_TaskRequestGetter()),
+        kind=SpanKind.CONSUMER,
+        attributes={"celery.task_id": task_id},
+    )
+    _task_spans[task_id] = (span, context.attach(trace.set_span_in_context(span)))
+
+
+@task_postrun.connect
+def _end_task_span(task_id=None, state=None, **kwargs):
+    if task_id not in _task_spans:
+        return
+    span, token = _task_spans.pop(task_id)
+    span.set_attribute("celery.state", state or "UNKNOWN")
+    if state == "FAILURE":
+        span.set_status(Status(StatusCode.ERROR))
+    context.detach(token)
+    span.end()
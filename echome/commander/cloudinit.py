@@ -9,6 +9,7 @@ class CloudInit(BaseCommander):
     """
 
     base_command = '/usr/bin/cloud-init'
+    timeout = 120
     
     def validate_schema(self, file_path: str):
         """Cloud-config schema validator`.
@@ -9,6 +9,7 @@ class CloudLocalds(BaseCommander):
     """
 
     base_command = '/usr/bin/cloud-localds'
+    timeout = 120
     set_verbose = True
     
     def create_image(self, user_data_file:str, output:str, meta_data_file:str = None, network_config_file:str=None,):
@@ -1,5 +1,8 @@
 import logging
-import subprocess
+import os
+from typing import Callable
+from . import engine
+from .engine import CommandResult
 
 logger = logging.getLogger(__name__)
 
@@ -9,28 +12,45 @@ class BaseCommander():
     set_verbose = False
     verbose_flag = ["-v"]
     env = {}
+    # Seconds a command may run before it's terminated. None uses COMMAND_TIMEOUT
+    timeout = None
+
+    def _args(self, cmd: list) -> list:
+        opt_verbose = self.verbose_flag if self.set_verbose else []
+        return [self.base_command] + opt_verbose + [str(c) for c in cmd]
+
+
+    def _name(self, cmd: list) -> str:
+        """Name the command's timings and resource usage are recorded under."""
+        return os.path.basename(self.base_command)
+
+
+    def run(self, cmd: list, on_output: Callable[[str], None] = None, timeout: int = None) -> CommandResult:
+        """Run a command and return its result, with stdout and stderr captured. on_output is
+        called with each line of stdout as soon as it's written."""
+        result = engine.run(self._args(cmd), timeout=timeout or self.timeout, env=self.env, on_output=on_output, name=self._name(cmd))
+        logger.debug(result.stdout)
+        return result
+
+
+    async def run_async(self, cmd: list, on_output: Callable[[str], None] = None, timeout: int = None) -> CommandResult:
+        """Coroutine version of run()."""
+        result = await engine.run_async(self._args(cmd), timeout=timeout or self.timeout, env=self.env, on_output=on_output, name=self._name(cmd))
+        logger.debug(result.stdout)
+        return result
+
 
     def command(self, cmd: list, wait: bool = True):
-        """Run a command."""
+        """Run a command. Returns its stdout and return code (which is non-zero if it timed out)."""
+        result = self.run(cmd)
+        return result.stdout, result.returncode if not result.timed_out else -1
 
-        opt_verbose = self.verbose_flag if self.set_verbose else []
-        cmd = [self.base_command] + opt_verbose + cmd
-        
-        logger.debug(f"Running command: {cmd}")
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True, env=self.env)
-        if wait:
-            logger.debug("wait set to True. Waiting..")
-            proc.wait()
-            logger.debug("Process Wait finished")
-        stdout, stderr = proc.communicate()
-        logger.debug(stdout)
-        logger.debug(f"SUBPROCESS RETURN CODE: {proc.returncode}")
-
-        if proc.returncode != 0:
-            if stderr:
-                logger.error(f"stderr: {stderr}")
-
-        return stdout, proc.returncode
+
+    def stream(self, cmd: list, on_output: Callable[[str], None]):
+        """Run a command, calling on_output with each line it writes as soon as it's written.
+        Carriage returns end a line too, so progress bars are reported as they update."""
+        result = self.run(cmd, on_output=on_output)
+        return result.stdout, result.returncode if not result.timed_out else -1
 
 
 class CommandExitedWithError(Exception):
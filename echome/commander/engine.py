@@ -0,0 +1,335 @@
+import asyncio
+import contextvars
+import errno
+import functools
+import fcntl
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from opentelemetry.trace import Status, StatusCode
+from echome.tracing import tracer
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds a command may run before it's terminated, unless the commander sets its own
+COMMAND_TIMEOUT = int(os.getenv("COMMAND_TIMEOUT", "7200"))
+# Seconds a command gets to exit after SIGTERM before it's killed
+COMMAND_KILL_GRACE = int(os.getenv("COMMAND_KILL_GRACE", "10"))
+
+# Maximum number of concurrent runs of a tool, or of one of its subcommands, on this
+# host across every process. Subcommands without a limit of their own, like the quick
+# qemu-img info and create, fall back to the tool's, and without one aren't limited.
+# Override with COMMAND_CONCURRENCY, e.g. "virt-sparsify=1,qemu-img convert=8"
+DEFAULT_CONCURRENCY = {
+    "virt-sparsify": 1,
+    "virt-sysprep": 2,
+    "qemu-img convert": 4,
+}
+# Has to be shared by every container that runs commands on the host (api and worker)
+COMMAND_LOCK_DIR = os.getenv("COMMAND_LOCK_DIR", "/var/lib/echome/locks")
+
+
+def _parse_concurrency(value:str) -> Dict[str, int]:
+    limits = dict(DEFAULT_CONCURRENCY)
+    for item in value.split(","):
+        if "=" in item:
+            tool, limit = item.split("=", 1)
+            limits[tool.strip()] = int(limit)
+    return limits
+
+COMMAND_CONCURRENCY = _parse_concurrency(os.getenv("COMMAND_CONCURRENCY", ""))
+
+
+@dataclass
+class CommandResult:
+    """Outcome of running an external command."""
+    args: List[str]
+    returncode: int
+    stdout: str
+    stderr: str
+    # Wall time in seconds, not including time spent waiting for a concurrency slot
+    duration: float
+    # Seconds spent waiting for a concurrency slot
+    queued: float = 0.0
+    timed_out: bool = False
+    # Name the command is recorded under, e.g. `qemu-img convert`
+    name: str = ""
+    # CPU seconds used by the command and the children it waited for
+    cpu_user: float = 0.0
+    cpu_system: float = 0.0
+    # Bytes the command read from and wrote to block devices. Reads served from
+    # the page cache aren't counted.
+    bytes_read: int = 0
+    bytes_written: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and not self.timed_out
+
+
+    @property
+    def status(self) -> str:
+        if self.timed_out:
+            return "timeout"
+        return "ok" if self.returncode == 0 else "error"
+
+
+    def summary(self) -> dict:
+        """What's recorded against the operation that ran the command."""
+        return {
+            "command": self.name,
+            "status": self.status,
+            "returncode": self.returncode,
+            "seconds": self.duration,
+            "queued_seconds": self.queued,
+            "cpu_seconds": round(self.cpu_user + self.cpu_system, 3),
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+        }
+
+
+# Lists collecting the summaries of the commands run by the current operation
+_recorders: contextvars.ContextVar[Tuple[list, ...]] = contextvars.ContextVar("command_recorders", default=())
+
+
+@contextmanager
+def record_commands():
+    """Collect the summary of every command run within this block (in this thread or
+    task) into the list it yields, so it can be stored with the virtual machine or
+    image the commands were run for. Blocks can be nested."""
+    commands = []
+    token = _recorders.set(_recorders.get() + (commands,))
+    try:
+        yield commands
+    finally:
+        _recorders.reset(token)
+
+
+class HostSemaphore:
+    """Limits concurrent runs of a tool across every process on this host, with one
+    lock file per slot. Locks are released by the kernel if a process dies holding one."""
+
+    def __init__(self, tool:str, limit:int, lock_dir:str = COMMAND_LOCK_DIR) -> None:
+        self.tool = tool
+        self.limit = limit
+        self.lock_dir = Path(lock_dir)
+        self.fd = None
+
+
+    def _try_acquire(self) -> bool:
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        for slot in range(self.limit):
+            fd = os.open(self.lock_dir / f"{self.tool.replace(' ', '-')}.{slot}.lock", os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                os.close(fd)
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    continue
+                raise
+            self.fd = fd
+            return True
+        return False
+
+
+    def acquire(self):
+        delay = 0.05
+        while not self._try_acquire():
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+def tool_semaphore(args:List[str]) -> Optional[HostSemaphore]:
+    """The semaphore limiting concurrent runs of the command's subcommand, or of its
+    tool, if either has a limit."""
+    tool = os.path.basename(args[0])
+    if len(args) > 1 and not args[1].startswith("-"):
+        subcommand = f"{tool} {args[1]}"
+        if subcommand in COMMAND_CONCURRENCY:
+            return HostSemaphore(subcommand, COMMAND_CONCURRENCY[subcommand])
+
+    limit = COMMAND_CONCURRENCY.get(tool)
+    return HostSemaphore(tool, limit) if limit else None
+
+
+class _LineSplitter:
+    """Splits output into lines as it arrives. Carriage returns end a line too, so
+    progress bars are reported as they update."""
+
+    def __init__(self, on_output:Callable[[str], None] = None) -> None:
+        self.on_output = on_output
+        self.pending = b""
+        self.chunks = []
+
+
+    def feed(self, chunk:bytes):
+        self.chunks.append(chunk)
+        if not self.on_output:
+            return
+        *lines, self.pending = re.split(rb"[\r\n]", self.pending + chunk)
+        for line in lines:
+            if line.strip():
+                self.on_output(line.decode("utf-8", errors="replace"))
+
+
+    def close(self) -> str:
+        if self.on_output and self.pending.strip():
+            self.on_output(self.pending.decode("utf-8", errors="replace"))
+        return b"".join(self.chunks).decode("utf-8", errors="replace")
+
+
+def _signal_group(proc, sig:int):
+    # Commands run in their own process group so helpers they start
+    # (e.g. the libguestfs appliance) are stopped along with them
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def run(args:List[str], timeout:int = None, env:dict = None,
+        on_output:Callable[[str], None] = None, name:str = None) -> CommandResult:
+    """Run a command to completion, reading stdout and stderr as they're written. on_output
+    is called with each line of stdout. After timeout seconds the command is sent SIGTERM,
+    then SIGKILL if it hasn't exited COMMAND_KILL_GRACE seconds later.
+
+    The command's timings and resource usage are recorded under name, which defaults
+    to the executable's name."""
+    timeout = timeout if timeout is not None else COMMAND_TIMEOUT
+    name = name if name else os.path.basename(args[0])
+
+    with tracer.start_as_current_span(f"command {name}", attributes={"command.args": [str(a) for a in args]}) as span:
+        semaphore = tool_semaphore(args)
+
+        queued_at = time.monotonic()
+        if semaphore:
+            semaphore.acquire()
+        try:
+            started = time.monotonic()
+            logger.debug(f"Running command: {args}")
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                env=env, start_new_session=True)
+
+            waiter = _Waiter(proc)
+            stdout = _LineSplitter(on_output)
+            stderr = _LineSplitter()
+            threads = [
+                waiter,
+                threading.Thread(target=_read_pipe, args=(proc.stdout, stdout), daemon=True),
+                threading.Thread(target=_read_pipe, args=(proc.stderr, stderr), daemon=True),
+            ]
+            for thread in threads:
+                thread.start()
+
+            timed_out = False
+            waiter.join(timeout)
+            if waiter.is_alive():
+                timed_out = True
+                logger.warning(f"Command timed out after {timeout} seconds, terminating: {args}")
+                _signal_group(proc, signal.SIGTERM)
+                waiter.join(COMMAND_KILL_GRACE)
+                if waiter.is_alive():
+                    logger.warning(f"Command did not exit after SIGTERM, killing: {args}")
+                    _signal_group(proc, signal.SIGKILL)
+
+                # A process stuck in the kernel can't be reaped, and helpers that left the
+                # process group can keep its pipes open. Don't wait on them for good.
+                for thread in threads:
+                    thread.join(COMMAND_KILL_GRACE)
+                if proc.returncode is None:
+                    logger.error(f"Command could not be reaped after SIGKILL: {args}")
+                    proc.returncode = -signal.SIGKILL
+            else:
+                for thread in threads:
+                    thread.join()
+        finally:
+            if semaphore:
+                semaphore.release()
+
+        result = CommandResult(
+            args = args,
+            returncode = proc.returncode,
+            stdout = stdout.close(),
+            stderr = stderr.close(),
+            duration = round(time.monotonic() - started, 3),
+            queued = round(started - queued_at, 3),
+            timed_out = timed_out,
+            name = name,
+            cpu_user = round(waiter.rusage.ru_utime, 3) if waiter.rusage else 0.0,
+            cpu_system = round(waiter.rusage.ru_stime, 3) if waiter.rusage else 0.0,
+            bytes_read = waiter.rusage.ru_inblock * 512 if waiter.rusage else 0,
+            bytes_written = waiter.rusage.ru_oublock * 512 if waiter.rusage else 0,
+        )
+        span.set_attributes({
+            "command.returncode": result.returncode,
+            "command.timed_out": result.timed_out,
+            "command.queued_seconds": result.queued,
+            "command.cpu_seconds": result.cpu_user + result.cpu_system,
+        })
+        if not result.ok:
+            span.set_status(Status(StatusCode.ERROR, result.stderr[-500:]))
+
+    _record(result)
+    return result
+
+
+class _Waiter(threading.Thread):
+    """Reaps the command with wait4(), which unlike Popen.wait() returns its resource usage."""
+
+    def __init__(self, proc:subprocess.Popen) -> None:
+        super().__init__(daemon=True)
+        self.proc = proc
+        self.rusage = None
+
+
+    def run(self):
+        _, status, self.rusage = os.wait4(self.proc.pid, 0)
+        if os.WIFSIGNALED(status):
+            self.proc.returncode = -os.WTERMSIG(status)
+        else:
+            self.proc.returncode = os.WEXITSTATUS(status)
+
+
+def _read_pipe(pipe, splitter:_LineSplitter):
+    with pipe:
+        for chunk in iter(lambda: pipe.read1(65536), b""):
+            splitter.feed(chunk)
+
+
+async def run_async(args:List[str], timeout:int = None, env:dict = None,
+        on_output:Callable[[str], None] = None, name:str = None) -> CommandResult:
+    """Coroutine version of run(). The command is run from the loop's default executor,
+    so on_output is called from that thread."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, context.run,
+        functools.partial(run, args, timeout=timeout, env=env, on_output=on_output, name=name))
+
+
+def _record(result:CommandResult):
+    logger.debug(f"Command exited with {result.returncode} after {result.duration} seconds "
+        f"({result.cpu_user + result.cpu_system:.2f} CPU seconds, {result.bytes_read} bytes read, "
+        f"{result.bytes_written} bytes written): {result.args}")
+    if not result.ok and result.stderr:
+        logger.error(f"stderr: {result.stderr}")
+
+    metrics.observe(result)
+    summary = result.summary()
+    for commands in _recorders.get():
+        commands.append(summary)
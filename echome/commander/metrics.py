@@ -0,0 +1,46 @@
+from prometheus_client import Histogram
+
+# From the sub-second runs of cloud-localds to sparsifying a large image
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+# 1 MiB to 64 GiB
+BYTES_BUCKETS = tuple(2**20 * 4**i for i in range(9))
+
+command_duration = Histogram(
+    "echome_command_duration_seconds",
+    "Wall time of external commands",
+    ["command", "status"],
+    buckets=DURATION_BUCKETS,
+)
+command_cpu = Histogram(
+    "echome_command_cpu_seconds",
+    "User and system CPU time of external commands",
+    ["command"],
+    buckets=DURATION_BUCKETS,
+)
+command_queued = Histogram(
+    "echome_command_queued_seconds",
+    "Time external commands waited for a concurrency slot",
+    ["command"],
+    buckets=DURATION_BUCKETS,
+)
+command_bytes_read = Histogram(
+    "echome_command_read_bytes",
+    "Bytes external commands read from block devices",
+    ["command"],
+    buckets=BYTES_BUCKETS,
+)
+command_bytes_written = Histogram(
+    "echome_command_written_bytes",
+    "Bytes external commands wrote to block devices",
+    ["command"],
+    buckets=BYTES_BUCKETS,
+)
+
+
+def observe(result):
+    """Record a CommandResult."""
+    command_duration.labels(result.name, result.status).observe(result.duration)
+    command_cpu.labels(result.name).observe(result.cpu_user + result.cpu_system)
+    command_queued.labels(result.name).observe(result.queued)
+    command_bytes_read.labels(result.name).observe(result.bytes_read)
+    command_bytes_written.labels(result.name).observe(result.bytes_written)
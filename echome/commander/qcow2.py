@@ -0,0 +1,76 @@
+import logging
+import os
+import struct
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+QCOW2_MAGIC = b"QFI\xfb"
+
+# magic, version, backing_file_offset, backing_file_size, cluster_bits, size,
+# crypt_method, l1_size, l1_table_offset, refcount_table_offset, 
+# refcount_table_clusters, nb_snapshots, snapshots_offset
+HEADER = struct.Struct(">4sIQIIQIIQQIIQ")
+# incompatible_features, compatible_features, autoclear_features, refcount_order, header_length
+HEADER_V3 = struct.Struct(">QQQII")
+EXTENSION = struct.Struct(">II")
+
+EXT_END = 0x00000000
+EXT_BACKING_FORMAT = 0xE2792ACA
+
+COMPRESSION_TYPES = {0: "zlib", 1: "zstd"}
+
+
+def read_qcow2_header(filename: str) -> Optional[dict]:
+    """Read a qcow2 image's header straight from the file, without running qemu-img.
+    Returns the same keys `qemu-img info --output json` does for the fields in the
+    header, or None if the file isn't a qcow2 image."""
+    with open(filename, "rb") as f:
+        header = f.read(4096)
+        if len(header) < HEADER.size or header[:4] != QCOW2_MAGIC:
+            return None
+
+        (_, version, backing_file_offset, backing_file_size, cluster_bits, size,
+            crypt_method, _, _, _, _, nb_snapshots, _) = HEADER.unpack_from(header)
+
+        info = {
+            "filename": filename,
+            "format": "qcow2",
+            "virtual-size": size,
+            "actual-size": os.stat(f.fileno()).st_blocks * 512,
+            "cluster-size": 1 << cluster_bits,
+            "encrypted": crypt_method != 0,
+            "dirty-flag": False,
+            "snapshots": nb_snapshots,
+            "format-specific": {
+                "type": "qcow2",
+                "data": {"compat": "1.1" if version >= 3 else "0.10"},
+            },
+        }
+
+        header_length = HEADER.size
+        if version >= 3:
+            incompatible, _, _, refcount_order, header_length = HEADER_V3.unpack_from(header, HEADER.size)
+            info["dirty-flag"] = bool(incompatible & 1)
+            info["format-specific"]["data"]["refcount-bits"] = 1 << refcount_order
+            # The compression type is the byte after the header fields, if the header has it
+            if header_length > 104:
+                info["format-specific"]["data"]["compression-type"] = COMPRESSION_TYPES.get(header[104], "unknown")
+
+        # Header extensions follow the header, up to the end of the first cluster
+        offset = header_length
+        while offset + EXTENSION.size <= len(header):
+            ext_type, ext_length = EXTENSION.unpack_from(header, offset)
+            offset += EXTENSION.size
+            if ext_type == EXT_END:
+                break
+            if ext_type == EXT_BACKING_FORMAT:
+                info["backing-filename-format"] = header[offset:offset + ext_length].decode("utf-8", errors="replace")
+            # Extension data is padded to a multiple of 8 bytes
+            offset += (ext_length + 7) & ~7
+
+        if backing_file_offset:
+            f.seek(backing_file_offset)
+            info["backing-filename"] = f.read(backing_file_size).decode("utf-8", errors="replace")
+
+    return info
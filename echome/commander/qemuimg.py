@@ -1,16 +1,35 @@
+import copy
 import logging
 import json
+import os
+import re
+import struct
+import threading
+from collections import OrderedDict
+from typing import Callable
 from .commander import BaseCommander
+from .qcow2 import read_qcow2_header
 
 logger = logging.getLogger(__name__)
 
+# Number of images info() keeps the details of
+QEMU_IMG_INFO_CACHE_SIZE = int(os.getenv("QEMU_IMG_INFO_CACHE_SIZE", "1024"))
+
+_info_cache = OrderedDict()
+_info_cache_lock = threading.Lock()
+
 class QemuImg(BaseCommander):
     """
     Create a QemuImg object to pass commands to qemu-img.
     """
 
     base_command = '/usr/bin/qemu-img'
-    
+
+
+    def _name(self, cmd: list) -> str:
+        # Recorded per subcommand; a resize and a convert have little in common
+        return f"qemu-img {cmd[0]}"
+
 
     def resize(self, filename: str, size: str):
         """Resize disk images using `qemu-img resize`.
@@ -29,30 +48,72 @@ class QemuImg(BaseCommander):
             return False
     
 
-    def convert(self, filename: str, output_filename: str, output_format=None):
+    def convert(self, filename: str, output_filename: str, output_format=None, force_share: bool = False,
+            compression: str = None, on_progress: Callable[[float], None] = None):
         """Convert or copy an image to another format using `qemu-img convert`.
+        Zeroed areas of the source are not written to the destination.
 
         :param filename: Source filename to convert or copy.
         :param output_filename: Destination filename.
         :param output_format: Specify a format to copy to. By default, uses the
             format of the original filename. Run qemu-img -h to determine what
             formats are supported, defaults to None
+        :param force_share: Open the source even if a running virtual machine has it
+            open (e.g. as the backing file of a snapshot), defaults to False
+        :param compression: Compress the destination (qcow2 only) with `zlib` or `zstd`,
+            defaults to None
+        :param on_progress: Called with the percentage copied as the conversion
+            runs, defaults to None
 
         :returns: boolean if the operation was successful
         """        
         flags = []
+        if force_share:
+            flags.append("-U")
         if output_format:
             flags.append("-O")
             flags.append(output_format)
+        if compression:
+            flags.append("-c")
+            if compression != "zlib":
+                flags += ["-o", f"compression_type={compression}"]
         
         cmds = ["convert"] + flags + [filename, output_filename]
-        output, return_code = self.command(cmds)
+        if on_progress:
+            output, return_code = self.stream(["convert", "-p"] + cmds[1:], 
+                lambda line: self._report_progress(line, on_progress))
+        else:
+            output, return_code = self.command(cmds)
         if return_code == 0:
             return True
         else:
             return False
     
 
+    def _report_progress(self, line: str, on_progress: Callable[[float], None]):
+        # qemu-img -p prints "    (12.34/100%)"
+        if match := re.search(r"\(([\d.]+)/100%\)", line):
+            on_progress(float(match.group(1)))
+
+
+    def create_overlay(self, filename: str, backing_filename: str, backing_format: str = "qcow2"):
+        """Create a qcow2 image on top of a backing image using `qemu-img create -b`.
+        Writes go to the new image, the backing image is only read.
+
+        :param filename: Destination filename/location for the new image.
+        :param backing_filename: Image the new image is backed by.
+        :param backing_format: Format of the backing image, defaults to qcow2
+
+        :returns: boolean if the operation was successful
+        """
+        cmds = ["create", "-f", "qcow2", "-b", str(backing_filename), "-F", backing_format, filename]
+        output, return_code = self.command(cmds)
+        if return_code == 0:
+            return True
+        else:
+            return False
+
+
     def create(self, filename: str, format: str, size: str):
         """Create a new image for virtual machines using `qemu-img create`.
 
@@ -74,18 +135,46 @@ class QemuImg(BaseCommander):
             return False
         
 
-    def info(self, filename: str):
+    def info(self, filename: str, full: bool = False):
         """Get info about an image. Returns a dictionary if the image exists.
 
+        qcow2 headers are read directly from the file, other formats with `qemu-img info`.
+        Results are cached until the file changes (by inode, modification time and size).
+
         :param filename: Destination filename/location for the new image.
+        :param full: Always run `qemu-img info`, which includes details that aren't
+            in the qcow2 header (e.g. snapshot names), defaults to False
 
         :returns: Dictionary if successful, False if the operation was unsuccessful. 
         """
-        flags = ["--output", "json"]
-        
-        cmds = ["info"] + [filename] + flags
-        output, return_code = self.command(cmds)
-        if return_code == 0:
-            return json.loads(output)
-        else:
+        try:
+            stat = os.stat(filename)
+        except OSError:
             return False
+
+        key = (str(filename), stat.st_ino, stat.st_mtime_ns, stat.st_size, full)
+        with _info_cache_lock:
+            if key in _info_cache:
+                _info_cache.move_to_end(key)
+                return copy.deepcopy(_info_cache[key])
+
+        obj = None
+        if not full:
+            try:
+                obj = read_qcow2_header(filename)
+            except (OSError, ValueError, struct.error) as e:
+                logger.debug(f"Unable to read qcow2 header of {filename}: {e}")
+
+        if obj is None:
+            flags = ["--output", "json"]
+            cmds = ["info"] + [filename] + flags
+            output, return_code = self.command(cmds)
+            if return_code != 0:
+                return False
+            obj = json.loads(output)
+
+        with _info_cache_lock:
+            _info_cache[key] = obj
+            while len(_info_cache) > QEMU_IMG_INFO_CACHE_SIZE:
+                _info_cache.popitem(last=False)
+        return copy.deepcopy(obj)
@@ -1,3 +1,132 @@
+import asyncio
+import os
+import tempfile
 from django.test import TestCase
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from echome.tracing import add_exporter, tracer
+from .qcow2 import read_qcow2_header, HEADER, HEADER_V3, EXTENSION, EXT_BACKING_FORMAT
+from .qemuimg import QemuImg
+from . import engine
+
+def write_qcow2(path:str, size:int, backing:str = None):
+    """Write the header of an (empty) qcow2 v3 image."""
+    header_length = 112
+    backing_offset = 512 if backing else 0
+    header = HEADER.pack(b"QFI\xfb", 3, backing_offset, len(backing or ""), 16, size, 0, 0, 0, 0, 0, 0, 0)
+    header += HEADER_V3.pack(0, 0, 0, 4, header_length)
+    header += bytes([1]) + bytes(header_length - len(header) - 1)
+    if backing:
+        header += EXTENSION.pack(EXT_BACKING_FORMAT, 5) + b"qcow2" + bytes(3)
+    header += EXTENSION.pack(0, 0)
+    header = header.ljust(512, b"\0")
+    if backing:
+        header += backing.encode("utf-8")
+
+    with open(path, "wb") as f:
+        f.write(header)
 
 # Create your tests here.
+class TestQemuImgInfo(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "disk.qcow2")
+
+
+    def test_reads_qcow2_header(self):
+        write_qcow2(self.path, 10 * 2**30, backing="/images/base.qcow2")
+        info = read_qcow2_header(self.path)
+
+        self.assertEqual(info["format"], "qcow2")
+        self.assertEqual(info["virtual-size"], 10 * 2**30)
+        self.assertEqual(info["cluster-size"], 65536)
+        self.assertEqual(info["backing-filename"], "/images/base.qcow2")
+        self.assertEqual(info["backing-filename-format"], "qcow2")
+        self.assertEqual(info["format-specific"]["data"]["compression-type"], "zstd")
+
+
+    def test_other_formats_are_not_parsed(self):
+        with open(self.path, "wb") as f:
+            f.write(bytes(1024))
+        self.assertIsNone(read_qcow2_header(self.path))
+
+
+    def test_info_is_cached_until_the_file_changes(self):
+        write_qcow2(self.path, 2**30)
+        self.assertEqual(QemuImg().info(self.path)["virtual-size"], 2**30)
+
+        # Cached copies can't be changed by callers
+        QemuImg().info(self.path)["virtual-size"] = 0
+        self.assertEqual(QemuImg().info(self.path)["virtual-size"], 2**30)
+
+        write_qcow2(self.path, 2**31)
+        os.utime(self.path, ns=(0, 1))
+        self.assertEqual(QemuImg().info(self.path)["virtual-size"], 2**31)
+
+
+class TestEngine(TestCase):
+
+    def test_large_output_and_stderr_are_captured(self):
+        # More output than fits in a pipe buffer
+        result = engine.run(["/bin/sh", "-c", "head -c 1000000 /dev/zero; echo failed >&2; exit 3"])
+        self.assertEqual(len(result.stdout), 1000000)
+        self.assertEqual(result.stderr, "failed\n")
+        self.assertEqual(result.returncode, 3)
+        self.assertFalse(result.ok)
+
+
+    def test_output_is_streamed_by_line(self):
+        lines = []
+        engine.run(["/bin/sh", "-c", "printf '(1.00/100%%)\\r(50.00/100%%)\\rdone\\n'"], on_output=lines.append)
+        self.assertEqual(lines, ["(1.00/100%)", "(50.00/100%)", "done"])
+
+
+    def test_timed_out_commands_are_killed(self):
+        result = engine.run(["/bin/sleep", "30"], timeout=1)
+        self.assertTrue(result.timed_out)
+        self.assertFalse(result.ok)
+        self.assertLess(result.duration, 30)
+
+
+    def test_async_front_end(self):
+        result = asyncio.run(engine.run_async(["/bin/sh", "-c", "echo out; echo err >&2"]))
+        self.assertEqual((result.stdout, result.stderr, result.returncode), ("out\n", "err\n", 0))
+
+
+
+    def test_commands_are_recorded_with_their_resource_usage(self):
+        with engine.record_commands() as commands:
+            result = engine.run(["/bin/sh", "-c", "i=0; while [ $i -lt 200000 ]; do i=$((i+1)); done"], name="busy loop")
+        self.assertGreater(result.cpu_user + result.cpu_system, 0)
+        self.assertEqual(commands, [result.summary()])
+        self.assertEqual(commands[0]["command"], "busy loop")
+
+
+    def test_concurrency_is_limited_per_subcommand(self):
+        self.assertEqual(engine.tool_semaphore(["/usr/bin/qemu-img", "convert", "-O", "qcow2", "a", "b"]).tool, "qemu-img convert")
+        self.assertIsNone(engine.tool_semaphore(["/usr/bin/qemu-img", "info", "a"]))
+        self.assertEqual(engine.tool_semaphore(["virt-sparsify", "--in-place", "a"]).tool, "virt-sparsify")
+
+
+class TestEngineTracing(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.exporter = InMemorySpanExporter()
+        add_exporter(cls.exporter)
+
+
+    def setUp(self):
+        self.exporter.clear()
+
+
+    def test_commands_are_traced_within_the_current_span(self):
+        with tracer.start_as_current_span("vm.prepare_disk") as parent:
+            engine.run(["/bin/sh", "-c", "exit 1"], name="qemu-img resize")
+
+        command, prepare_disk = self.exporter.get_finished_spans()
+        self.assertEqual(command.name, "command qemu-img resize")
+        self.assertEqual(command.parent.span_id, parent.get_span_context().span_id)
+        self.assertEqual(command.attributes["command.returncode"], 1)
+        self.assertFalse(command.status.is_ok)
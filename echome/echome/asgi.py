@@ -13,4 +13,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'echome.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django has been set up
+from api.event_stream import EventStream
+
+event_stream = EventStream()
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] == EventStream.path:
+        return await event_stream(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -44,6 +44,8 @@ class AppConfig:
 
         guest_images_dir = None
         user_dir = None
+        image_store_dir = None
+        image_cache_dir = "/var/lib/echome/image_cache"
     
     class EcHome(__base_section):
         ini_section = "echome"
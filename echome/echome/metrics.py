@@ -0,0 +1,35 @@
+import asyncio
+import functools
+import time
+from prometheus_client import Histogram
+
+# From a quick libvirt lookup to a VM shutdown that's waited on
+CALL_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def timed(histogram:Histogram, *labels:str):
+    """Decorator observing how long each call to a function (or coroutine) takes
+    into histogram, with the given label values."""
+    child = histogram.labels(*labels)
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_inner(*args, **kwargs):
+                started = time.monotonic()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    child.observe(time.monotonic() - started)
+            return async_inner
+
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                child.observe(time.monotonic() - started)
+        return inner
+
+    return decorator
@@ -15,6 +15,7 @@ from pathlib import Path
 import dj_database_url
 from datetime import timedelta
 from celery.signals import setup_logging
+from kombu import Queue
 from .config import ecHomeConfig
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -30,6 +31,7 @@ ALLOWED_HOSTS = ['*']
 
 INSTALLED_APPS = [
     'django_extensions',
+    'django_celery_results',
     'api.apps.ApiConfig',
     'commander.apps.CommanderConfig',
     'identity.apps.IdentityConfig',
@@ -47,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.metrics_middleware',
+    'api.tracing.tracing_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -80,10 +84,10 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.AllowAny',
     ),
     'DEFAULT_RENDERER_CLASSES': (
-        'rest_framework.renderers.JSONRenderer',
+        'api.renderers.ORJSONRenderer',
     ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'identity.authentication.CachedJWTAuthentication',
         #'rest_framework.authentication.TokenAuthentication',
         # 'rest_framework.authentication.SessionAuthentication',
         # 'rest_framework.authentication.BasicAuthentication',
@@ -105,6 +109,7 @@ LOGGING = {
 }
 
 WSGI_APPLICATION = 'echome.wsgi.application'
+ASGI_APPLICATION = 'echome.asgi.application'
 
 
 # Database
@@ -116,6 +121,82 @@ DATABASES = {"default": dj_database_url.config(default='postgres://echome:echome
 CELERY_BROKER_URL = 'amqp://guest@rabbitmq//'
 CELERY_WORKER_HIJACK_ROOT_LOGGER = False
 
+# Each kind of work has its own queue, consumed by its own worker (bin/worker <queue>),
+# so a quick termination doesn't wait behind an image build. Within a queue, tasks
+# someone is waiting on are given a higher priority (0-9) than background work.
+# Tasks that have to run on a particular host go to its host.<host ID> queue instead.
+CELERY_TASK_QUEUES = (
+    Queue('launch', queue_arguments={'x-max-priority': 9}),
+    Queue('terminate', queue_arguments={'x-max-priority': 9}),
+    Queue('image', queue_arguments={'x-max-priority': 9}),
+    Queue('kube', queue_arguments={'x-max-priority': 9}),
+    Queue('maintenance', queue_arguments={'x-max-priority': 9}),
+    # Anything that isn't routed
+    Queue('celery'),
+)
+CELERY_TASK_DEFAULT_QUEUE = 'celery'
+CELERY_TASK_ROUTES = {
+    'vmmanager.tasks.task_fill_warm_pool': {'queue': 'launch', 'priority': 3},
+    'keys.tasks.task_refill_keypair_pool': {'queue': 'launch', 'priority': 3},
+    'vmmanager.tasks.task_terminate_instance': {'queue': 'terminate', 'priority': 9},
+    'vmmanager.tasks.task_create_image': {'queue': 'image', 'priority': 9},
+    'vmmanager.tasks.task_store_image': {'queue': 'image', 'priority': 5},
+    'kube.tasks.task_create_cluster': {'queue': 'kube', 'priority': 9},
+    'kube.tasks.task_add_node': {'queue': 'kube', 'priority': 9},
+    'kube.tasks.task_register_kube_image': {'queue': 'kube', 'priority': 5},
+    'kube.tasks.task_build_kube_image': {'queue': 'kube', 'priority': 3},
+    # Samples and state are only useful when they're current
+    'vmmanager.tasks.task_collect_vm_stats': {'queue': 'maintenance', 'priority': 9},
+    'vmmanager.tasks.task_collect_all_vm_stats': {'queue': 'maintenance', 'priority': 9},
+    'vmmanager.tasks.task_reconcile_host': {'queue': 'maintenance', 'priority': 7},
+    'vmmanager.tasks.task_reconcile_all_hosts': {'queue': 'maintenance', 'priority': 7},
+    'vmmanager.tasks.task_maintain_warm_pools': {'queue': 'maintenance', 'priority': 5},
+    'vmmanager.tasks.task_prefetch_image': {'queue': 'maintenance', 'priority': 3},
+    'vmmanager.tasks.task_prefetch_popular_images': {'queue': 'maintenance', 'priority': 3},
+    'vmmanager.tasks.task_collect_image_blobs': {'queue': 'maintenance', 'priority': 1},
+    'vmmanager.tasks.task_drop_unreferenced_images': {'queue': 'maintenance', 'priority': 1},
+    'vmmanager.tasks.task_collect_orphans': {'queue': 'maintenance', 'priority': 1},
+    'vmmanager.tasks.task_collect_orphans_on_all_hosts': {'queue': 'maintenance', 'priority': 1},
+}
+# Workers only reserve the task they're about to run, so a long task doesn't
+# hold on to quick ones and priorities apply to everything still waiting.
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Outcomes of the tasks that keep them (api.idempotency.IdempotentTask) can be looked
+# up by task ID. Other tasks are fire and forget.
+CELERY_RESULT_BACKEND = 'django-db'
+CELERY_RESULT_EXTENDED = True
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_TASK_TRACK_STARTED = True
+
+# Periodic tasks, run by celery beat (bin/beat)
+CELERY_BEAT_SCHEDULE = {
+    'maintain-warm-pools': {
+        'task': 'vmmanager.tasks.task_maintain_warm_pools',
+        'schedule': int(os.getenv('WARM_POOL_MAINTENANCE_INTERVAL', '300')),
+    },
+    'collect-image-blobs': {
+        'task': 'vmmanager.tasks.task_collect_image_blobs',
+        'schedule': int(os.getenv('IMAGE_BLOB_GC_INTERVAL', '3600')),
+    },
+    'prefetch-popular-images': {
+        'task': 'vmmanager.tasks.task_prefetch_popular_images',
+        'schedule': int(os.getenv('IMAGE_PREFETCH_INTERVAL', '3600')),
+    },
+    'collect-vm-stats': {
+        'task': 'vmmanager.tasks.task_collect_all_vm_stats',
+        'schedule': int(os.getenv('VM_STATS_INTERVAL', '60')),
+    },
+    'reconcile-vms': {
+        'task': 'vmmanager.tasks.task_reconcile_all_hosts',
+        'schedule': int(os.getenv('RECONCILE_INTERVAL', '120')),
+    },
+    'collect-orphans': {
+        'task': 'vmmanager.tasks.task_collect_orphans_on_all_hosts',
+        'schedule': int(os.getenv('ORPHAN_GC_INTERVAL', '21600')),
+    },
+}
+
 @setup_logging.connect
 def configure_logging(sender=None, **kwargs):
     import logging
@@ -143,6 +224,21 @@ AUTH_PASSWORD_VALIDATORS = [
 
 AUTH_USER_MODEL = 'identity.User'
 
+# The 'auth' cache holds authenticated users per access token. It's local to
+# each process by default, where users are only cached for AUTH_LOCAL_CACHE_TTL
+# seconds since other API processes don't see access key changes. Point it at a
+# shared cache (e.g. Redis) so changes are seen by every process immediately and
+# users can be cached for AUTH_CACHE_TTL seconds.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'auth': {
+        'BACKEND': os.getenv('AUTH_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('AUTH_CACHE_LOCATION', 'auth'),
+    },
+}
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(hours=1),
     'ROTATE_REFRESH_TOKENS': True,
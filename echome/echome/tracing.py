@@ -0,0 +1,58 @@
+import asyncio
+import functools
+import logging
+import os
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SimpleSpanProcessor, SpanExporter
+
+logger = logging.getLogger(__name__)
+
+# Spans are sent with OTLP over HTTP when this (or OTEL_EXPORTER_OTLP_TRACES_ENDPOINT)
+# is set, e.g. http://jaeger:4318. Otherwise nothing is exported.
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT") or os.getenv("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "echome")
+
+tracer = trace.get_tracer("echome")
+
+_provider = None
+
+
+def configure_tracing() -> TracerProvider:
+    """Install the tracer provider for this process, exporting to OTLP if an
+    endpoint is configured. Safe to call more than once."""
+    global _provider
+    if _provider is None:
+        _provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+        if OTEL_EXPORTER_OTLP_ENDPOINT:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            _provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+            logger.debug(f"Exporting traces to {OTEL_EXPORTER_OTLP_ENDPOINT}")
+        trace.set_tracer_provider(_provider)
+    return _provider
+
+
+def add_exporter(exporter:SpanExporter):
+    """Export every span finished in this process to exporter as soon as it ends,
+    e.g. an InMemorySpanExporter in tests."""
+    configure_tracing().add_span_processor(SimpleSpanProcessor(exporter))
+
+
+def traced(name:str):
+    """Decorator running each call to a function (or coroutine) in a span."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_inner(*args, **kwargs):
+                with tracer.start_as_current_span(name):
+                    return await func(*args, **kwargs)
+            return async_inner
+
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            with tracer.start_as_current_span(name):
+                return func(*args, **kwargs)
+        return inner
+
+    return decorator
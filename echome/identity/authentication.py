@@ -0,0 +1,100 @@
+import logging
+import os
+import time
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+# How long (seconds) an authenticated user is reused for the same token
+# before it's loaded from the database again.
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "60"))
+# With a cache local to each process (the default), invalidate_cached_user() is
+# only seen by the process it ran in, so other processes may keep using a disabled
+# user for this long. Users are never cached for longer than this there.
+AUTH_LOCAL_CACHE_TTL = int(os.getenv("AUTH_LOCAL_CACHE_TTL", "5"))
+
+auth_cache = caches["auth"]
+if isinstance(auth_cache, LocMemCache):
+    AUTH_CACHE_TTL = min(AUTH_CACHE_TTL, AUTH_LOCAL_CACHE_TTL)
+
+
+def _token_key(jti:str) -> str:
+    return f"jwt:{jti}"
+
+
+def _generation_key(user_id:str) -> str:
+    return f"jwt-user-generation:{user_id}"
+
+
+def invalidate_cached_user(user_id:str):
+    """Discard every cached authentication for a user. Call this whenever a
+    user is disabled, deleted or otherwise changed in a way that affects
+    whether its tokens may be used."""
+    key = _generation_key(user_id)
+    try:
+        auth_cache.incr(key)
+    except ValueError:
+        # Kept for good, if it expired the entries cached before it would be valid again
+        auth_cache.set(key, 1, timeout=None)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that keeps the authenticated user (with its account
+    already loaded) in the `auth` cache, keyed by the token's jti.
+
+    Entries are stored with the user's cache generation at the time they were
+    loaded; invalidate_cached_user() bumps the generation so every entry for
+    that user is ignored from then on.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        jti = validated_token.get(api_settings.JTI_CLAIM)
+        if jti is None:
+            return self.load_user(user_id)
+
+        token_key = _token_key(jti)
+        generation_key = _generation_key(user_id)
+        cached = auth_cache.get_many([token_key, generation_key])
+        generation = cached.get(generation_key, 0)
+
+        if token_key in cached:
+            cached_generation, user = cached[token_key]
+            if cached_generation == generation:
+                return user
+
+        user = self.load_user(user_id)
+
+        # Never keep a user around for longer than the token is valid
+        timeout = AUTH_CACHE_TTL
+        if "exp" in validated_token:
+            timeout = max(min(timeout, int(validated_token["exp"] - time.time())), 0)
+        if timeout:
+            auth_cache.set(token_key, (generation, user), timeout=timeout)
+
+        return user
+
+
+    def load_user(self, user_id:str) -> User:
+        try:
+            user = User.objects.select_related("account").get(**{api_settings.USER_ID_FIELD: user_id})
+        except User.DoesNotExist:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+
+        if not api_settings.USER_AUTHENTICATION_RULE(user):
+            raise AuthenticationFailed(_('User is not allowed to use the API'), code='user_not_allowed')
+
+        return user
@@ -1,3 +1,42 @@
 from django.test import TestCase
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.tokens import AccessToken
+from .authentication import CachedJWTAuthentication, auth_cache, invalidate_cached_user
+from .models import Account, User
 
 # Create your tests here.
+class TestCachedJWTAuthentication(TestCase):
+
+    def setUp(self):
+        auth_cache.clear()
+        account = Account(name="test")
+        account.generate_id()
+        account.save()
+
+        self.access_key = User(account=account, type=User.Type.ACCESS_KEY)
+        self.access_key.generate_id()
+        self.access_key.username = self.access_key.user_id
+        self.access_key.save()
+
+        self.auth = CachedJWTAuthentication()
+        self.token = AccessToken.for_user(self.access_key)
+
+
+    def test_user_is_cached_per_token(self):
+        user = self.auth.get_user(self.token)
+        self.assertEqual(user.user_id, self.access_key.user_id)
+
+        with self.assertNumQueries(0):
+            user = self.auth.get_user(self.token)
+            self.assertEqual(user.account.account_id, self.access_key.account_id)
+
+
+    def test_disabled_user_is_rejected_after_invalidation(self):
+        self.auth.get_user(self.token)
+
+        self.access_key.is_active = False
+        self.access_key.save()
+        invalidate_cached_user(self.access_key.user_id)
+
+        with self.assertRaises(AuthenticationFailed):
+            self.auth.get_user(self.token)
@@ -3,6 +3,7 @@ from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from api.api_view import HelperView
+from .authentication import invalidate_cached_user
 from .models import User
 from .serializer import UserSerializer, UserAccessKeySerializer
 
@@ -188,6 +189,7 @@ class ModifyUser(HelperView, APIView):
 
         access_key.is_active = is_active
         access_key.save()
+        invalidate_cached_user(access_key.user_id)
 
 
     def delete_access_key(self, request):
@@ -201,4 +203,5 @@ class ModifyUser(HelperView, APIView):
             raise
 
         access_key.delete()
+        invalidate_cached_user(access_key.user_id)
 
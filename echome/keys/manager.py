@@ -1,10 +1,17 @@
+import base64
+import hashlib
+import os
 import sshpubkeys
 import logging
+from typing import Tuple
+from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import serialization as crypto_serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ed25519
 from cryptography.hazmat.backends import default_backend as crypto_default_backend
+from django.conf import settings
+from django.db import connection, transaction
 from identity.models import User
-from .models import UserKey
+from .models import UserKey, PooledKeyPair
 from .exceptions import (
     KeyDoesNotExist,
     KeyNameAlreadyExists,
@@ -13,6 +20,99 @@ from .exceptions import (
 
 logger = logging.getLogger(__name__)
 
+# Number of keypairs of each type kept ready in the pool, and the size the
+# pool is allowed to drop to before a refill is queued.
+KEYPAIR_POOL_SIZE = int(os.getenv("KEYPAIR_POOL_SIZE", "20"))
+KEYPAIR_POOL_LOW_WATERMARK = int(os.getenv("KEYPAIR_POOL_LOW_WATERMARK", "5"))
+
+
+def generate_keypair(key_type:str = PooledKeyPair.KeyType.RSA) -> Tuple[str, str]:
+    """Generate a new SSH keypair. Returns the (public key, private key) in OpenSSH format."""
+    if key_type == PooledKeyPair.KeyType.ED25519:
+        key = ed25519.Ed25519PrivateKey.generate()
+        # Ed25519 keys can only be written in the OpenSSH private key format
+        private_format = crypto_serialization.PrivateFormat.OpenSSH
+    else:
+        key = rsa.generate_private_key(
+            backend=crypto_default_backend(), 
+            public_exponent=65537, 
+            key_size=2048
+        )
+        private_format = crypto_serialization.PrivateFormat.TraditionalOpenSSL
+
+    private_key = key.private_bytes(
+        crypto_serialization.Encoding.PEM, 
+        private_format, 
+        crypto_serialization.NoEncryption()
+    ).decode("utf-8")
+    public_key = key.public_key().public_bytes(
+        crypto_serialization.Encoding.OpenSSH, 
+        crypto_serialization.PublicFormat.OpenSSH
+    ).decode("utf-8")
+
+    return public_key, private_key
+
+
+class KeyPairPool:
+    """Pool of pre-generated keypairs so that creating a key in a request doesn't
+    have to pay for key generation. Private keys are stored encrypted and
+    are removed from the pool when taken."""
+
+    def __init__(self) -> None:
+        secret = hashlib.sha256(settings.SECRET_KEY.encode("utf-8")).digest()
+        self.fernet = Fernet(base64.urlsafe_b64encode(secret))
+
+
+    def take(self, key_type:str) -> Tuple[str, str]:
+        """Take a keypair out of the pool, generating one on the spot if the pool is
+        empty. Queues a refill when the pool is running low. Call it in the transaction
+        that stores the key, so the keypair goes back to the pool if that fails."""
+        with transaction.atomic():
+            pooled = PooledKeyPair.objects.select_for_update(skip_locked=True) \
+                .filter(key_type=key_type).order_by("id").first()
+            if pooled:
+                pooled.delete()
+
+        if self.needs_refill(key_type):
+            from .tasks import task_refill_keypair_pool
+            transaction.on_commit(lambda: task_refill_keypair_pool.delay(key_type))
+
+        if pooled is None:
+            logger.debug(f"Keypair pool for {key_type} is empty, generating key in request")
+            return generate_keypair(key_type)
+
+        private_key = self.fernet.decrypt(bytes(pooled.encrypted_private_key)).decode("utf-8")
+        return pooled.public_key, private_key
+
+
+    def needs_refill(self, key_type:str) -> bool:
+        return PooledKeyPair.objects.filter(key_type=key_type).count() < KEYPAIR_POOL_LOW_WATERMARK
+
+
+    def refill(self, key_type:str) -> int:
+        """Generate keypairs until the pool is back to KEYPAIR_POOL_SIZE. Returns the
+        number of keypairs added."""
+        with transaction.atomic():
+            # Every take while the pool is low queues a refill. Refills wait for the 
+            # one in progress so they count the keypairs it added and don't overfill it.
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [f"keypair-pool:{key_type}"])
+
+            missing = KEYPAIR_POOL_SIZE - PooledKeyPair.objects.filter(key_type=key_type).count()
+            pooled = []
+            for _ in range(max(missing, 0)):
+                public_key, private_key = generate_keypair(key_type)
+                pooled.append(PooledKeyPair(
+                    key_type=key_type,
+                    public_key=public_key,
+                    encrypted_private_key=self.fernet.encrypt(private_key.encode("utf-8")),
+                ))
+
+            PooledKeyPair.objects.bulk_create(pooled)
+        logger.debug(f"Added {len(pooled)} {key_type} keypairs to the pool")
+        return len(pooled)
+
+
 class UserKeyManager:
 
     user_key_db:UserKey = None
@@ -28,36 +128,26 @@ class UserKeyManager:
                 raise KeyDoesNotExist
 
 
-    def generate_sshkey(self, user:User, key_name:str, service_key=False):
+    def generate_sshkey(self, user:User, key_name:str, service_key=False, key_type:str = PooledKeyPair.KeyType.RSA):
         """
         Generate an SSH key to save in the database.
         The private key is returned and not saved in the database.
+        Keys are taken from the pre-generated KeyPairPool when available.
         """
-        key = rsa.generate_private_key(
-            backend=crypto_default_backend(), 
-            public_exponent=65537, 
-            key_size=2048
-        )
-        private_key = key.private_bytes(
-            crypto_serialization.Encoding.PEM, 
-            crypto_serialization.PrivateFormat.TraditionalOpenSSL, 
-            crypto_serialization.NoEncryption()
-        ).decode("utf-8")
-        public_key = key.public_key().public_bytes(
-            crypto_serialization.Encoding.OpenSSH, 
-            crypto_serialization.PublicFormat.OpenSSH
-        ).decode("utf-8")
-
-        self.name = key_name
-        self.public_key = public_key
-        self.service_key = service_key
+        # A pooled keypair is only used up if the key can be stored
+        with transaction.atomic():
+            public_key, private_key = KeyPairPool().take(key_type)
 
-        try:
-            key_obj = self.store_key(user, key_name, public_key)
-        except KeyNameAlreadyExists:
-            raise
-        except PublicKeyAlreadyExists:
-            raise
+            self.name = key_name
+            self.public_key = public_key
+            self.service_key = service_key
+
+            try:
+                key_obj = self.store_key(user, key_name, public_key)
+            except KeyNameAlreadyExists:
+                raise
+            except PublicKeyAlreadyExists:
+                raise
 
         return key_obj, private_key
     
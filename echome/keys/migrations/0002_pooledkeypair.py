@@ -0,0 +1,23 @@
+# Generated by Django 4.0.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keys', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PooledKeyPair',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key_type', models.CharField(choices=[('rsa', 'RSA'), ('ed25519', 'Ed25519')], db_index=True, max_length=10)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('public_key', models.TextField()),
+                ('encrypted_private_key', models.BinaryField()),
+            ],
+        ),
+    ]
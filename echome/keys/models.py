@@ -26,3 +26,25 @@ class UserKey(models.Model):
     def __str__(self) -> str:
         return self.key_id
 
+
+
+class PooledKeyPair(models.Model):
+    """A pre-generated SSH keypair waiting to be handed out by CreateKeys.
+    The private key is encrypted with a key derived from the Django SECRET_KEY
+    and the row is deleted as soon as it's taken from the pool."""
+
+    class KeyType(models.TextChoices):
+        RSA = 'rsa', 'RSA'
+        ED25519 = 'ed25519', 'Ed25519'
+
+    key_type = models.CharField(
+        max_length=10,
+        choices=KeyType.choices,
+        db_index=True,
+    )
+    created = models.DateTimeField(auto_now_add=True, null=False)
+    public_key = models.TextField()
+    encrypted_private_key = models.BinaryField()
+
+    def __str__(self) -> str:
+        return f"{self.key_type}-{self.pk}"
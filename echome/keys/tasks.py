@@ -0,0 +1,11 @@
+import logging
+from celery import shared_task
+from .manager import KeyPairPool
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def task_refill_keypair_pool(key_type:str):
+    logger.debug(f"Received async task to refill the {key_type} keypair pool")
+    KeyPairPool().refill(key_type)
@@ -1,3 +1,45 @@
 from django.test import TestCase
+from unittest import mock
+from identity.models import Account, User
+from .exceptions import KeyNameAlreadyExists
+from .manager import KeyPairPool, UserKeyManager, generate_keypair
+from .models import PooledKeyPair
 
 # Create your tests here.
+class TestKeyPairPool(TestCase):
+
+    def test_generate_ed25519_keypair(self):
+        public_key, private_key = generate_keypair(PooledKeyPair.KeyType.ED25519)
+        self.assertTrue(public_key.startswith("ssh-ed25519 "))
+        self.assertIn("BEGIN OPENSSH PRIVATE KEY", private_key)
+
+
+    @mock.patch("keys.tasks.task_refill_keypair_pool.delay")
+    def test_take_returns_pooled_keypair(self, refill):
+        pool = KeyPairPool()
+        pool.refill(PooledKeyPair.KeyType.ED25519)
+        pooled = PooledKeyPair.objects.filter(key_type=PooledKeyPair.KeyType.ED25519).order_by("id").first()
+
+        public_key, private_key = pool.take(PooledKeyPair.KeyType.ED25519)
+
+        self.assertEqual(public_key, pooled.public_key)
+        self.assertIn("BEGIN OPENSSH PRIVATE KEY", private_key)
+        self.assertFalse(PooledKeyPair.objects.filter(pk=pooled.pk).exists())
+
+
+    @mock.patch("keys.tasks.task_refill_keypair_pool.delay")
+    def test_keypair_is_kept_when_key_cant_be_stored(self, refill):
+        account = Account(name="test")
+        account.generate_id()
+        account.save()
+        user = User(account=account, username="test")
+        user.generate_id()
+        user.save()
+
+        KeyPairPool().refill(PooledKeyPair.KeyType.ED25519)
+        UserKeyManager().generate_sshkey(user, "key", key_type=PooledKeyPair.KeyType.ED25519)
+        pooled = PooledKeyPair.objects.filter(key_type=PooledKeyPair.KeyType.ED25519).count()
+
+        with self.assertRaises(KeyNameAlreadyExists):
+            UserKeyManager().generate_sshkey(user, "key", key_type=PooledKeyPair.KeyType.ED25519)
+        self.assertEqual(PooledKeyPair.objects.filter(key_type=PooledKeyPair.KeyType.ED25519).count(), pooled)
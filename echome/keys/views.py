@@ -3,7 +3,7 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework import status
 from api.api_view import HelperView
-from .models import UserKey
+from .models import UserKey, PooledKeyPair
 from .manager import UserKeyManager
 from .serializers import UserKeySerializer
 from .exceptions import KeyDoesNotExist, KeyNameAlreadyExists, PublicKeyAlreadyExists
@@ -22,8 +22,19 @@ class CreateKeys(HelperView, APIView):
             return self.missing_parameter_response(missing_params)
         
         if request.POST["Action"] == "new":
+            key_type = request.POST.get("KeyType", PooledKeyPair.KeyType.RSA).lower()
+            if key_type not in PooledKeyPair.KeyType.values:
+                return self.error_response(
+                    f"Unknown KeyType. Must be one of: {', '.join(PooledKeyPair.KeyType.values)}",
+                    status = status.HTTP_400_BAD_REQUEST
+                )
+
             try:
-                new_key, private_key = UserKeyManager().generate_sshkey(request.user, request.POST["KeyName"])
+                new_key, private_key = UserKeyManager().generate_sshkey(
+                    request.user, 
+                    request.POST["KeyName"], 
+                    key_type=key_type
+                )
             except KeyNameAlreadyExists:
                 return self.error_response(
                     "Key (KeyName) with that name already exists.",
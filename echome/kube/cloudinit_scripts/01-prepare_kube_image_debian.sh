@@ -5,6 +5,11 @@ echo "[>] Starting Kubernetes image preparation!"
 
 echo "[*] Preparing variables.."
 
+# Download packages through the build host's apt cache if one was given
+if [ -f /root/apt_proxy ]; then
+    echo "Acquire::http::Proxy \"$(cat /root/apt_proxy)\";" > /etc/apt/apt.conf.d/01proxy
+fi
+
 apt update && apt upgrade -y
 apt install curl jq -y
 
@@ -14,6 +19,7 @@ echome_token=$(jq -r '.auth_token' < $server_file )
 
 function cleanup() {
     echo "[*] Deleting files"
+    rm -f /etc/apt/apt.conf.d/01proxy
     find /root/ -maxdepth 1 -not -path '*/.*' -type f -print -delete
 }
 
@@ -0,0 +1,66 @@
+import time
+from api.management_command import ManagementCommand
+from identity.models import User
+from kube.manager import KubeClusterManager
+from kube.models import KubeImageBuild
+from kube.tasks import launch_image_builds
+
+FINISHED = [KubeImageBuild.Status.READY, KubeImageBuild.Status.FAILED]
+
+class Command(ManagementCommand):
+    help = 'Build Kubernetes base images for several Kubernetes versions in parallel.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', required=True, help='User ID the images are built as')
+        parser.add_argument('--base-image', required=True, help='Image ID the Kubernetes images are built from')
+        parser.add_argument('--network', required=True, help='Network profile the build virtual machines are launched in')
+        parser.add_argument('--versions', 
+            help='Comma separated Kubernetes versions, e.g. 1.21,1.22. Defaults to every version there is already an image for')
+        parser.add_argument('--key-name', help='SSH key added to the build virtual machines for debugging')
+        parser.add_argument('--wait', action='store_true', help='Wait for the builds to finish and print how long each stage took')
+
+
+    def handle(self, *args, **options):
+        manager = KubeClusterManager()
+        if options['versions']:
+            versions = [v.strip() for v in options['versions'].split(',') if v.strip()]
+        else:
+            versions = manager.prepared_kubernetes_versions()
+
+        if not versions:
+            self.stderr.write('Error: No Kubernetes versions to build.')
+            return
+
+        try:
+            user = User.objects.get(user_id=options['user'])
+            builds = manager.build_kubernetes_images(
+                user,
+                base_image = options['base_image'],
+                network_profile = options['network'],
+                kubernetes_versions = versions,
+                key_name = options['key_name'],
+            )
+            launch_image_builds(builds, user, options['network'], options['key_name'])
+        except Exception as e:
+            self.stdout.write(str(e))
+            self.stderr.write('Error: There was an error while attempting to queue the Kubernetes image builds.')
+            return
+
+        for build in builds:
+            self.stdout.write(f'{build.build_id}: Kubernetes {build.kubernetes_version}')
+        self.stdout.write(self.style.SUCCESS(f'Queued {len(builds)} Kubernetes image builds'))
+
+        if not options['wait']:
+            return
+
+        build_ids = [build.build_id for build in builds]
+        while KubeImageBuild.objects.filter(build_id__in=build_ids).exclude(status__in=FINISHED).exists():
+            time.sleep(10)
+
+        for build in KubeImageBuild.objects.filter(build_id__in=build_ids).order_by("kubernetes_version"):
+            stages = ", ".join(f"{stage} {seconds}s" for stage, seconds in build.stages.items())
+            line = f'{build.kubernetes_version} {build.status} {build.image_id or ""} ({stages})'
+            if build.status == KubeImageBuild.Status.READY:
+                self.stdout.write(self.style.SUCCESS(line))
+            else:
+                self.stdout.write(self.style.ERROR(f'{line}: {build.error}'))
@@ -0,0 +1,32 @@
+from api.management_command import ManagementCommand
+from identity.models import User
+from kube.manager import KubeClusterManager
+from vmmanager.instance_definitions import InstanceDefinition
+
+class Command(ManagementCommand):
+    help = 'Configure a warm pool of Kubernetes node virtual machines for a Kubernetes version and instance type.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', required=True, help='User ID the node virtual machines are created as')
+        parser.add_argument('--version', required=True, help='Kubernetes version, e.g. 1.22')
+        parser.add_argument('--instance-type', required=True, help='Instance type of the nodes, e.g. standard.medium')
+        parser.add_argument('--network', required=True, help='Network profile the nodes are launched in')
+        parser.add_argument('--disk-size', default='30G', help='Disk size of the nodes')
+        parser.add_argument('--size', type=int, default=1, help='Number of nodes to keep ready. 0 stops refilling the pool')
+
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(user_id=options['user'])
+            pool = KubeClusterManager().configure_warm_pool(
+                user,
+                kubernetes_version = options['version'],
+                instance_def = InstanceDefinition(options['instance_type']),
+                network_profile = options['network'],
+                disk_size = options['disk_size'],
+                size = options['size'],
+            )
+            self.stdout.write(self.style.SUCCESS(f'Configured warm pool {pool.pool_id} with {pool.size} nodes'))
+        except Exception as e:
+            self.stdout.write(str(e))
+            self.stderr.write('Error: There was an error while attempting to configure the warm pool.')
@@ -1,26 +1,32 @@
 import json
 import logging
+import os
 import re
 import secrets
 import string
 import time
 import yaml
+from typing import List
 from django.apps import apps
 from django.urls import reverse
+from django.utils import timezone
+from api.events import publish_event
 from echome.config import ecHomeConfig
 from identity.models import User
 from identity.manager import ServiceAccount
-from vault.vault import Vault
+from vault.vault import Vault, AsyncVault
 from vault.exceptions import SecretDoesNotExistError
 from network.manager import VirtualNetworkManager
 from keys.manager import UserKeyManager
 from vmmanager.exceptions import VirtualMachineDoesNotExist
 from vmmanager.instance_definitions import InstanceDefinition
 from vmmanager.vm_manager import VmManager
+from vmmanager.host_image_cache import choose_host
 from vmmanager.tasks import task_terminate_instance
+from vmmanager.warm_pool import WarmPoolManager
 from vmmanager.cloudinit import CloudInitFile
 from vmmanager.models import VirtualMachine, Image
-from .models import KubeCluster
+from .models import KubeCluster, KubeNode, KubeImageBuild
 from .exceptions import (
     ClusterConfigurationError, 
     ClusterDoesNotExist, 
@@ -32,6 +38,10 @@ from .kubeadm_config import KubeadmInitConfig, KubeadmJoinConfig, KubeadmCluster
 
 logger = logging.getLogger(__name__)
 
+# apt proxy (e.g. the apt-cacher-ng service, http://<host>:3142) image builds
+# download packages through, so parallel builds only fetch each package once.
+KUBE_IMAGE_APT_PROXY = os.getenv("KUBE_IMAGE_APT_PROXY", "")
+
 class KubeClusterManager:
 
     cluster_db: KubeCluster = None
@@ -63,15 +73,20 @@ class KubeClusterManager:
     def delete_cluster_db(self):
         pass
 
+    def _publish_status(self):
+        publish_event(self.cluster_db.account_id, "kube", self.cluster_db.cluster_id, self.cluster_db.status)
+
     def set_cluster_as_failed(self):
         logger.debug("Setting cluster status as FAILED")
         self.cluster_db.status = KubeCluster.Status.FAILED
         self.cluster_db.save()
+        self._publish_status()
     
     def set_cluster_as_ready(self):
         logger.debug("Setting cluster status as READY")
         self.cluster_db.status = KubeCluster.Status.READY
         self.cluster_db.save()
+        self._publish_status()
     
 
     def get_cluster_config(self, user:User):
@@ -88,6 +103,22 @@ class KubeClusterManager:
             raise ClusterGetConfigurationError("Could not retrieve config for specified cluster.")
         
         return conf
+
+
+    async def aget_cluster_config(self, user:User):
+        """Async version of get_cluster_config() for use in async views."""
+        vault = AsyncVault()
+        try:
+            conf = await vault.get_secret(
+                self.vault_mount_point, 
+                f"{user.account_id}/{self.cluster_db.cluster_id}"
+            )
+            conf = conf["data"]["data"]["admin.conf"]
+        except Exception:
+            logger.debug(f"Could not extract config from Vault for {self.cluster_db.cluster_id}/admin")
+            raise ClusterGetConfigurationError("Could not retrieve config for specified cluster.")
+        
+        return conf
     
 
     def set_cluster_secrets(self, user:User, details:dict):
@@ -155,6 +186,7 @@ class KubeClusterManager:
         self.cluster_db.primary = None
         self.cluster_db.status = KubeCluster.Status.TERMINATED
         self.cluster_db.delete()
+        self._publish_status()
 
         return True
     
@@ -224,6 +256,23 @@ class KubeClusterManager:
 
         if self.cluster_db is None:
             raise ClusterConfigurationError("cluster_db is not set!")
+
+        # An earlier attempt got as far as launching the controller. One that didn't finish
+        # launching is terminated, so its ControllerIp is free for the new one.
+        if self.cluster_db.primary is None:
+            controllers = VirtualMachine.objects.filter(
+                tags__cluster_id=self.cluster_db.cluster_id, tags__controller=True,
+            ).exclude(state=VirtualMachine.State.TERMINATED)
+            for controller in controllers:
+                if controller.state == VirtualMachine.State.AVAILABLE and self.cluster_db.primary is None:
+                    self.cluster_db.primary = controller
+                    continue
+                logger.debug(f"Terminating controller {controller.instance_id} ({controller.state}) left by an earlier attempt")
+                VmManager().terminate_instance(controller.instance_id, user)
+        if self.cluster_db.primary is not None:
+            logger.debug(f"Controller {self.cluster_db.primary.instance_id} was already created")
+            self.cluster_db.save()
+            return self.cluster_db.cluster_id
         
         kube_image = self._find_image_for_kubernetes(kubernetes_version)
         logger.debug(f"Using image: {kube_image}")
@@ -401,23 +450,135 @@ class KubeClusterManager:
         # Merge tags with instance_tags taking precedence
         instance_tags = {**tags, **instance_tags}
 
+        launch_config = {
+            "NetworkProfile": network_profile,
+            "PrivateIp": node_ip,
+            "KeyName": key_name,
+            "Tags": instance_tags,
+            "Files": files,
+            "RunCommands": [sh_script_path],
+        }
+
+        # create_vm() launches from a warm pool for this image if there is one,
+        # the join config is written to its cloud-init ISO when it's launched.
         vm_manager = VmManager()
         vm_id = vm_manager.create_vm(
             user, 
             instance_def=instance_def, 
-            NetworkProfile = network_profile,
             ImageId = kube_image.image_id,
             DiskSize = disk_size,
-            PrivateIp = node_ip,
-            KeyName = key_name,
-            Tags = instance_tags,
-            Files = files,
-            RunCommands = [sh_script_path]
+            **launch_config
         )
 
         return vm_id
 
 
+    def configure_warm_pool(self, user:User, kubernetes_version:str, instance_def:InstanceDefinition, 
+            network_profile:str, disk_size:str = "30G", size:int = 1):
+        """Keep `size` nodes ready to launch from the prepared image for this Kubernetes version.
+        Nodes added with the same instance type, network and disk size will use them."""
+        kube_image = self._find_image_for_kubernetes(kubernetes_version)
+        manager = WarmPoolManager()
+        pool = manager.create_pool(
+            user,
+            image_id = kube_image.image_id,
+            instance_def = instance_def,
+            network_profile = network_profile,
+            disk_size = disk_size,
+            size = size,
+            tags = {"ecHome_kubernetes__version": kubernetes_version},
+        )
+        manager.queue_fill(pool.pool_id, choose_host())
+        return pool
+
+
+    def validate_nodes(self, user:User, instance_def:str, network_profile:str, node_ips:list, image_id:str = None):
+        """Check that a batch of nodes can be launched before any of them are queued."""
+        if image_id:
+            self._verify_image_for_kubernetes(image_id)
+
+        try:
+            InstanceDefinition(instance_def)
+            network = VirtualNetworkManager(network_profile, user)
+        except Exception as e:
+            logger.exception(e)
+            raise ClusterConfigurationError("Provided InstanceType or NetworkProfile is not valid.")
+
+        ips = [ip for ip in node_ips if ip]
+        if len(ips) != len(set(ips)):
+            raise ClusterConfigurationError("Node IPs must be unique.")
+
+        for ip in ips:
+            try:
+                valid = network.validate_ip(ip)
+            except ValueError:
+                valid = False
+            if not valid:
+                raise ClusterConfigurationError(f"{ip} is not a valid address for {network_profile}.")
+
+
+    def prepare_nodes(self, user:User, instance_def:str, network_profile:str, node_ips:list, 
+        disk_size:str, key_name:str = None, image_id:str = None, tags:dict = None) -> List[KubeNode]:
+        """Create a PENDING node for every entry in `node_ips` (None lets the network assign
+        the address). The nodes are built by tasks.launch_nodes()."""
+        nodes = []
+        for node_ip in node_ips:
+            node = KubeNode(
+                cluster = self.cluster_db,
+                spec = {
+                    "user_id": user.user_id,
+                    "instance_def": instance_def,
+                    "network_profile": network_profile,
+                    "node_ip": node_ip,
+                    "disk_size": disk_size,
+                    "key_name": key_name,
+                    "image_id": image_id,
+                    "tags": tags if tags else {},
+                }
+            )
+            node.generate_id()
+            nodes.append(node)
+
+        KubeNode.objects.bulk_create(nodes)
+        return nodes
+
+
+    def get_pending_nodes(self) -> List[KubeNode]:
+        return list(self.cluster_db.nodes.filter(state=KubeNode.State.PENDING))
+
+
+    def build_node(self, user:User, node:KubeNode):
+        """Launch the instance for a node. The node is JOINING once the instance is up
+        and is marked READY by NodeAddAdminKubeCluster when kubeadm join completes."""
+        self.set_node_state(node, KubeNode.State.BUILDING)
+        spec = node.spec
+        try:
+            vm_id = self.add_node_to_cluster(
+                user,
+                InstanceDefinition(spec["instance_def"]),
+                node_ip = spec["node_ip"],
+                network_profile = spec["network_profile"],
+                disk_size = spec["disk_size"],
+                key_name = spec["key_name"],
+                image_id = spec["image_id"],
+                tags = spec["tags"],
+            )
+        except Exception as e:
+            self.set_node_state(node, KubeNode.State.FAILED, error=str(e))
+            raise
+
+        node.instance_id = vm_id
+        self.set_node_state(node, KubeNode.State.JOINING)
+
+
+    def set_node_state(self, node:KubeNode, state:str, error:str = None):
+        logger.debug(f"Setting node {node.node_id} state as {state}")
+        node.state = state
+        node.error = error
+        node.save()
+        publish_event(self.cluster_db.account_id, "kube-node", node.node_id, state, cluster_id=self.cluster_db.cluster_id)
+
+
     def generate_kubeadm_token(self):
         """Generates a Kubeadm token used to authenticate requests between Nodes and controllers
         (i think?)"""
@@ -438,12 +599,18 @@ class KubeClusterManager:
         images = Image.objects.filter(
             tags__has_key='ecHome_kubernetes__image', 
             tags__contains={'ecHome_kubernetes__version': kubernetes_version}
-        )
+        ).order_by("-created")
         if not images:
             raise ClusterConfigurationError("No prepared images exist for this Kubernetes version.")
         
         return images[0]
     
+    def prepared_kubernetes_versions(self) -> List[str]:
+        """Kubernetes versions there are prepared images for."""
+        images = Image.objects.filter(tags__has_key='ecHome_kubernetes__image').values_list("tags", flat=True)
+        versions = set(tags.get('ecHome_kubernetes__version') for tags in images) - {None, ""}
+        return sorted(versions, key=lambda v: [int(p) for p in v.split(".")])
+    
     def _verify_image_for_kubernetes(self, image_id:str):
         images = Image.objects.filter(
             image_id = image_id,
@@ -463,10 +630,43 @@ class KubeClusterManager:
         return True if pattern.match(kubernetes_version) else False
 
     
-    def generate_kubernetes_image(self, user:User, base_image:str, network_profile:str, kubernetes_version:str, key_name:str = None):
+    def build_kubernetes_images(self, user:User, base_image:str, network_profile:str, 
+            kubernetes_versions:List[str], key_name:str = None) -> List[KubeImageBuild]:
+        """Queue a Kubernetes image build for each version. Start them with
+        tasks.launch_image_builds()."""
+        for kubernetes_version in kubernetes_versions:
+            if not self.kubernetes_version_is_valid(kubernetes_version):
+                raise ClusterConfigurationError(f"Kubernetes version {kubernetes_version} is not valid")
+        
+        builds = []
+        for kubernetes_version in dict.fromkeys(kubernetes_versions):
+            build = KubeImageBuild(
+                account = user.account,
+                kubernetes_version = kubernetes_version,
+                base_image_id = base_image,
+            )
+            build.generate_id()
+            build.save()
+            builds.append(build)
+
+        return builds
+
+
+    def set_build_failed(self, build:KubeImageBuild, error:str):
+        logger.debug(f"Setting image build {build.build_id} as FAILED")
+        build.status = KubeImageBuild.Status.FAILED
+        build.error = error
+        build.finished = timezone.now()
+        build.save(update_fields=["status", "error", "finished", "stages", "last_modified"])
+
+
+    def generate_kubernetes_image(self, user:User, base_image:str, network_profile:str, kubernetes_version:str, 
+            key_name:str = None, build:KubeImageBuild = None):
         """Creates a Kubernetes base image with kubeadm that will be used to launch clusters and nodes.
         This launches a Virtual Machine. Once the VM is complete, sends a message back to us if it was successful
-        then shuts down to create the base image."""
+        then shuts down to create the base image.
+        
+        If build is given, the virtual machine is recorded on it along with how long it took to launch."""
 
         # TODO: Create a JobToken to authenticate requests where we're waiting for an instance to complete
         # a job.
@@ -507,12 +707,25 @@ class KubeClusterManager:
             content = str(kubernetes_version)
         ))
 
+        if KUBE_IMAGE_APT_PROXY:
+            files.append(CloudInitFile(
+                path = "/root/apt_proxy",
+                content = KUBE_IMAGE_APT_PROXY
+            ))
+
         tags = {
             "echome_managed": True, 
             "ephemeral": True, 
             "kubernetes_version": kubernetes_version
         }
 
+        if build:
+            build.status = KubeImageBuild.Status.BUILDING
+            build.started = timezone.now()
+            build.save()
+            tags["kubernetes_image_build"] = build.build_id
+
+        started = time.monotonic()
         vm_manager = VmManager()
         vm_id = vm_manager.create_vm(
             user, 
@@ -526,6 +739,27 @@ class KubeClusterManager:
             RunCommands = ["/root/init_prepare_kubernetes.sh"]
         )
 
+        if build:
+            build.instance_id = vm_id
+            build.stages = {"launch": round(time.monotonic() - started, 2)}
+            build.save()
+        
+        return vm_id
+
+
+    def get_image_build_for_instance(self, instance_id:str):
+        """Returns the image build that launched this virtual machine or None if it wasn't
+        launched by one (e.g. generate_kubernetes_image() was called directly)"""
+        return KubeImageBuild.objects.filter(instance_id=instance_id).first()
+
+
+    def set_build_provisioned(self, build:KubeImageBuild):
+        """The build's virtual machine finished installing Kubernetes; record how long it took."""
+        elapsed = (timezone.now() - build.started).total_seconds()
+        build.stages["provision"] = round(elapsed - build.stages.get("launch", 0), 2)
+        build.status = KubeImageBuild.Status.REGISTERING
+        build.save()
+
 
     def register_kubernetes_image(self, user:User, instance_id:str):
         """Registers a Virtual Machine Image (vmi) for Kubernetes created by the generate_kubernetes_image function.
@@ -545,6 +779,7 @@ class KubeClusterManager:
         image_name = vm_db.image_metadata['image_name']
         image_id = vm_db.image_metadata['image_id']
         kube_ver = vm_db.tags['kubernetes_version']
+        build = self.get_image_build_for_instance(instance_id)
 
         build_time = str(int(time.time()))
 
@@ -555,6 +790,7 @@ class KubeClusterManager:
             "echome_kubernetes__build_date": build_time
         }
 
+        stage_times = {}
         try:
             vmi = vm_manager.create_virtual_machine_image(
                 vm_id = instance_id,
@@ -562,9 +798,24 @@ class KubeClusterManager:
                 name = f"kubernetes-image-{kube_ver}",
                 description = f"ecHome-Kubernetes base image from {image_name} ({image_id}) - {build_time}",
                 tags = vmi_tags,
-                terminate_after_creation = True
+                terminate_after_creation = True,
+                stage_times = stage_times,
             )
         except Exception as e:
             logger.exception(e)
+            if build:
+                build.stages.update(stage_times)
+                self.set_build_failed(build, str(e))
             raise
 
+        if build:
+            # The instance was terminated along with its row, don't write it back
+            build.stages.update(stage_times)
+            build.image_id = vmi["vmi_id"]
+            build.status = KubeImageBuild.Status.READY
+            build.finished = timezone.now()
+            build.save(update_fields=["stages", "image_id", "status", "finished", "last_modified"])
+            logger.debug(f"Image build {build.build_id} complete: {build.stages}")
+
+        return vmi
+
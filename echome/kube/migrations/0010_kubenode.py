@@ -0,0 +1,29 @@
+# Generated by Django 4.0.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0017_alter_image_state'),
+        ('kube', '0009_kubecluster_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KubeNode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('node_id', models.CharField(db_index=True, max_length=20, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+                ('state', models.CharField(choices=[('PENDING', 'Pending'), ('BUILDING', 'Building'), ('JOINING', 'Joining'), ('READY', 'Ready'), ('FAILED', 'Failed')], default='PENDING', max_length=20)),
+                ('spec', models.JSONField(default=dict)),
+                ('error', models.TextField(null=True)),
+                ('cluster', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='nodes', to='kube.kubecluster', to_field='cluster_id')),
+                ('instance', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='vmmanager.virtualmachine', to_field='instance_id')),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.0.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0001_initial'),
+        ('vmmanager', '0019_warmpool_ttl'),
+        ('kube', '0010_kubenode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KubeImageBuild',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('build_id', models.CharField(db_index=True, max_length=20, unique=True)),
+                ('kubernetes_version', models.CharField(max_length=8)),
+                ('base_image_id', models.CharField(max_length=20)),
+                ('image_id', models.CharField(max_length=20, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+                ('status', models.CharField(choices=[('QUEUED', 'Queued'), ('BUILDING', 'Building'), ('REGISTERING', 'Registering'), ('READY', 'Ready'), ('FAILED', 'Failed')], default='QUEUED', max_length=20)),
+                ('stages', models.JSONField(default=dict)),
+                ('error', models.TextField(null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='identity.account', to_field='account_id')),
+                ('instance', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='vmmanager.virtualmachine', to_field='instance_id')),
+            ],
+        ),
+    ]
@@ -50,3 +50,90 @@ class KubeCluster(models.Model):
             self.cluster_id = IdGenerator.generate("kube")
         else:
             raise AttemptedOverrideOfImmutableIdException
+
+
+class KubeNode(models.Model):
+    """A worker node being added to (or part of) a cluster. Tracks the node from the
+    request to add it until it has joined the cluster."""
+    node_id = models.CharField(max_length=20, unique=True, db_index=True)
+    cluster = models.ForeignKey(KubeCluster, on_delete=models.CASCADE, to_field="cluster_id", related_name="nodes")
+    instance = models.ForeignKey("vmmanager.VirtualMachine", \
+        on_delete=models.SET_NULL, \
+        to_field="instance_id", \
+        null=True)
+    created = models.DateTimeField(auto_now_add=True, null=False)
+    last_modified = models.DateTimeField(auto_now=True)
+
+    class State(models.TextChoices):
+        PENDING = 'PENDING', 'Pending'
+        BUILDING = 'BUILDING', 'Building'
+        JOINING = 'JOINING', 'Joining'
+        READY = 'READY', 'Ready'
+        FAILED = 'FAILED', 'Failed'
+
+    state = models.CharField(
+        max_length=20,
+        choices=State.choices,
+        default=State.PENDING,
+    )
+
+    # Parameters the node is launched with (InstanceType, NetworkProfile, NodeIp, etc.)
+    spec = models.JSONField(default=dict)
+    # Reason the node failed, if it did
+    error = models.TextField(null=True)
+
+    def generate_id(self):
+        if self.node_id is None or self.node_id == "":
+            self.node_id = IdGenerator.generate("knode")
+        else:
+            raise AttemptedOverrideOfImmutableIdException
+
+    def __str__(self) -> str:
+        return self.node_id
+
+
+class KubeImageBuild(models.Model):
+    """A Kubernetes base image being built for one Kubernetes version. Records how
+    long each stage of the build took so slow stages can be found."""
+    build_id = models.CharField(max_length=20, unique=True, db_index=True)
+    account = models.ForeignKey("identity.Account", on_delete=models.CASCADE, to_field="account_id")
+    kubernetes_version = models.CharField(max_length=8)
+    base_image_id = models.CharField(max_length=20)
+    instance = models.ForeignKey("vmmanager.VirtualMachine", \
+        on_delete=models.SET_NULL, \
+        to_field="instance_id", \
+        null=True)
+    # Image registered by the build once it's complete
+    image_id = models.CharField(max_length=20, null=True)
+    created = models.DateTimeField(auto_now_add=True, null=False)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    last_modified = models.DateTimeField(auto_now=True)
+
+    class Status(models.TextChoices):
+        QUEUED = 'QUEUED', 'Queued'
+        BUILDING = 'BUILDING', 'Building'
+        REGISTERING = 'REGISTERING', 'Registering'
+        READY = 'READY', 'Ready'
+        FAILED = 'FAILED', 'Failed'
+
+    status = models.CharField(
+        max_length=20,
+        choices=Status.choices,
+        default=Status.QUEUED,
+    )
+
+    # Seconds spent in each stage, in the order they ran: launch, provision, then
+    # the stages of creating the image (see VmManager.create_virtual_machine_image)
+    stages = models.JSONField(default=dict)
+    # Reason the build failed, if it did
+    error = models.TextField(null=True)
+
+    def generate_id(self):
+        if self.build_id is None or self.build_id == "":
+            self.build_id = IdGenerator.generate("kbuild")
+        else:
+            raise AttemptedOverrideOfImmutableIdException
+
+    def __str__(self) -> str:
+        return self.build_id
@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from api.serializers import ValuesSerializer
 from .models import KubeCluster
   
 class KubeClusterSerializer(serializers.ModelSerializer):
@@ -6,3 +7,10 @@ class KubeClusterSerializer(serializers.ModelSerializer):
     class Meta:
         model = KubeCluster
         exclude = ['id', 'account']
+
+
+
+class KubeClusterValuesSerializer(ValuesSerializer):
+    # associated_instances is many-to-many and is not included
+    model = KubeCluster
+    exclude = KubeClusterSerializer.Meta.exclude
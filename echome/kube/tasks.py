@@ -1,22 +1,30 @@
 import logging
-from celery import shared_task
+from typing import List
+from celery import shared_task, group
+from celery.result import GroupResult
 from vmmanager.instance_definitions import InstanceDefinition
+from api.idempotency import IdempotentTask
 from identity.models import User
 from .manager import KubeClusterManager
+from .models import KubeNode, KubeImageBuild
 
 logger = logging.getLogger(__name__)
 
 
-@shared_task
-def task_create_cluster(prepared_cluster_id:str, user_id:str, instance_def: str,  
+@shared_task(bind=True, base=IdempotentTask, idempotency_key="create-cluster:{prepared_cluster_id}")
+def task_create_cluster(self, prepared_cluster_id:str, user_id:str, instance_def: str,  
         network_profile:str, controller_ip:str, kubernetes_version:str, key_name:str, disk_size:str):
     logger.debug(f"Received async task to create cluster for: {prepared_cluster_id}")
 
     user = User.objects.get(user_id = user_id)
     manager = KubeClusterManager(cluster_id = prepared_cluster_id)
 
-    try:
-        manager.create_cluster(
+    def failed():
+        manager.set_cluster_as_failed()
+        logger.error("KubeCluster creation process failed")
+
+    with self.on_failure_of(failed):
+        cluster_id = manager.create_cluster(
             user = user,
             instance_def = InstanceDefinition(instance_def),
             controller_ip = controller_ip,
@@ -25,8 +33,70 @@ def task_create_cluster(prepared_cluster_id:str, user_id:str, instance_def: str,
             kubernetes_version = kubernetes_version,
             key_name = key_name,
         )
+    return {"cluster_id": cluster_id}
+
+
+@shared_task
+def task_add_node(node_id:str):
+    logger.debug(f"Received async task to build node: {node_id}")
+
+    node = KubeNode.objects.get(node_id = node_id)
+    user = User.objects.get(user_id = node.spec["user_id"])
+    manager = KubeClusterManager(cluster_id = node.cluster_id)
+
+    try:
+        manager.build_node(user, node)
     except Exception as e:
-        manager.set_cluster_as_failed()
         logger.exception(e)
-        logger.error("KubeCluster creation process failed")
-        
+        logger.error(f"Building node {node_id} failed")
+
+
+def launch_nodes(nodes:List[KubeNode]) -> GroupResult:
+    """Build a batch of prepared nodes in parallel, one task_add_node per node in a
+    single Celery group."""
+    logger.debug(f"Launching {len(nodes)} nodes")
+    return group(task_add_node.s(node.node_id) for node in nodes).apply_async()
+
+
+@shared_task
+def task_build_kube_image(build_id:str, user_id:str, network_profile:str, key_name:str = None):
+    logger.debug(f"Received async task to build Kubernetes image: {build_id}")
+
+    build = KubeImageBuild.objects.get(build_id = build_id)
+    user = User.objects.get(user_id = user_id)
+    manager = KubeClusterManager()
+
+    try:
+        manager.generate_kubernetes_image(
+            user, 
+            base_image = build.base_image_id, 
+            network_profile = network_profile, 
+            kubernetes_version = build.kubernetes_version, 
+            key_name = key_name, 
+            build = build,
+        )
+    except Exception as e:
+        manager.set_build_failed(build, str(e))
+        logger.exception(e)
+        logger.error(f"Kubernetes image build {build_id} failed")
+
+
+@shared_task
+def task_register_kube_image(user_id:str, instance_id:str):
+    logger.debug(f"Received async task to register Kubernetes image from: {instance_id}")
+
+    user = User.objects.get(user_id = user_id)
+    try:
+        KubeClusterManager().register_kubernetes_image(user, instance_id)
+    except Exception as e:
+        logger.exception(e)
+        logger.error(f"Registering Kubernetes image from {instance_id} failed")
+
+
+def launch_image_builds(builds:List[KubeImageBuild], user:User, network_profile:str, key_name:str = None) -> GroupResult:
+    """Build a Kubernetes image for every queued build in parallel, one task_build_kube_image
+    per build in a single Celery group."""
+    logger.debug(f"Launching {len(builds)} Kubernetes image builds")
+    return group(
+        task_build_kube_image.s(build.build_id, user.user_id, network_profile, key_name) for build in builds
+    ).apply_async()
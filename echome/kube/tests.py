@@ -1,3 +1,115 @@
 from django.test import TestCase
+from unittest import mock
+from identity.models import Account, User
+from vmmanager.models import Image, VirtualMachine
+from vmmanager.vm_manager import VmManager
+from .manager import KubeClusterManager
+from .tasks import launch_nodes
+from .exceptions import ClusterConfigurationError
+from .models import KubeCluster, KubeNode, KubeImageBuild
 
 # Create your tests here.
+class TestKubeNodes(TestCase):
+
+    def setUp(self):
+        account = Account(name="test")
+        account.generate_id()
+        account.save()
+        self.user = User(account=account, username="test")
+        self.user.generate_id()
+        self.user.save()
+
+        self.manager = KubeClusterManager()
+        self.manager._prepare_cluster_db(self.user, "test-cluster", "1.22")
+
+
+    @mock.patch("kube.manager.publish_event")
+    def test_prepared_nodes_are_pending_until_built(self, publish_event):
+        nodes = self.manager.prepare_nodes(
+            self.user, 
+            instance_def="standard.medium", 
+            network_profile="home-network", 
+            node_ips=["192.168.0.10", None], 
+            disk_size="30G"
+        )
+        self.assertEqual(len(nodes), 2)
+        self.assertEqual(len(self.manager.get_pending_nodes()), 2)
+
+        with mock.patch.object(KubeClusterManager, "add_node_to_cluster", side_effect=Exception("No image")):
+            with self.assertRaises(Exception):
+                self.manager.build_node(self.user, nodes[0])
+
+        failed = KubeNode.objects.get(node_id=nodes[0].node_id)
+        self.assertEqual(failed.state, KubeNode.State.FAILED)
+        self.assertEqual(failed.error, "No image")
+        self.assertEqual(len(self.manager.get_pending_nodes()), 1)
+
+
+    @mock.patch("kube.manager.publish_event")
+    def test_nodes_are_built_in_parallel(self, publish_event):
+        nodes = self.manager.prepare_nodes(
+            self.user, 
+            instance_def="standard.medium", 
+            network_profile="home-network", 
+            node_ips=["192.168.0.10", "192.168.0.11", None], 
+            disk_size="30G"
+        )
+
+        with mock.patch("kube.tasks.group") as group:
+            launch_nodes(nodes)
+
+        signatures = list(group.call_args.args[0])
+        self.assertEqual([signature.args for signature in signatures], [(node.node_id,) for node in nodes])
+        group.return_value.apply_async.assert_called_once_with()
+
+
+    @mock.patch.object(VmManager, "terminate_instance")
+    def test_controllers_left_by_an_earlier_attempt_are_adopted_or_terminated(self, terminate_instance):
+        controllers = {}
+        for state in (VirtualMachine.State.ERROR, VirtualMachine.State.AVAILABLE):
+            vm = VirtualMachine(account=self.user.account, key_name="", state=state, 
+                tags={"cluster_id": self.manager.cluster_db.cluster_id, "controller": True})
+            vm.generate_id()
+            vm.save()
+            controllers[state] = vm
+
+        cluster_id = self.manager.create_cluster(
+            self.user, None, "192.168.0.2", "home-network", "30G", "1.22")
+
+        self.assertEqual(cluster_id, self.manager.cluster_db.cluster_id)
+        self.assertEqual(self.manager.cluster_db.primary, controllers[VirtualMachine.State.AVAILABLE])
+        terminate_instance.assert_called_once_with(controllers[VirtualMachine.State.ERROR].instance_id, self.user)
+
+
+class TestKubeImageBuilds(TestCase):
+
+    def setUp(self):
+        account = Account(name="test")
+        account.generate_id()
+        account.save()
+        self.user = User(account=account, username="test")
+        self.user.generate_id()
+        self.user.save()
+        self.manager = KubeClusterManager()
+
+
+    def test_one_build_is_queued_per_version(self):
+        builds = self.manager.build_kubernetes_images(
+            self.user, "gmi-00000001", "home-network", ["1.22", "1.23", "1.22"])
+
+        self.assertEqual([build.kubernetes_version for build in builds], ["1.22", "1.23"])
+        self.assertTrue(all(build.status == KubeImageBuild.Status.QUEUED for build in builds))
+
+        with self.assertRaises(ClusterConfigurationError):
+            self.manager.build_kubernetes_images(self.user, "gmi-00000001", "home-network", ["1.24", "latest"])
+        self.assertEqual(KubeImageBuild.objects.count(), 2)
+
+
+    def test_prepared_versions_are_sorted_numerically(self):
+        for i, version in enumerate(["1.22", "1.9", "1.22", "1.10"]):
+            Image(image_id=f"vmi-0000000{i}", image_path="/images/kube.qcow2", tags={
+                "ecHome_kubernetes__image": True,
+                "ecHome_kubernetes__version": version,
+            }).save()
+
+        self.assertEqual(self.manager.prepared_kubernetes_versions(), ["1.9", "1.10", "1.22"])
@@ -3,19 +3,39 @@ import json
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework import status
+from django.db.models import Count, Max
 from api.api_view import HelperView
-from vmmanager.exceptions import VirtualMachineDoesNotExist
+from api.async_view import AsyncAPIView, run_in_db_pool
 from identity.models import User
 from vmmanager.instance_definitions import InstanceDefinition
 from vmmanager.models import VirtualMachine
 from .exceptions import ClusterConfigurationError, ClusterAlreadyExists, ClusterDoesNotExist
-from .models import KubeCluster
+from .models import KubeCluster, KubeNode
 from .manager import KubeClusterManager
-from .tasks import task_create_cluster
-from .serializers import KubeClusterSerializer
+from .tasks import task_create_cluster, task_register_kube_image, launch_nodes
+from .serializers import KubeClusterValuesSerializer
 
 logger = logging.getLogger(__name__)
 
+def unpack_node_ips(view:HelperView, request) -> list:
+    """Returns one entry per requested node from the NodeCount and NodeIps parameters.
+    Entries are the node's IP, or None when only a count was given. Raises ValueError
+    if the two don't agree."""
+    node_ips = view.unpack_comma_separated_list("NodeIps", request.POST) if request.POST.get("NodeIps") else []
+    node_ips = [ip.strip() for ip in node_ips]
+
+    if "NodeCount" not in request.POST:
+        return node_ips
+
+    node_count = int(request.POST["NodeCount"])
+    if node_count < 0:
+        raise ValueError("NodeCount must be a positive number.")
+    if node_ips and len(node_ips) != node_count:
+        raise ValueError("NodeCount does not match the number of NodeIps.")
+
+    return node_ips if node_ips else [None] * node_count
+
+
 class CreateKubeCluster(HelperView, APIView):
     permission_classes = [IsAuthenticated]
 
@@ -30,6 +50,10 @@ class CreateKubeCluster(HelperView, APIView):
             "KubeVersion": "1.22",
             "KeyName": None,
             "DiskSize": "30G",
+            "NodeCount": 0,
+            "NodeIps": None,
+            "NodeInstanceType": None,
+            "NodeDiskSize": None,
             "Tags": {}
         }
         if missing_params := self.require_parameters(request, required_params):
@@ -37,9 +61,21 @@ class CreateKubeCluster(HelperView, APIView):
         
         tags = self.unpack_tags(request)
 
+        try:
+            node_ips = unpack_node_ips(self, request)
+        except ValueError as e:
+            return self.bad_request(str(e))
+        
+        if request.POST["ControllerIp"] in node_ips:
+            return self.bad_request("NodeIps must not include the ControllerIp.")
+
         manager = KubeClusterManager()
+        node_instance_type = request.POST.get("NodeInstanceType") or request.POST["InstanceType"]
 
         try:
+            if node_ips:
+                manager.validate_nodes(request.user, node_instance_type, request.POST["NetworkProfile"], node_ips)
+
             # I don't like doing this
             # Need to figure out a way to clean this up
             
@@ -54,7 +90,19 @@ class CreateKubeCluster(HelperView, APIView):
                 tags = tags,
             )
 
-            task_create_cluster.delay(
+            if node_ips:
+                # Nodes are built once the controller reports the cluster as READY
+                manager.prepare_nodes(
+                    request.user,
+                    instance_def = node_instance_type,
+                    network_profile = request.POST["NetworkProfile"],
+                    node_ips = node_ips,
+                    disk_size = request.POST.get("NodeDiskSize") or request.POST.get("DiskSize", optional_params["DiskSize"]),
+                    key_name = request.POST.get("KeyName", optional_params["KeyName"]),
+                    tags = tags,
+                )
+
+            task = task_create_cluster.delay(
                 prepared_cluster_id = cluster_id,
                 user_id = request.user.user_id,
                 instance_def = request.POST["InstanceType"],
@@ -75,7 +123,7 @@ class CreateKubeCluster(HelperView, APIView):
         except Exception as e:
             logger.exception(e)
             return self.internal_server_error_response()
-        return self.success_response({"kube_cluster_id": cluster_id})
+        return self.success_response({"kube_cluster_id": cluster_id, "task_id": task.id})
         
 
 
@@ -83,31 +131,59 @@ class DescribeKubeCluster(HelperView, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, cluster_name:str):
-        i = []
-
         try:
-            if cluster_name == "all":
-                vms = KubeCluster.objects.filter(
-                    account=request.user.account
-                )
-            else:
-                vms = []
-                vms.append(KubeCluster.objects.get(
-                    account=request.user.account,
-                    name=cluster_name
-                ))
-            
-            for cluster in vms:
-                assoc_instances = []
-                s_obj = KubeClusterSerializer(cluster).data
-                for a_inst in s_obj['associated_instances']:
-                    vm = VirtualMachine.objects.get(id=a_inst)
-                    assoc_instances.append({
-                        'instance_id': vm.instance_id,
-                        'name': vm.tags['Name'] if "Name" in vm.tags else ""
-                    })
-                s_obj['associated_instances'] = assoc_instances
-                i.append(s_obj)
+            clusters = KubeCluster.objects.filter(
+                account=request.user.account
+            )
+            if cluster_name != "all":
+                clusters = clusters.filter(name=cluster_name)
+
+            # Node state is shown in the response too, so changes to a cluster's
+            # nodes need to invalidate the validators as well.
+            node_agg = KubeNode.objects.filter(cluster__in=clusters).aggregate(
+                last_modified=Max('last_modified'), count=Count('pk')
+            )
+            node_last_modified = node_agg['last_modified']
+            etag, last_modified = self.get_cache_validators(
+                clusters,
+                extra=f"{node_last_modified.isoformat() if node_last_modified else ''}:{node_agg['count']}"
+            )
+            if last_modified is not None and node_last_modified is not None:
+                last_modified = max(last_modified, int(node_last_modified.timestamp()))
+            if not_modified := self.not_modified_response(request, etag, last_modified):
+                return not_modified
+
+            i = KubeClusterValuesSerializer.serialize(clusters)
+            if cluster_name != "all" and not i:
+                raise KubeCluster.DoesNotExist(f"KubeCluster {cluster_name} does not exist")
+
+            # Fetch the associated instances for every cluster in one query
+            assoc_instances = {}
+            through = KubeCluster.associated_instances.through.objects.filter(
+                kubecluster__cluster_id__in=[c['cluster_id'] for c in i]
+            ).values_list('kubecluster__cluster_id', 'virtualmachine__instance_id', 'virtualmachine__tags')
+            for cluster_id, instance_id, tags in through:
+                assoc_instances.setdefault(cluster_id, []).append({
+                    'instance_id': instance_id,
+                    'name': tags['Name'] if tags and "Name" in tags else ""
+                })
+
+            # And every cluster's nodes in another
+            nodes = {}
+            node_rows = KubeNode.objects.filter(
+                cluster_id__in=[c['cluster_id'] for c in i]
+            ).values_list('cluster_id', 'node_id', 'instance_id', 'state', 'error')
+            for cluster_id, node_id, instance_id, node_state, error in node_rows:
+                nodes.setdefault(cluster_id, []).append({
+                    'node_id': node_id,
+                    'instance_id': instance_id,
+                    'state': node_state,
+                    'error': error,
+                })
+
+            for cluster in i:
+                cluster['associated_instances'] = assoc_instances.get(cluster['cluster_id'], [])
+                cluster['nodes'] = nodes.get(cluster['cluster_id'], [])
         except KubeCluster.DoesNotExist as e:
             logger.debug(e)
             return self.not_found_response()
@@ -115,23 +191,23 @@ class DescribeKubeCluster(HelperView, APIView):
             logger.exception(e)
             return self.internal_server_error_response()
             
-        return self.success_response(i)
+        return self.set_cache_validators(self.success_response(i), etag, last_modified)
     
 
-class ConfigKubeCluster(HelperView, APIView):
+class ConfigKubeCluster(HelperView, AsyncAPIView):
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, cluster_name:str):
+    async def get(self, request, cluster_name:str):
         try:
-            cluster_manager = KubeClusterManager(cluster_name)
+            cluster_manager = await run_in_db_pool(KubeClusterManager, cluster_name)
         except ClusterDoesNotExist:
             return self.not_found_response()
         
-        if cluster_manager.cluster_db.account != request.user.account:
+        if cluster_manager.cluster_db.account_id != request.user.account_id:
             return self.not_found_response()
         
         try:
-            config = cluster_manager.get_cluster_config(request.user)
+            config = await cluster_manager.aget_cluster_config(request.user)
             return self.success_response({"admin.conf": config})
         except Exception as e:
             logger.exception(e)
@@ -196,31 +272,97 @@ class ModifyKubeCluster(HelperView, APIView):
 
             try:
                 instance_class_size = request.POST["InstanceType"].split(".")
-                instanceDefinition = InstanceDefinition(instance_class_size[0], instance_class_size[1])
+                # Only validated here, the node is launched with it by the task
+                InstanceDefinition(instance_class_size[0], instance_class_size[1])
             except Exception as e:
                 logger.debug(e)
                 return self.bad_request("Provided InstanceSize is not a valid type or size.")
             
             tags = self.unpack_tags(request)
             
+            if cluster_manager.cluster_db.status != KubeCluster.Status.READY:
+                return self.bad_request("Cluster is not in state to accept new nodes")
+
             try:
-                cluster_manager.add_node_to_cluster(
+                node_ips = [request.POST['NodeIp']]
+                cluster_manager.validate_nodes(
+                    request.user,
+                    request.POST["InstanceType"],
+                    request.POST['NetworkProfile'],
+                    node_ips,
+                    image_id = request.POST.get("ImageId", optional_params['ImageId']),
+                )
+                nodes = cluster_manager.prepare_nodes(
                     request.user,
-                    instanceDefinition,
-                    node_ip = request.POST['NodeIp'],
+                    instance_def = request.POST["InstanceType"],
                     network_profile = request.POST['NetworkProfile'],
+                    node_ips = node_ips,
                     disk_size = request.POST.get("DiskSize", optional_params["DiskSize"]),
                     key_name = request.POST.get("KeyName", optional_params["KeyName"]),
                     image_id = request.POST.get("ImageId", optional_params['ImageId']),
                     tags = tags
                 )
+                launch_nodes(nodes)
             except ClusterConfigurationError as e:
                 return self.bad_request(str(e))
             except Exception as e:
                 logger.exception(e)
                 return self.internal_server_error_response()
 
-            return self.request_success_response()
+            return self.request_success_response(nodes[0].node_id)
+        elif action == 'add-nodes':
+            required_params = [
+                "InstanceType",
+                "NetworkProfile",
+            ]
+            optional_params = {
+                "KeyName": None,
+                "ImageId": None,
+                "DiskSize": "30G",
+                "NodeCount": None,
+                "NodeIps": None,
+                "Tags": {}
+            }
+            if missing_params := self.require_parameters(request, required_params):
+                return self.missing_parameter_response(missing_params)
+            
+            try:
+                node_ips = unpack_node_ips(self, request)
+            except ValueError as e:
+                return self.bad_request(str(e))
+            
+            if not node_ips:
+                return self.bad_request("NodeCount or NodeIps must be provided.")
+            
+            if cluster_manager.cluster_db.status != KubeCluster.Status.READY:
+                return self.bad_request("Cluster is not in state to accept new nodes")
+
+            try:
+                cluster_manager.validate_nodes(
+                    request.user, 
+                    request.POST["InstanceType"], 
+                    request.POST['NetworkProfile'], 
+                    node_ips,
+                    image_id = request.POST.get("ImageId", optional_params['ImageId']),
+                )
+                nodes = cluster_manager.prepare_nodes(
+                    request.user,
+                    instance_def = request.POST["InstanceType"],
+                    network_profile = request.POST['NetworkProfile'],
+                    node_ips = node_ips,
+                    disk_size = request.POST.get("DiskSize", optional_params["DiskSize"]),
+                    key_name = request.POST.get("KeyName", optional_params["KeyName"]),
+                    image_id = request.POST.get("ImageId", optional_params['ImageId']),
+                    tags = self.unpack_tags(request),
+                )
+                launch_nodes(nodes)
+            except ClusterConfigurationError as e:
+                return self.bad_request(str(e))
+            except Exception as e:
+                logger.exception(e)
+                return self.internal_server_error_response()
+
+            return self.success_response({"node_ids": [node.node_id for node in nodes]})
         else:
             return self.bad_request("Unknown action")
 
@@ -273,23 +415,27 @@ class PrepareAdminKubeCluster(HelperView, APIView):
         instance_id = request.POST['Self']
         logger.debug(f"Instance ID: {instance_id}")
 
+        if not VirtualMachine.objects.filter(instance_id=instance_id, account=request.user.account).exists():
+            return self.forbidden_response()
+
         cluster_manager = KubeClusterManager()
+        build = cluster_manager.get_image_build_for_instance(instance_id)
         
         logger.debug(request.POST)
         if request.POST['Success'] != "true":
             logger.debug("PrepareAdminKubeCluster: Instance posted failed status")
             logger.debug(request.POST['ErrorLog'])
+            if build:
+                cluster_manager.set_build_failed(build, request.POST.get('ErrorLog', ''))
             return self.success_response()
 
         logger.debug("PrepareAdminKubeCluster: Instance posted success status")
-        try:
-            cluster_manager.register_kubernetes_image(request.user, instance_id)
-        except VirtualMachineDoesNotExist:
-            return self.forbidden_response()
-        except Exception as e:
-            logger.exception(e)
-            return self.internal_server_error_response()
+        if build:
+            cluster_manager.set_build_provisioned(build)
 
+        # Creating the image stops the instance that's calling us, so
+        # don't make it wait for that.
+        task_register_kube_image.delay(request.user.user_id, instance_id)
         return self.success_response()
 
 
@@ -321,6 +467,10 @@ class InitAdminKubeCluster(HelperView, APIView):
             # Store cluster secrets
             cluster_manager.set_cluster_secrets(request.user, data)
             cluster_manager.set_cluster_as_ready()
+
+            # Build any nodes requested with the cluster, all at once
+            if pending_nodes := cluster_manager.get_pending_nodes():
+                launch_nodes(pending_nodes)
         else:
             cluster_manager.set_cluster_as_failed()
 
@@ -353,14 +503,19 @@ class NodeAddAdminKubeCluster(HelperView, APIView):
         except VirtualMachine.DoesNotExist:
             return self.bad_request("Unrecognized instance to add to cluster")
         
+        node = KubeNode.objects.filter(cluster=cluster_manager.cluster_db, instance=vm).first()
+
         logger.debug(request.POST)
         if request.POST['Success'] == "true":
             # Associate this instance with the cluster
             cluster_manager.cluster_db.associated_instances.add(vm)
             cluster_manager.cluster_db.save()
+            if node:
+                cluster_manager.set_node_state(node, KubeNode.State.READY)
         else:
             logger.debug("Instance posted Success = False message")
             logger.debug(request.POST['ErrorLog'])
-            pass
+            if node:
+                cluster_manager.set_node_state(node, KubeNode.State.FAILED, error=request.POST['ErrorLog'])
 
         return self.success_response()
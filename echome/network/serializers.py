@@ -1,8 +1,14 @@
 from rest_framework import serializers
+from api.serializers import ValuesSerializer
 from .models import VirtualNetwork
   
 class NetworkSerializer(serializers.ModelSerializer):
     # specify model and fields
     class Meta:
         model = VirtualNetwork
-        exclude = ['id', 'deactivated', 'account']
\ No newline at end of file
+        exclude = ['id', 'deactivated', 'account']
+
+
+class NetworkValuesSerializer(ValuesSerializer):
+    model = VirtualNetwork
+    exclude = NetworkSerializer.Meta.exclude
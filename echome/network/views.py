@@ -5,7 +5,7 @@ from api.api_view import HelperView
 from .models import VirtualNetwork
 from .manager import VirtualNetworkManager
 from .exceptions import InvalidNetworkConfiguration, InvalidNetworkName
-from .serializers import NetworkSerializer
+from .serializers import NetworkValuesSerializer
 
 logger = logging.getLogger(__name__)
 
@@ -61,23 +61,20 @@ class DescribeNetwork(HelperView, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, net_id:str):
-        networks = []
-
         try:
-            if net_id == "all":
-                vnets = VirtualNetwork.objects.filter(
-                    account=request.user.account,
-                )
-            else:
-                vnets = []
-                vnets.append(VirtualNetwork.objects.get(
-                    network_id=net_id,
-                    account=request.user.account,
-                ))
-            
-            for vnet in vnets:
-                networks.append(NetworkSerializer(vnet).data)
+            vnets = VirtualNetwork.objects.filter(
+                account=request.user.account,
+            )
+            if net_id != "all":
+                vnets = vnets.filter(network_id=net_id)
+
+            etag, last_modified = self.get_cache_validators(vnets)
+            if not_modified := self.not_modified_response(request, etag, last_modified):
+                return not_modified
 
+            networks = NetworkValuesSerializer.serialize(vnets)
+            if net_id != "all" and not networks:
+                raise VirtualNetwork.DoesNotExist(f"VirtualNetwork {net_id} does not exist")
         except VirtualNetwork.DoesNotExist as e:
             logger.debug(e)
             return self.not_found_response()
@@ -85,7 +82,7 @@ class DescribeNetwork(HelperView, APIView):
             logger.exception(e)
             return self.internal_server_error_response()
         
-        return self.success_response(networks)
+        return self.set_cache_validators(self.success_response(networks), etag, last_modified)
         
 
 class TerminateNetwork(HelperView, APIView):
@@ -0,0 +1,9 @@
+from prometheus_client import Histogram
+from echome.metrics import CALL_BUCKETS
+
+vault_call_duration = Histogram(
+    "echome_vault_call_duration_seconds",
+    "Latency of calls to Vault",
+    ["call"],
+    buckets=CALL_BUCKETS,
+)
@@ -1,8 +1,13 @@
+import asyncio
 import logging
+import weakref
 import hvac
+import httpx
 from hvac import exceptions
 from echome.config import ecHomeConfig
+from echome.metrics import timed
 from .exceptions import CannotUnsealVaultServerError, SecretDoesNotExistError, VaultIsSealedError
+from .metrics import vault_call_duration
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +28,7 @@ class Vault:
         return capabilities['path'] == 'auth/token/root'
     
 
+    @timed(vault_call_duration, "unseal")
     def unseal(self):
         """Unseals Vault"""
         if self.client.sys.is_sealed():
@@ -39,6 +45,7 @@ class Vault:
             logger.debug("Vault is already unsealed!")
     
 
+    @timed(vault_call_duration, "create_secret_engine")
     def create_secret_engine(self, path:str, type:str = "kv"):
         logger.debug(f"Creating secrets engine of type: {type} at path {path}")
         options = {}
@@ -51,11 +58,13 @@ class Vault:
             options=options
         )
     
+    @timed(vault_call_duration, "check_if_path_exists")
     def check_if_path_exists(self, path:str) -> bool:
         engines = self.client.sys.list_mounted_secrets_engines()['data']
         return f"{path}/" in engines.keys()
     
 
+    @timed(vault_call_duration, "store_sshkey")
     def store_sshkey(self, mount_point:str, path_name:str, key:str):
         self.client.secrets.kv.v2.create_or_update_secret(
             mount_point=mount_point,
@@ -66,6 +75,7 @@ class Vault:
         )
     
     
+    @timed(vault_call_duration, "store_dict")
     def store_dict(self, mount_point:str, path_name:str, value:dict):
         # First check to see if there's already stuff here. If there is, merge it
         data = {}
@@ -94,6 +104,7 @@ class Vault:
                 self.delete_key(mount_point, f"{path_name}/{key}")
     
 
+    @timed(vault_call_duration, "delete_key")
     def delete_key(self, mount_point:str, path_name:str):
         """When provided the full path to a key, deletes all metadata
         and versions of the key."""
@@ -103,6 +114,7 @@ class Vault:
         )
     
 
+    @timed(vault_call_duration, "list_keys")
     def list_keys(self, mount_point:str, path_name:str):
         try:
             keys = self.client.secrets.kv.v2.list_secrets(
@@ -114,6 +126,7 @@ class Vault:
             return False
     
 
+    @timed(vault_call_duration, "get_secret")
     def get_secret(self, mount_point:str, path_name:str):
         try:
             return self.client.secrets.kv.v2.read_secret_version(
@@ -125,6 +138,7 @@ class Vault:
 
     
 
+    @timed(vault_call_duration, "create_policy")
     def create_policy(self, policy:str, name:str):
         return self.client.sys.create_or_update_policy(
             name=name,
@@ -132,13 +146,62 @@ class Vault:
         )
     
 
+    @timed(vault_call_duration, "delete_policy")
     def delete_policy(self, name:str):
         return self.client.sys.delete_policy(name)
     
 
+    @timed(vault_call_duration, "generate_temp_token")
     def generate_temp_token(self, policies:list, lease='1h'):
         return self.client.create_token(
             policies=policies, 
             lease=lease, 
             renewable=False
         )
+
+
+
+class AsyncVault:
+    """Read-only Vault client for async views. Uses an async HTTP client so
+    waiting on Vault doesn't tie up a thread. Writes and administrative
+    calls should keep using Vault."""
+
+    # One client per event loop so keep-alive connections are reused between
+    # requests without sharing a client across loops.
+    _clients = weakref.WeakKeyDictionary()
+
+    def __init__(self):
+        self.addr = ecHomeConfig.Vault().addr.rstrip("/")
+        self.token = ecHomeConfig.Vault().root_token
+
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                base_url=self.addr,
+                headers={"X-Vault-Token": self.token},
+                timeout=10.0,
+            )
+            self._clients[loop] = client
+        return client
+
+
+    @timed(vault_call_duration, "get_secret")
+    async def get_secret(self, mount_point:str, path_name:str):
+        """Async equivalent of Vault.get_secret(). Returns the same KV v2 response."""
+        response = await self.client.get(f"/v1/{mount_point}/data/{path_name}")
+
+        if response.status_code == 503:
+            # Sealed. The sync client knows how to unseal, then try again once.
+            logger.debug("Vault is sealed, attempting to unseal before retrying")
+            await asyncio.get_running_loop().run_in_executor(None, Vault)
+            response = await self.client.get(f"/v1/{mount_point}/data/{path_name}")
+
+        if response.status_code == 404:
+            raise SecretDoesNotExistError
+
+        response.raise_for_status()
+        return response.json()
@@ -8,6 +8,7 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from dataclasses import dataclass
 from echome.config import ecHomeConfig
+from echome.tracing import traced
 from commander.cloudlocalds import CloudLocalds
 from commander.cloudinit import CloudInit as CloudInitCommand
 from network.models import VirtualNetwork
@@ -227,6 +228,7 @@ class CloudInit:
         return contents
     
 
+    @traced("cloudinit.create_iso")
     def create_iso(self, userdata_yaml_file_path:str = None, cloudinit_network_yaml_file_path:str = None,
             cloudinit_metadata_file_path:str = None) -> str:
         """Create the Cloudinit ISO to be mounted to the virtual machine.
@@ -0,0 +1,202 @@
+import logging
+import os
+import shutil
+from datetime import timedelta
+from pathlib import Path
+from typing import List
+from django.db.models import Count, Exists, OuterRef, Sum
+from django.utils import timezone
+from echome.config import ecHomeConfig
+from .models import HostMachine, HostImage, Image, ImageBlob, Volume
+
+logger = logging.getLogger(__name__)
+
+# The host this process runs on. Images are only copied into the cache of this host.
+HOST_ID = os.getenv("HOST_ID", "")
+
+# Bytes a host's image cache may use before the least recently used images are 
+# evicted. Set image_cache_size in a host's metadata to override it for that host.
+HOST_IMAGE_CACHE_SIZE = int(os.getenv("HOST_IMAGE_CACHE_SIZE", str(50 * 2**30)))
+
+# prefetch_popular() pushes the images launched most in the last
+# IMAGE_PREFETCH_DAYS days to every host.
+IMAGE_PREFETCH_COUNT = int(os.getenv("IMAGE_PREFETCH_COUNT", "5"))
+IMAGE_PREFETCH_DAYS = int(os.getenv("IMAGE_PREFETCH_DAYS", "7"))
+
+
+def host_queue(host:HostMachine) -> str:
+    """Celery queue consumed only by the worker running on the host."""
+    return f"host.{host.host_id}"
+
+
+def choose_host() -> HostMachine:
+    """Pick the host to launch a virtual machine on. Domains are defined through
+    this process's libvirt connection, so until launches can be sent to another
+    host, that's this host (HOST_ID), or without one, the first registered host."""
+    hosts = HostMachine.objects.order_by("created")
+    if HOST_ID:
+        hosts = hosts.filter(host_id=HOST_ID)
+    host = hosts.first()
+    if host is None:
+        raise HostMachine.DoesNotExist(f"Host {HOST_ID} is not registered" if HOST_ID else "No hosts are registered")
+    return host
+
+
+def prefetch(image:Image, hosts:List[HostMachine] = None) -> List[HostMachine]:
+    """Queue copying an image into the cache of each host (or every host) that doesn't
+    have it yet. Returns the hosts it was queued for."""
+    from .tasks import task_prefetch_image
+    if image.blob_id is None:
+        logger.debug(f"{image.image_id} is not in the image store, it can't be prefetched")
+        return []
+    if not HOST_ID:
+        # Only workers started with a HOST_ID consume their host's queue
+        logger.debug(f"HOST_ID is not set, not prefetching {image.image_id}")
+        return []
+
+    if hosts is None:
+        hosts = HostMachine.objects.all()
+
+    queued = []
+    for host in hosts:
+        if HostImageCache(host).has(image.blob_id):
+            continue
+        task_prefetch_image.apply_async((host.host_id, image.blob_id), queue=host_queue(host))
+        queued.append(host)
+    return queued
+
+
+def prefetch_popular() -> List[Image]:
+    """Prefetch the images launched most often recently to every host."""
+    since = timezone.now() - timedelta(days=IMAGE_PREFETCH_DAYS)
+    popular = Volume.objects.filter(created__gte=since, parent_image__isnull=False) \
+        .values("parent_image").annotate(launches=Count("id")).order_by("-launches") \
+        .values_list("parent_image", flat=True)[:IMAGE_PREFETCH_COUNT]
+    
+    images = list(Image.objects.filter(image_id__in=list(popular), blob__isnull=False))
+    hosts = list(HostMachine.objects.all())
+    for image in images:
+        prefetch(image, hosts)
+    return images
+
+
+class HostImageCache:
+    """LRU cache of image store blobs on a host's local disk, evicted by size."""
+
+    def __init__(self, host:HostMachine) -> None:
+        self.host = host
+        self.root = Path(ecHomeConfig.VirtualMachines().image_cache_dir)
+
+
+    @property
+    def capacity(self) -> int:
+        return int(self.host.metadata.get("image_cache_size", HOST_IMAGE_CACHE_SIZE))
+
+
+    def has(self, digest:str) -> bool:
+        return HostImage.objects.filter(host=self.host, blob_id=digest, state=HostImage.State.AVAILABLE).exists()
+
+
+    def path_for(self, image:Image) -> str:
+        """Path to launch a virtual machine from the image on this host. That's the cached
+        copy if there is one, otherwise the image store's, and the image is prefetched 
+        so the next launch finds it in the cache."""
+        if image.blob_id is None:
+            return image.image_path
+
+        updated = HostImage.objects.filter(
+            host = self.host, 
+            blob_id = image.blob_id, 
+            state = HostImage.State.AVAILABLE
+        ).update(last_used=timezone.now())
+        if updated:
+            return HostImage.objects.values_list("path", flat=True).get(host=self.host, blob_id=image.blob_id)
+
+        logger.debug(f"{image.image_id} is not cached on {self.host.host_id}, using the image store")
+        prefetch(image, [self.host])
+        return image.image_path
+
+
+    def fetch(self, blob:ImageBlob) -> HostImage:
+        """Copy a blob into this host's cache. Has to run on the host itself."""
+        if self.host.host_id != HOST_ID:
+            raise ValueError(f"Images can only be cached on the host this runs on ({HOST_ID}), not {self.host.host_id}")
+
+        entry, created = HostImage.objects.get_or_create(
+            host = self.host,
+            blob = blob,
+            defaults = {"path": str(self.root / blob.digest[:2] / f"{blob.digest}.{blob.format}")},
+        )
+        if not created and entry.state == HostImage.State.AVAILABLE and os.path.exists(entry.path):
+            return entry
+
+        path = Path(entry.path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(f"{path.name}.partial")
+        logger.debug(f"Caching {blob.digest} on {self.host.host_id}: {path}")
+        try:
+            shutil.copyfile(blob.path, partial)
+            os.replace(partial, path)
+        except Exception:
+            partial.unlink(missing_ok=True)
+            entry.delete()
+            raise
+
+        entry.size = os.path.getsize(path)
+        entry.state = HostImage.State.AVAILABLE
+        entry.last_used = timezone.now()
+        entry.save()
+
+        self.evict()
+        return entry
+
+
+    def evict(self) -> List[HostImage]:
+        """Remove the least recently used images until the cache fits its capacity. Images
+        that overlay volumes on this host are backed by are kept. Returns the evicted images."""
+        entries = HostImage.objects.filter(host=self.host, state=HostImage.State.AVAILABLE)
+        used = entries.aggregate(total=Sum("size"))["total"] or 0
+        if used <= self.capacity:
+            return []
+
+        in_use = Volume.objects.filter(host=self.host, blob_id=OuterRef("blob_id"))
+        evicted = []
+        for entry in entries.annotate(in_use=Exists(in_use)).filter(in_use=False).order_by("last_used"):
+            if used <= self.capacity:
+                break
+
+            logger.debug(f"Evicting {entry.blob_id} from the image cache on {self.host.host_id}")
+            entry.delete()
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+            used -= entry.size
+            evicted.append(entry)
+
+        return evicted
+
+
+    def drop_unreferenced(self) -> List[HostImage]:
+        """Remove the cached copies of blobs the image store is about to collect, so
+        they can be collected. Has to run on the host itself. Returns the removed images."""
+        from .image_store import ImageStore
+        if self.host.host_id != HOST_ID:
+            raise ValueError(f"Images can only be removed from the cache of the host this runs on ({HOST_ID}), not {self.host.host_id}")
+
+        entries = HostImage.objects.filter(
+            host = self.host, 
+            state = HostImage.State.AVAILABLE,
+            blob__in = ImageStore().unreferenced().values("digest"),
+        )
+        dropped = []
+        for entry in entries:
+            logger.debug(f"Removing unreferenced {entry.blob_id} from the image cache on {self.host.host_id}")
+            entry.delete()
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+            dropped.append(entry)
+
+        return dropped
@@ -2,8 +2,12 @@ import logging
 import os
 import shutil
 from pathlib import Path
+from django.db import transaction
+from django.db.models import Q
 from identity.models import User
+from commander.qemuimg import QemuImg
 from .models import Image
+from .image_store import ImageStore
 from .exceptions import (
     ImageAlreadyExistsError, 
     InvalidImagePath, 
@@ -96,26 +100,41 @@ class ImageManager:
             logger.warn("Cannot finish an image that was not first prepared")
             raise ImagePrepError
         
-        return self._register_image(path)
+        return self._register_image(path, move=True)
 
 
-    def _register_image(self, path:str):
+    def _register_image(self, path:str, move:bool = False):
+        """Register the image at path. With move, the file at path is moved into the image
+        store right away. Otherwise it's left where it is and the image is used from there
+        until it's copied into the store in the background (task_store_image)."""
         # Check to see if a file exists at the provided path
         if not os.path.exists(path):
             logger.error(f"File does not exist at specified file path: {path}")
             raise InvalidImagePath(f"File does not exist at specified file path: {path}")
         
-        # Check to see if an image at the path already exists
-        if Image.objects.filter(image_path=path).exists():
+        # Check to see if an image at the path already exists. Once it's in the image store,
+        # an image's path is its blob's, the path it was registered from is in its metadata.
+        if Image.objects.filter(Q(image_path=path) | Q(metadata__source_path=path)).exists():
             logger.error(f"Image already exists in database. img_path={path}")
             raise ImageAlreadyExistsError(f"Image already exists in database. img_path={path}")
         
         self.image.image_path = path
         self.image.set_image_metadata()
 
+        if move:
+            blob = ImageStore().put(path, move=True)
+            self.image.blob = blob
+            self.image.image_path = blob.path
+        else:
+            self.image.metadata["source_path"] = path
+
         self.image.state = Image.State.AVAILABLE
 
         self.image.save()
+        if not move:
+            from .tasks import task_store_image
+            image_id = self.image.image_id
+            transaction.on_commit(lambda: task_store_image.delay(image_id))
         return self.image.image_id
 
 
@@ -146,9 +165,10 @@ class ImageManager:
         return image
 
 
-    def copy_image(self, image:Image, destination_dir:Path, file_name:str) -> str:
-        """Copy a guest or user image to the path. Returns the full path of the copied image."""
-        img_path = image.image_path
+    def copy_image(self, image:Image, destination_dir:Path, file_name:str, source_path:str = None) -> str:
+        """Copy a guest or user image to the path. Returns the full path of the copied image.
+        source_path is a copy of the image to read instead, e.g. from a host's image cache."""
+        img_path = source_path if source_path else image.image_path
         img_format = image.format
 
         # Form the path of the final image
@@ -166,6 +186,35 @@ class ImageManager:
         return destination_vm_img
 
     
+    def overlay_image(self, image:Image, destination_dir:Path, file_name:str, source_path:str = None) -> str:
+        """Create a qcow2 overlay of an image in the image store at the path, in place of a 
+        full copy. Returns the full path of the overlay. source_path is a copy of the
+        image's blob to use as the backing file instead, e.g. from a host's image cache."""
+        destination_vm_img = destination_dir.absolute() / f"{file_name}.qcow2"
+        backing_path = source_path if source_path else image.blob.path
+        logger.debug(f"Creating overlay of {image.image_id} ({image.blob_id}) as {destination_vm_img}")
+        if not QemuImg().create_overlay(destination_vm_img, backing_path, image.blob.format):
+            raise ImageCopyError("Encountered an error creating an overlay of the image.")
+        return destination_vm_img
+
+
+    def set_progress(self, stage:str, percent:float = None):
+        """Record which stage of creation a prepared image is in, and how far along it is,
+        in its metadata for clients polling the image."""
+        progress = {"stage": stage}
+        if percent is not None:
+            progress["percent"] = round(percent, 1)
+
+        # Skip writes for changes of less than a percent
+        previous = self.image.metadata.get("progress", {})
+        if previous.get("stage") == stage and percent is not None \
+                and abs(percent - previous.get("percent", 0)) < 1 and percent < 100:
+            return
+
+        self.image.metadata["progress"] = progress
+        self.image.save(update_fields=["metadata", "last_modified"])
+
+
     def mark_image_as_failed(self):
         logger.debug("Marking image as failed")
         self.image.state = Image.State.ERROR
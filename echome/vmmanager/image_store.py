@@ -0,0 +1,180 @@
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+from datetime import timedelta
+from pathlib import Path
+from typing import List
+from django.db import transaction
+from django.db.models import Count, F, ProtectedError, Q
+from django.utils import timezone
+from echome.config import ecHomeConfig
+from commander.qemuimg import QemuImg
+from .models import Image, ImageBlob
+from .exceptions import ImagePrepError
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 4 * 2**20
+
+# Unreferenced blobs are only collected once they haven't been stored for this
+# many seconds, so one that's about to be referenced by a new image is kept.
+IMAGE_BLOB_GC_GRACE_PERIOD = int(os.getenv("IMAGE_BLOB_GC_GRACE_PERIOD", "3600"))
+
+# Seconds between collections. The collection task is scheduled on this interval.
+IMAGE_BLOB_GC_INTERVAL = int(os.getenv("IMAGE_BLOB_GC_INTERVAL", "3600"))
+
+# ioctl from linux/fs.h that makes a file share another's data copy-on-write
+FICLONE = 0x40049409
+
+
+def chunked_digest(path:str) -> str:
+    """sha256 of the sha256 digests of each 4 MiB chunk of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(hashlib.sha256(chunk).digest())
+    return digest.hexdigest()
+
+
+def copy_file(source:str, destination:str):
+    """Copy a file, as a reflink on filesystems that support it (btrfs, XFS), which
+    takes no time or space until one of the files is changed."""
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, destination)
+
+
+class ImageStore:
+    """Content-addressed store for image data. Images with the same content share
+    a single file, kept for as long as an Image or overlay Volume references it."""
+
+    def __init__(self, root:str = None) -> None:
+        if root is None:
+            config = ecHomeConfig.VirtualMachines()
+            root = config.image_store_dir if config.image_store_dir else f"{config.user_dir}/image_store"
+        self.root = Path(root)
+
+
+    def blob_path(self, digest:str, format:str) -> Path:
+        return self.root / digest[:2] / f"{digest}.{format}"
+
+
+    def put(self, path:str, move:bool = False) -> ImageBlob:
+        """Add the image at path to the store, returning the blob with its content. If
+        the store already has it, nothing's written. With move, the file at path is 
+        moved into the store (or removed if it's already there) instead of copied."""
+        digest = chunked_digest(path)
+        blob = ImageBlob.objects.filter(digest=digest).first()
+        if blob and os.path.exists(blob.path):
+            logger.debug(f"Image store already has {path} as {digest}")
+            blob.save()
+            if move:
+                os.unlink(path)
+            return blob
+
+        info = QemuImg().info(path)
+        if not info:
+            raise ImagePrepError(f"Unable to read image at {path}")
+
+        destination = self.blob_path(digest, info["format"])
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        self._store_file(Path(path), destination, move)
+        logger.debug(f"Stored {path} in the image store as {digest}")
+
+        blob, _ = ImageBlob.objects.update_or_create(
+            digest = digest,
+            defaults = {
+                "path": str(destination),
+                "size": os.path.getsize(destination),
+                "format": info["format"],
+            }
+        )
+        return blob
+
+
+    def _store_file(self, path:Path, destination:Path, move:bool):
+        if move:
+            try:
+                os.replace(path, destination)
+                return
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+        elif destination.exists():
+            return
+
+        # Not a hard link, the caller's file could still be changed. Copied (or moved 
+        # across filesystems) to a partial file and put in place in one step.
+        partial = destination.with_name(f"{destination.name}.partial")
+        copy_file(path, partial)
+        os.replace(partial, destination)
+        if move:
+            os.unlink(path)
+
+
+    def store_image(self, image:Image, move:bool = False) -> ImageBlob:
+        """Move an image's data into the store and point the image at it."""
+        blob = self.put(image.image_path, move=move)
+        if not move:
+            # An image is only registered from a path once
+            image.metadata.setdefault("source_path", image.image_path)
+        image.blob = blob
+        image.image_path = blob.path
+        # Storing a large image takes a while, don't overwrite changes made meanwhile
+        image.save(update_fields=["blob", "image_path", "metadata", "last_modified"])
+        return blob
+
+
+    def with_ref_counts(self):
+        """Blobs annotated with the number of images (not deleted) and overlay 
+        volumes referencing them, as ref_count."""
+        return ImageBlob.objects.annotate(
+            image_refs = Count("images", filter=~Q(images__state=Image.State.DELETED), distinct=True),
+            volume_refs = Count("volumes", distinct=True),
+        ).annotate(ref_count=F("image_refs") + F("volume_refs"))
+
+
+    def unreferenced(self):
+        """Blobs nothing has referenced for the grace period."""
+        cutoff = timezone.now() - timedelta(seconds=IMAGE_BLOB_GC_GRACE_PERIOD)
+        return self.with_ref_counts().filter(ref_count=0, last_modified__lt=cutoff)
+
+
+    def collect_garbage(self, dry_run:bool = False) -> List[ImageBlob]:
+        """Delete blobs nothing references anymore. Blobs hosts still have a cached
+        copy of are kept until the hosts drop them. Returns the blobs that were 
+        (or with dry_run, would have been) deleted."""
+        cutoff = timezone.now() - timedelta(seconds=IMAGE_BLOB_GC_GRACE_PERIOD)
+        unreferenced = list(self.unreferenced())
+        if dry_run:
+            return unreferenced
+
+        collected = []
+        for blob in unreferenced:
+            try:
+                with transaction.atomic():
+                    # Images marked deleted still point at the blob
+                    Image.objects.filter(blob=blob, state=Image.State.DELETED).update(blob=None)
+                    deleted, _ = ImageBlob.objects.filter(pk=blob.pk, last_modified__lt=cutoff).delete()
+            except ProtectedError:
+                deleted = 0
+            
+            if not deleted:
+                logger.debug(f"Blob {blob.digest} was referenced again or is still cached on a host, keeping it")
+                continue
+
+            try:
+                os.unlink(blob.path)
+            except FileNotFoundError:
+                pass
+            logger.debug(f"Collected blob {blob.digest} ({blob.size} bytes)")
+            collected.append(blob)
+
+        return collected
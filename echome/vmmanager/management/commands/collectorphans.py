@@ -0,0 +1,18 @@
+from api.management_command import ManagementCommand
+from vmmanager.orphan_collector import collect_orphans
+
+class Command(ManagementCommand):
+    help = 'Delete virtual machine directories and disks on this host that no virtual machine, volume or libvirt domain uses.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+
+
+    def handle(self, *args, **options):
+        orphans = collect_orphans(dry_run=options['dry_run'])
+        for orphan in orphans:
+            kind = "directory" if orphan.is_directory else "disk"
+            self.stdout.write(f'{orphan.path}: {kind} ({orphan.size} bytes)')
+
+        verb = "Would delete" if options['dry_run'] else "Deleted"
+        self.stdout.write(self.style.SUCCESS(f'{verb} {len(orphans)} directories and disks, {sum(orphan.size for orphan in orphans)} bytes'))
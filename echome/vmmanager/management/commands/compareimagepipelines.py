@@ -0,0 +1,45 @@
+from api.management_command import ManagementCommand
+from identity.models import User
+from vmmanager.models import Image
+from vmmanager.vm_manager import VmManager
+
+PIPELINES = ["three-pass", "pipelined"]
+
+class Command(ManagementCommand):
+    help = 'Create an image from a virtual machine with each image creation pipeline and compare wall time and bytes written.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', required=True, help='User ID owning the virtual machine')
+        parser.add_argument('--vm', required=True, help='Instance ID of the virtual machine to create the images from')
+        parser.add_argument('--keep', action='store_true', help='Keep the created images instead of deactivating them')
+
+
+    def handle(self, *args, **options):
+        user = User.objects.get(user_id=options['user'])
+        vm_manager = VmManager()
+
+        for pipeline in PIPELINES:
+            try:
+                vmi = vm_manager.create_virtual_machine_image(
+                    vm_id = options['vm'],
+                    user = user,
+                    name = f"{options['vm']}-{pipeline}",
+                    description = f"Image creation comparison ({pipeline})",
+                    pipeline = pipeline,
+                )
+            except Exception as e:
+                self.stdout.write(str(e))
+                self.stderr.write(f'Error: Creating an image with the {pipeline} pipeline failed.')
+                return
+
+            image = Image.objects.get(image_id=vmi["vmi_id"])
+            creation = image.metadata["creation"]
+            stages = ", ".join(f"{stage} {seconds}s" for stage, seconds in creation["stages"].items())
+            self.stdout.write(self.style.SUCCESS(
+                f'{pipeline}: {creation["seconds"]}s, {creation["bytes_written"] / 2**20:.1f} MiB written, '
+                f'{image.metadata["actual-size"] / 2**20:.1f} MiB image ({stages})'
+            ))
+
+            if not options['keep']:
+                image.deactivated = True
+                image.save()
@@ -0,0 +1,53 @@
+from api.management_command import ManagementCommand
+from vmmanager.image_store import ImageStore
+from vmmanager.models import Image
+
+class Command(ManagementCommand):
+    help = 'Move existing images into the content-addressed image store and collect unreferenced blobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['import', 'gc'], 
+            help='import: store images that are not in the image store yet. gc: delete blobs nothing references')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be done')
+
+
+    def handle(self, *args, **options):
+        store = ImageStore()
+        if options['action'] == 'import':
+            self.import_images(store, options['dry_run'])
+        else:
+            self.collect_garbage(store, options['dry_run'])
+
+
+    def import_images(self, store:ImageStore, dry_run:bool):
+        images = Image.objects.filter(blob__isnull=True, state=Image.State.AVAILABLE)
+        if dry_run:
+            for image in images:
+                self.stdout.write(f'{image.image_id}: {image.image_path}')
+            return
+
+        digests = set()
+        stored = 0
+        for image in images:
+            try:
+                # Guest images are copied, their original files are left alone
+                blob = store.store_image(image, move=image.image_type == Image.ImageType.USER)
+            except Exception as e:
+                self.stderr.write(f'Error: Unable to store {image.image_id}: {e}')
+                continue
+
+            shared = " (deduplicated)" if blob.digest in digests else ""
+            digests.add(blob.digest)
+            stored += 1
+            self.stdout.write(f'{image.image_id}: {blob.digest}{shared}')
+
+        self.stdout.write(self.style.SUCCESS(f'Stored {stored} images as {len(digests)} blobs'))
+
+
+    def collect_garbage(self, store:ImageStore, dry_run:bool):
+        blobs = store.collect_garbage(dry_run=dry_run)
+        for blob in blobs:
+            self.stdout.write(f'{blob.digest}: {blob.path} ({blob.size} bytes)')
+
+        verb = "Would delete" if dry_run else "Deleted"
+        self.stdout.write(self.style.SUCCESS(f'{verb} {len(blobs)} blobs, {sum(blob.size for blob in blobs)} bytes'))
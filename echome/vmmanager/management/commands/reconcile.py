@@ -0,0 +1,27 @@
+from api.management_command import ManagementCommand
+from vmmanager.host_image_cache import HOST_ID
+from vmmanager.reconciler import reconcile_host
+
+class Command(ManagementCommand):
+    help = 'Reconcile the state of the virtual machines on this host with libvirt and report orphaned domains and files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default=HOST_ID,
+            help='Host ID of this host (defaults to HOST_ID). Without one, every virtual machine is checked.')
+
+
+    def handle(self, *args, **options):
+        report = reconcile_host(options['host'])
+
+        for vm in report.updated:
+            self.stdout.write(f'{vm["virtual_machine_id"]}: {vm["state"]} ({vm["power_state"] or "no domain"})')
+        for vm_id in report.missing_domains:
+            self.stdout.write(f'Missing domain: {vm_id}')
+        for name in report.orphaned_domains:
+            self.stdout.write(f'Orphaned domain: {name}')
+        for path in report.orphaned_directories:
+            self.stdout.write(f'Orphaned directory: {path}')
+        for path in report.orphaned_disks:
+            self.stdout.write(f'Orphaned disk: {path}')
+
+        self.stdout.write(self.style.SUCCESS(f'Checked {report.checked} virtual machines, updated {len(report.updated)}'))
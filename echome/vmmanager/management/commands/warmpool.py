@@ -0,0 +1,37 @@
+from api.management_command import ManagementCommand
+from identity.models import User
+from vmmanager.instance_definitions import InstanceDefinition
+from vmmanager.host_image_cache import choose_host
+from vmmanager.warm_pool import WarmPoolManager
+
+class Command(ManagementCommand):
+    help = 'Configure a warm pool of prepared virtual machines for an image, instance type and network.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', required=True, help='User ID the virtual machines are created as')
+        parser.add_argument('--image', required=True, help='Image ID, e.g. gmi-12345678')
+        parser.add_argument('--instance-type', required=True, help='Instance type, e.g. standard.small')
+        parser.add_argument('--network', required=True, help='Network profile the virtual machines are launched in')
+        parser.add_argument('--disk-size', default='10G', help='Disk size of the virtual machines')
+        parser.add_argument('--size', type=int, default=1, help='Number of virtual machines to keep ready. 0 empties the pool')
+        parser.add_argument('--ttl', type=int, help='Seconds a warm virtual machine is kept before it is replaced')
+
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(user_id=options['user'])
+            manager = WarmPoolManager()
+            pool = manager.create_pool(
+                user,
+                image_id = options['image'],
+                instance_def = InstanceDefinition(options['instance_type']),
+                network_profile = options['network'],
+                disk_size = options['disk_size'],
+                size = options['size'],
+                ttl = options['ttl'],
+            )
+            manager.queue_fill(pool.pool_id, choose_host())
+            self.stdout.write(self.style.SUCCESS(f'Configured warm pool {pool.pool_id} with {pool.size} virtual machines'))
+        except Exception as e:
+            self.stdout.write(str(e))
+            self.stderr.write('Error: There was an error while attempting to configure the warm pool.')
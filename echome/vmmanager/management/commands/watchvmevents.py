@@ -0,0 +1,49 @@
+import logging
+import libvirt
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from api.events import publish_event
+from vmmanager.models import VirtualMachine
+from vmmanager.vm_instance import domain_state_str
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Watch libvirt for virtual machine lifecycle events and publish them to event stream subscribers.'
+
+    def handle(self, *args, **options):
+        libvirt.virEventRegisterDefaultImpl()
+        conn = libvirt.openReadOnly('qemu:///system')
+        conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.lifecycle_event, None)
+        conn.setKeepAlive(5, 3)
+        self.stdout.write(self.style.SUCCESS('Watching for virtual machine lifecycle events'))
+
+        while conn.isAlive():
+            libvirt.virEventRunDefaultImpl()
+
+        self.stderr.write('Error: Lost connection to libvirt.')
+
+
+    def lifecycle_event(self, conn, dom, event, detail, opaque):
+        vm_id = dom.name()
+        close_old_connections()
+        try:
+            account_id = VirtualMachine.objects.values_list("account_id", flat=True).get(instance_id=vm_id)
+        except VirtualMachine.DoesNotExist:
+            logger.debug(f"Received event for unknown domain {vm_id}, ignoring")
+            return
+
+        try:
+            state_int, _ = dom.state()
+        except libvirt.libvirtError:
+            # The domain was undefined before we got to it
+            return
+
+        # Keeps DescribeVM current between reconciliations
+        VirtualMachine.objects.filter(instance_id=vm_id).update(
+            power_state=domain_state_str(state_int),
+            power_state_code=state_int,
+            last_modified=timezone.now(),
+        )
+        publish_event(account_id, "vm", vm_id, domain_state_str(state_int), libvirt_state=state_int)
@@ -0,0 +1,39 @@
+from prometheus_client import Histogram
+from prometheus_client.core import GaugeMetricFamily
+from django.db.models import Count
+from echome.metrics import CALL_BUCKETS
+
+libvirt_call_duration = Histogram(
+    "echome_libvirt_call_duration_seconds",
+    "Latency of libvirt operations",
+    ["call"],
+    buckets=CALL_BUCKETS,
+)
+
+launch_stage_duration = Histogram(
+    "echome_vm_launch_stage_duration_seconds",
+    "Time spent in each stage of launching a virtual machine",
+    # source is cold for VMs built on launch and warm for VMs claimed from a warm pool
+    ["stage", "source"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+
+
+def observe_launch(stage_times:dict, source:str):
+    for stage, seconds in stage_times.items():
+        launch_stage_duration.labels(stage, source).observe(seconds)
+
+
+class ResourceStateCollector:
+    """Number of virtual machines, volumes and images in each state, counted
+    from the database when metrics are scraped."""
+
+    def collect(self):
+        from .models import VirtualMachine, Volume, Image
+
+        for name, model in (("vms", VirtualMachine), ("volumes", Volume), ("images", Image)):
+            gauge = GaugeMetricFamily(f"echome_{name}", f"Number of {name} by state", labels=["state"])
+            counts = dict(model.objects.values_list("state").annotate(count=Count("pk")).order_by())
+            for state in model.State.values:
+                gauge.add_metric([state], counts.get(state, 0))
+            yield gauge
@@ -0,0 +1,38 @@
+# Generated by Django 4.0.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0001_initial'),
+        ('vmmanager', '0017_alter_image_state'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='virtualmachine',
+            name='state',
+            field=models.CharField(choices=[('CREATING', 'Creating'), ('AVAILABLE', 'Available'), ('TERMINATING', 'Terminating'), ('TERMINATED', 'Terminated'), ('ERROR', 'Error'), ('WARM', 'Warm')], default='CREATING', max_length=16),
+        ),
+        migrations.CreateModel(
+            name='WarmPool',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pool_id', models.CharField(db_index=True, max_length=20, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+                ('image_id', models.CharField(max_length=20)),
+                ('instance_type', models.CharField(max_length=40)),
+                ('instance_size', models.CharField(max_length=40)),
+                ('network_profile', models.CharField(max_length=40)),
+                ('disk_size', models.CharField(default='10G', max_length=10)),
+                ('size', models.PositiveIntegerField(default=1)),
+                ('tags', models.JSONField(default=dict)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='identity.account', to_field='account_id')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='identity.user', to_field='user_id')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0018_warmpool'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='warmpool',
+            name='ttl',
+            field=models.PositiveIntegerField(default=86400),
+        ),
+    ]
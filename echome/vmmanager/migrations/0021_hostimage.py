@@ -0,0 +1,30 @@
+# Generated by Django 4.0.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0020_imageblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HostImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=200)),
+                ('size', models.BigIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('last_used', models.DateTimeField(auto_now_add=True)),
+                ('state', models.CharField(choices=[('COPYING', 'Copying'), ('AVAILABLE', 'Available')], default='COPYING', max_length=16)),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='host_copies', to='vmmanager.imageblob', to_field='digest')),
+                ('host', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cached_images', to='vmmanager.hostmachine', to_field='host_id')),
+            ],
+            options={
+                'unique_together': {('host', 'blob')},
+            },
+        ),
+    ]
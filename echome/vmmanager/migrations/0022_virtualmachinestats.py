@@ -0,0 +1,28 @@
+# Generated by Django 4.0.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0021_hostimage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VirtualMachineStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.PositiveIntegerField()),
+                ('samples', models.JSONField(default=list)),
+                ('counters', models.JSONField(default=dict)),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+                ('virtual_machine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='vmmanager.virtualmachine', to_field='instance_id')),
+            ],
+            options={
+                'unique_together': {('virtual_machine', 'resolution')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.0.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0022_virtualmachinestats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='power_state',
+            field=models.CharField(max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='power_state_code',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='state_checked',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.0.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vmmanager', '0023_virtualmachine_power_state'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='hostimage',
+            name='blob',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='host_copies', to='vmmanager.imageblob', to_field='digest'),
+        ),
+    ]
@@ -55,6 +55,8 @@ class VirtualMachine(models.Model):
         TERMINATING = 'TERMINATING', 'Terminating'
         TERMINATED = 'TERMINATED', 'Terminated'
         ERROR = 'ERROR', 'Error'
+        # Prepared and defined, but not started, in a WarmPool
+        WARM = 'WARM', 'Warm'
 
     state = models.CharField(
         max_length=16,
@@ -62,6 +64,13 @@ class VirtualMachine(models.Model):
         default=State.CREATING,
     )
 
+    # State of the libvirt domain (vm_instance.DOMAIN_STATES), kept up to date by
+    # lifecycle events and the reconciler so it can be served without asking libvirt
+    power_state = models.CharField(max_length=16, null=True)
+    power_state_code = models.IntegerField(null=True)
+    # When the reconciler last compared this row with libvirt
+    state_checked = models.DateTimeField(null=True)
+
 
     def generate_id(self):
         if self.instance_id is None or self.instance_id == "":
@@ -79,6 +88,55 @@ class VirtualMachine(models.Model):
         return self.instance_id
 
 
+class VirtualMachineStats(models.Model):
+    """Resource usage history of a virtual machine at one resolution. Samples are kept
+    in a fixed-size ring buffer on this row instead of a row per sample (see vm_stats)."""
+    virtual_machine = models.ForeignKey(VirtualMachine, on_delete=models.CASCADE, to_field="instance_id", related_name="stats")
+    # Seconds each sample covers
+    resolution = models.PositiveIntegerField()
+    # Rows of vm_stats.FIELDS, oldest first
+    samples = models.JSONField(default=list)
+    # Counters read at the last collection, rates are computed from them
+    counters = models.JSONField(default=dict)
+    last_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("virtual_machine", "resolution")
+
+    def __str__(self) -> str:
+        return f"{self.virtual_machine_id}:{self.resolution}"
+
+
+class WarmPool(models.Model):
+    """Keeps `size` virtual machines ready to launch (disk cloned and resized, domain
+    defined but never started) for an image, instance type and network. Launches
+    with a matching configuration claim one of these instead of building from scratch."""
+    pool_id = models.CharField(max_length=20, unique=True, db_index=True)
+    account = models.ForeignKey("identity.Account", on_delete=models.CASCADE, to_field="account_id")
+    # User the warm virtual machines are built as
+    owner = models.ForeignKey("identity.User", on_delete=models.CASCADE, to_field="user_id")
+    created = models.DateTimeField(auto_now_add=True, null=False)
+    last_modified = models.DateTimeField(auto_now=True)
+    image_id = models.CharField(max_length=20)
+    instance_type = models.CharField(max_length=40)
+    instance_size = models.CharField(max_length=40)
+    network_profile = models.CharField(max_length=40)
+    disk_size = models.CharField(max_length=10, default="10G")
+    size = models.PositiveIntegerField(default=1)
+    # Seconds a warm virtual machine is kept before it's replaced with a fresh one
+    ttl = models.PositiveIntegerField(default=86400)
+    tags = models.JSONField(default=dict)
+
+    def generate_id(self):
+        if self.pool_id is None or self.pool_id == "":
+            self.pool_id = IdGenerator.generate("pool")
+        else:
+            raise AttemptedOverrideOfImmutableIdException
+
+    def __str__(self) -> str:
+        return self.pool_id
+
+
 class InstanceDefinition(models.Model):
     instance_definition_id = models.CharField(max_length=20, unique=True, db_index=True)
     created = models.DateTimeField(auto_now_add=True, null=False)
@@ -100,6 +158,54 @@ class OperatingSystem(models.TextChoices):
     OTHER = 'OTHER', 'Other'
     NONE = 'NONE', 'None'
 
+class ImageBlob(models.Model):
+    """Image data in the content-addressed image store (see image_store.ImageStore). Every
+    Image with the same content, and every volume created as an overlay of it, shares
+    one blob."""
+    # Chunked sha256 of the image's data
+    digest = models.CharField(max_length=64, unique=True, db_index=True)
+    path = models.CharField(max_length=200)
+    size = models.BigIntegerField()
+    format = models.CharField(max_length=12)
+    created = models.DateTimeField(auto_now_add=True, null=False)
+    # Bumped whenever the blob is stored again, so a blob that's about 
+    # to be referenced isn't garbage collected in the meantime.
+    last_modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return self.digest
+
+
+class HostImage(models.Model):
+    """A copy of an image store blob in a host's local image cache (see 
+    host_image_cache.HostImageCache)."""
+    host = models.ForeignKey(HostMachine, on_delete=models.CASCADE, to_field="host_id", related_name="cached_images")
+    # The cached file is only removed by its host, so a blob can't be collected
+    # while a host still has a copy of it (see HostImageCache.drop_unreferenced)
+    blob = models.ForeignKey(ImageBlob, on_delete=models.PROTECT, to_field="digest", related_name="host_copies")
+    path = models.CharField(max_length=200)
+    size = models.BigIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True, null=False)
+    # When a virtual machine was last launched from it, for LRU eviction
+    last_used = models.DateTimeField(auto_now_add=True)
+
+    class State(models.TextChoices):
+        COPYING = 'COPYING', 'Copying'
+        AVAILABLE = 'AVAILABLE', 'Available'
+
+    state = models.CharField(
+        max_length=16,
+        choices=State.choices,
+        default=State.COPYING,
+    )
+
+    class Meta:
+        unique_together = ("host", "blob")
+
+    def __str__(self) -> str:
+        return f"{self.host_id}:{self.blob_id}"
+
+
 # All images (disk images) derive from this model.
 # There's currently only two types:
 # GuestImage (gmi-): For ALL accounts/users on the server
@@ -122,6 +228,8 @@ class Image(models.Model):
     name = models.CharField(max_length=60)
     description = models.CharField(max_length=100)
 
+    blob = models.ForeignKey(ImageBlob, on_delete=models.PROTECT, to_field="digest", related_name="images", null=True)
+
     minimum_requirements = models.JSONField(default=dict)
     metadata = models.JSONField(default=dict)
     deactivated = models.BooleanField(default=False)
@@ -186,11 +294,12 @@ class Image(models.Model):
         obj = QemuImg().info(self.image_path)
         logger.debug(obj)
 
-        self.metadata = {
+        self.metadata.pop("progress", None)
+        self.metadata.update({
             "format": obj["format"],
             "actual-size": obj["actual-size"],
             "virtual-size": obj["virtual-size"]
-        }
+        })
 
 
     def __str__(self) -> str:
@@ -209,6 +318,8 @@ class Volume(models.Model):
     format = models.CharField(max_length=12, null=True)
     metadata = models.JSONField(default=dict)
     path = models.CharField(max_length=200)
+    # Image store blob the volume is an overlay of, if it is one
+    blob = models.ForeignKey(ImageBlob, on_delete=models.PROTECT, to_field="digest", related_name="volumes", null=True)
     tags = models.JSONField(default=dict)
 
     class State(models.TextChoices):
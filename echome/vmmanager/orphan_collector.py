@@ -0,0 +1,111 @@
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List
+from .models import VirtualMachine
+from .reconciler import find_orphans, live_references
+from .vm_instance import get_domain_states
+from .vm_manager import VM_ROOT_DIR
+
+logger = logging.getLogger(__name__)
+
+# Seconds between collections. The collection task is scheduled on this interval.
+ORPHAN_GC_INTERVAL = int(os.getenv("ORPHAN_GC_INTERVAL", "21600"))
+# Files are only collected once they haven't been modified for this many seconds.
+# This is longer than the reconciler's so a failed launch kept with
+# VM_CLEAN_UP_ON_FAIL=false can be looked at before it's collected.
+ORPHAN_GC_GRACE_PERIOD = int(os.getenv("ORPHAN_GC_GRACE_PERIOD", "86400"))
+# Bytes released per second, 0 for no limit. Large disks are truncated a chunk
+# at a time so the filesystem isn't asked to free gigabytes of extents at once.
+ORPHAN_GC_BYTES_PER_SECOND = int(os.getenv("ORPHAN_GC_BYTES_PER_SECOND", str(64 * 1024 * 1024)))
+ORPHAN_GC_CHUNK_SIZE = 256 * 1024 * 1024
+
+
+@dataclass
+class Orphan:
+    path: str
+    # Bytes allocated on disk, which is less than the file size for sparse disks
+    size: int
+    is_directory: bool
+
+
+def collect_orphans(dry_run:bool = False, root:Path = None, domains:Dict[str, int] = None) -> List[Orphan]:
+    """Delete the virtual machine directories and disks under root (VM_ROOT_DIR) that no
+    live virtual machine, volume or libvirt domain on this host uses. Returns what was
+    (or with dry_run, would have been) deleted."""
+    root = Path(root if root is not None else VM_ROOT_DIR)
+    domains = domains if domains is not None else get_domain_states()
+
+    live_vms, volume_paths = live_references()
+    directories, disks = find_orphans(root, live_vms | set(domains), volume_paths, ORPHAN_GC_GRACE_PERIOD)
+    orphans = [Orphan(str(path), allocated_size(path), True) for path in directories]
+    orphans += [Orphan(str(path), allocated_size(path), False) for path in disks]
+    if dry_run:
+        return orphans
+
+    collected = []
+    for orphan in orphans:
+        # Deleting everything can take a while, check the directory's still unused
+        vm_id = Path(orphan.path).name
+        if orphan.is_directory and VirtualMachine.objects.filter(instance_id=vm_id).exclude(
+                state__in=[VirtualMachine.State.ERROR, VirtualMachine.State.TERMINATED]).exists():
+            logger.debug(f"{vm_id} is in use again, keeping {orphan.path}")
+            continue
+
+        try:
+            if orphan.is_directory:
+                remove_directory(Path(orphan.path))
+            else:
+                remove_file(Path(orphan.path))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Unable to delete {orphan.path}: {e}")
+            continue
+
+        logger.debug(f"Collected {orphan.path} ({orphan.size} bytes)")
+        collected.append(orphan)
+
+    return collected
+
+
+def allocated_size(path:Path) -> int:
+    """Bytes allocated to a file, or to every file under a directory."""
+    if not path.is_dir():
+        return path.stat().st_blocks * 512
+    return sum(
+        os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+        for dirpath, _, names in os.walk(path) for name in names
+    )
+
+
+def remove_directory(path:Path, bytes_per_second:int = ORPHAN_GC_BYTES_PER_SECOND):
+    """Delete a directory, releasing the space of its files at bytes_per_second."""
+    for dirpath, _, names in os.walk(path):
+        for name in names:
+            file_path = Path(dirpath, name)
+            if not file_path.is_symlink():
+                remove_file(file_path, bytes_per_second)
+    shutil.rmtree(path)
+
+
+def remove_file(path:Path, bytes_per_second:int = ORPHAN_GC_BYTES_PER_SECOND):
+    """Delete a file, truncating it a chunk at a time and pausing in between so
+    its space is released at no more than bytes_per_second."""
+    stat = path.stat()
+    # Truncating a hard link would empty every other link to the file too
+    if bytes_per_second > 0 and stat.st_nlink == 1:
+        allocated = stat.st_blocks * 512
+        size = stat.st_size
+        while size > 0 and allocated > 0:
+            # Sparse files only take as long as the space they actually hold
+            chunk = min(ORPHAN_GC_CHUNK_SIZE, size)
+            size -= chunk
+            os.truncate(path, size)
+            released = allocated - path.stat().st_blocks * 512
+            allocated -= released
+            time.sleep(released / bytes_per_second)
+    path.unlink()
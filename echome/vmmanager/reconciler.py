@@ -0,0 +1,176 @@
+import logging
+import os
+import time
+from dataclasses import dataclass, field, asdict
+from datetime import timedelta
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+from django.db.models import Q
+from django.utils import timezone
+from api.events import publish_event
+from .host_image_cache import HOST_ID
+from .models import HostMachine, VirtualMachine, Volume
+from .vm_instance import get_domain_states, domain_state_str
+from .vm_manager import VM_ROOT_DIR
+
+logger = logging.getLogger(__name__)
+
+# Seconds between reconciliations. The reconcile task is scheduled on this interval.
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "120"))
+# Rows that are still being set up or torn down, and files that may still be
+# written, are left alone until they're this many seconds old.
+RECONCILE_GRACE_PERIOD = int(os.getenv("RECONCILE_GRACE_PERIOD", "900"))
+
+# Files in a virtual machine's directory that are disks
+DISK_SUFFIXES = (".qcow2", ".img", ".raw")
+
+# States of rows that should have a libvirt domain
+EXPECTS_DOMAIN = (VirtualMachine.State.AVAILABLE, VirtualMachine.State.WARM)
+IN_PROGRESS = (VirtualMachine.State.CREATING, VirtualMachine.State.TERMINATING)
+# Metadata key with the state a row had before the reconciler set it to ERROR, which
+# it's restored to when the domain recovers. Rows in ERROR for other reasons are left alone.
+ERROR_FROM = "error_from"
+
+
+@dataclass
+class ReconciliationReport:
+    host: str
+    checked: int = 0
+    # {"virtual_machine_id", "state", "power_state"} of each row that was changed
+    updated: List[dict] = field(default_factory=list)
+    # Rows whose domain no longer exists
+    missing_domains: List[str] = field(default_factory=list)
+    # Domains without a row
+    orphaned_domains: List[str] = field(default_factory=list)
+    # Directories and disks under VM_ROOT_DIR that no virtual machine or volume uses
+    orphaned_directories: List[str] = field(default_factory=list)
+    orphaned_disks: List[str] = field(default_factory=list)
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+def reconcile_host(host_id:str = HOST_ID) -> ReconciliationReport:
+    """Compare the virtual machines of this host with its libvirt domains, fetched with
+    a single bulk call, then update their state and report what's orphaned."""
+    report = reconcile(get_domain_states(), host_id)
+
+    logger.info(f"Reconciled {report.checked} VMs on {report.host or 'this host'}: {len(report.updated)} updated, "
+        f"{len(report.missing_domains)} missing domains, {len(report.orphaned_domains)} orphaned domains, "
+        f"{len(report.orphaned_directories)} orphaned directories, {len(report.orphaned_disks)} orphaned disks")
+    if host_id:
+        host = HostMachine.objects.filter(host_id=host_id).first()
+        if host:
+            host.metadata["reconciliation"] = {"time": int(time.time()), **report.as_dict()}
+            host.save(update_fields=["metadata"])
+    return report
+
+
+def reconcile(domains:Dict[str, int], host_id:str = None) -> ReconciliationReport:
+    """Update the rows of the virtual machines on a host from the state of its libvirt
+    domains (instance ID: libvirt state) and report what doesn't match up."""
+    now = timezone.now()
+    settled_before = now - timedelta(seconds=RECONCILE_GRACE_PERIOD)
+    report = ReconciliationReport(host=host_id or "")
+
+    vms = VirtualMachine.objects.all()
+    if host_id:
+        # Rows without a host could be on any host, they're only this host's if it has their domain
+        vms = vms.filter(Q(host_id=host_id) | Q(host__isnull=True, instance_id__in=list(domains)))
+
+    known = set()
+    changed = []
+    for vm in vms:
+        known.add(vm.instance_id)
+        report.checked += 1
+        before = (vm.state, vm.power_state)
+
+        if vm.instance_id in domains:
+            vm.power_state_code = domains[vm.instance_id]
+            vm.power_state = domain_state_str(vm.power_state_code)
+            if vm.power_state == "crashed":
+                if vm.state == VirtualMachine.State.AVAILABLE:
+                    set_error(vm)
+            elif vm.state == VirtualMachine.State.ERROR and ERROR_FROM in (vm.metadata or {}):
+                # Restarted or brought back outside of echome
+                vm.state = vm.metadata.pop(ERROR_FROM)
+        elif vm.state in EXPECTS_DOMAIN or (vm.state in IN_PROGRESS and vm.last_modified < settled_before):
+            # Destroyed outside of echome, or a launch or termination that died part way
+            report.missing_domains.append(vm.instance_id)
+            set_error(vm)
+            vm.power_state = None
+            vm.power_state_code = None
+
+        if (vm.state, vm.power_state) != before:
+            vm.last_modified = now
+            changed.append(vm)
+            report.updated.append({
+                "virtual_machine_id": vm.instance_id,
+                "state": vm.state,
+                "power_state": vm.power_state,
+            })
+
+    VirtualMachine.objects.bulk_update(changed, ["state", "power_state", "power_state_code", "metadata", "last_modified"])
+    # Not a change to the row, so last_modified (and the Describe ETag) is left alone
+    vms.filter(instance_id__in=known).update(state_checked=now)
+    for vm in changed:
+        publish_event(vm.account_id, "vm", vm.instance_id, vm.state, power_state=vm.power_state)
+
+    report.orphaned_domains = sorted(
+        name for name in domains
+        if name.startswith("vm-") and name not in known
+    )
+
+    live_vms, volume_paths = live_references()
+    directories, disks = find_orphans(Path(VM_ROOT_DIR), live_vms | set(domains), volume_paths)
+    report.orphaned_directories = [str(path) for path in directories]
+    report.orphaned_disks = [str(path) for path in disks]
+    return report
+
+
+def set_error(vm:VirtualMachine):
+    # A launch or termination that died isn't coming back
+    if vm.state in EXPECTS_DOMAIN:
+        vm.metadata = {**(vm.metadata or {}), ERROR_FROM: vm.state}
+    vm.state = VirtualMachine.State.ERROR
+
+
+def live_references() -> Tuple[Set[str], Set[str]]:
+    """Instance IDs of the virtual machines whose files are in use, and the paths of
+    the volumes that haven't been deleted. A failed or terminated virtual machine's
+    files are only in use while its domain exists, which callers check separately."""
+    vm_ids = set(VirtualMachine.objects.exclude(
+        state__in=[VirtualMachine.State.ERROR, VirtualMachine.State.TERMINATED]
+    ).values_list("instance_id", flat=True))
+    volume_paths = set(Volume.objects.exclude(state=Volume.State.DELETED).values_list("path", flat=True))
+    return vm_ids, volume_paths
+
+
+def find_orphans(root:Path, vm_ids:Set[str], volume_paths:Iterable[str],
+        grace_period:int = RECONCILE_GRACE_PERIOD) -> Tuple[List[Path], List[Path]]:
+    """Find the virtual machine directories (root/<account>/<instance ID>) under root that
+    don't belong to any of vm_ids or hold any of volume_paths, and the disks in the
+    remaining ones that aren't one of volume_paths. Anything modified within the grace
+    period is skipped."""
+    settled_before = time.time() - grace_period
+    volume_paths = {os.path.normpath(path) for path in volume_paths if path}
+    volume_dirs = {os.path.dirname(path) for path in volume_paths}
+    directories, disks = [], []
+
+    if not root.is_dir():
+        return directories, disks
+
+    for vm_dir in sorted(root.glob("*/vm-*")):
+        if not vm_dir.is_dir():
+            continue
+        if vm_dir.name not in vm_ids and os.path.normpath(vm_dir) not in volume_dirs:
+            if vm_dir.stat().st_mtime < settled_before:
+                directories.append(vm_dir)
+            continue
+
+        for disk in sorted(vm_dir.iterdir()):
+            if disk.suffix in DISK_SUFFIXES and disk.is_file() and os.path.normpath(disk) not in volume_paths \
+                    and disk.stat().st_mtime < settled_before:
+                disks.append(disk)
+
+    return directories, disks
@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from api.serializers import ValuesSerializer
 from .models import VirtualMachine, Volume, Image
   
 class VirtualMachineSerializer(serializers.ModelSerializer):
@@ -20,3 +21,19 @@ class ImageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Image
         exclude = ['id', 'account']
+
+
+
+class VirtualMachineValuesSerializer(ValuesSerializer):
+    model = VirtualMachine
+    exclude = VirtualMachineSerializer.Meta.exclude
+
+
+class VolumeValuesSerializer(ValuesSerializer):
+    model = Volume
+    exclude = VolumeSerializer.Meta.exclude
+
+
+class ImageValuesSerializer(ValuesSerializer):
+    model = Image
+    exclude = ImageSerializer.Meta.exclude
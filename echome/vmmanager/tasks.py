@@ -1,32 +1,165 @@
 import logging
 from celery import shared_task
+from api.idempotency import IdempotentTask
 from identity.models import User
 from .vm_manager import VmManager
 from .image_manager import ImageManager
+from .image_store import IMAGE_BLOB_GC_INTERVAL, ImageStore
+from .host_image_cache import HOST_ID, HostImageCache, host_queue, prefetch_popular
+from .models import WarmPool, HostMachine, Image, ImageBlob, VirtualMachine
+from .warm_pool import WarmPoolManager
+from .vm_stats import VM_STATS_INTERVAL, collect_vm_stats
+from .reconciler import RECONCILE_INTERVAL, reconcile_host
+from .orphan_collector import ORPHAN_GC_INTERVAL, collect_orphans
 
 logger = logging.getLogger(__name__)
 
 
-@shared_task
-def task_terminate_instance(vm_id:str, user_id:str):
+@shared_task(bind=True, base=IdempotentTask, idempotency_key="terminate:{vm_id}")
+def task_terminate_instance(self, vm_id:str, user_id:str):
     logger.debug(f"Received async task to terminate VM: {vm_id}")
     user = User.objects.get(user_id=user_id)
-    VmManager().terminate_instance(vm_id, user)
+    try:
+        VmManager().terminate_instance(vm_id, user)
+    except VirtualMachine.DoesNotExist:
+        logger.debug(f"{vm_id} was already terminated")
+    return {"virtual_machine_id": vm_id}
 
 
-@shared_task
-def task_create_image(vm_id:str, user_id:str, prepared_id:str):
+@shared_task(bind=True, base=IdempotentTask, idempotency_key="create-image:{prepared_id}")
+def task_create_image(self, vm_id:str, user_id:str, prepared_id:str, live:bool = False, quiesce:bool = False):
     logger.debug(f"Received async task to create disk image for: {vm_id}")
     user = User.objects.get(user_id=user_id)
     manager = ImageManager(prepared_id)
-    try:
-        VmManager().create_virtual_machine_image(vm_id, user, prepared_manager=manager)
-    except Exception as e:
+    if manager.image.state == Image.State.AVAILABLE:
+        logger.debug(f"{prepared_id} was already created")
+        return {"vmi_id": prepared_id}
+
+    def failed():
         logger.error("Image creation process from VM failed")
-        logger.error(e)
         manager.mark_image_as_failed()
 
+    with self.on_failure_of(failed):
+        return VmManager().create_virtual_machine_image(vm_id, user, prepared_manager=manager, live=live, quiesce=quiesce)
+
+
+@shared_task
+def task_fill_warm_pool(pool_id:str):
+    logger.debug(f"Received async task to fill warm pool: {pool_id}")
+    try:
+        pool = WarmPool.objects.get(pool_id=pool_id)
+    except WarmPool.DoesNotExist:
+        logger.debug(f"Warm pool {pool_id} no longer exists")
+        return
+
+    WarmPoolManager().fill(pool)
+
+
+@shared_task
+def task_maintain_warm_pools():
+    logger.debug("Received async task to maintain warm pools")
+    WarmPoolManager().maintain()
+
+
+@shared_task
+def task_drop_unreferenced_images(host_id:str = HOST_ID):
+    logger.debug(f"Received async task to remove unreferenced images from the image cache on {host_id}")
+    host = HostMachine.objects.get(host_id=host_id)
+    dropped = HostImageCache(host).drop_unreferenced()
+    logger.debug(f"Removed {len(dropped)} images from the image cache on {host_id}, {sum(entry.size for entry in dropped)} bytes")
+
+
+@shared_task
+def task_collect_image_blobs():
+    logger.debug("Received async task to collect unreferenced image blobs")
+    # Blobs still cached on a host are collected on the next run, after the host drops them
+    for host in HostMachine.objects.all():
+        task_drop_unreferenced_images.apply_async(args=[host.host_id], queue=host_queue(host), expires=IMAGE_BLOB_GC_INTERVAL)
+
+    collected = ImageStore().collect_garbage()
+    logger.debug(f"Collected {len(collected)} image blobs, {sum(blob.size for blob in collected)} bytes")
+
+
+@shared_task
+def task_store_image(image_id:str):
+    logger.debug(f"Received async task to add image {image_id} to the image store")
+    try:
+        image = Image.objects.get(image_id=image_id, blob__isnull=True)
+    except Image.DoesNotExist:
+        logger.debug(f"Image {image_id} is already in the image store or no longer exists")
+        return
+
+    blob = ImageStore().store_image(image)
+    logger.debug(f"Stored image {image_id} as {blob.digest}")
+
+
+@shared_task
+def task_prefetch_image(host_id:str, digest:str):
+    logger.debug(f"Received async task to cache image {digest} on {host_id}")
+    host = HostMachine.objects.get(host_id=host_id)
+    blob = ImageBlob.objects.get(digest=digest)
+    HostImageCache(host).fetch(blob)
+
+
+@shared_task
+def task_prefetch_popular_images():
+    logger.debug("Received async task to prefetch popular images")
+    images = prefetch_popular()
+    logger.debug(f"Prefetching {[image.image_id for image in images]}")
+
 
 @shared_task
-def task_create_vm(vm_id:str, user_id:str, prepared_id:str):
-    pass
+def task_collect_vm_stats():
+    sampled = collect_vm_stats()
+    logger.debug(f"Sampled resource usage of {sampled} VMs")
+
+
+@shared_task
+def task_collect_all_vm_stats():
+    logger.debug("Received async task to collect VM resource usage on every host")
+    hosts = list(HostMachine.objects.all())
+    if not hosts:
+        task_collect_vm_stats.delay()
+        return
+
+    # Samples are only useful when they're taken on time, drop the ones a host didn't get to
+    for host in hosts:
+        task_collect_vm_stats.apply_async(queue=host_queue(host), expires=VM_STATS_INTERVAL)
+
+
+@shared_task
+def task_reconcile_host(host_id:str = HOST_ID):
+    logger.debug(f"Received async task to reconcile VMs on {host_id or 'this host'}")
+    reconcile_host(host_id)
+
+
+@shared_task
+def task_reconcile_all_hosts():
+    logger.debug("Received async task to reconcile VMs on every host")
+    hosts = list(HostMachine.objects.all())
+    if not hosts:
+        task_reconcile_host.delay()
+        return
+
+    # The next run reconciles a host that didn't get to this one
+    for host in hosts:
+        task_reconcile_host.apply_async(args=[host.host_id], queue=host_queue(host), expires=RECONCILE_INTERVAL)
+
+
+@shared_task
+def task_collect_orphans():
+    logger.debug("Received async task to collect orphaned VM directories and disks")
+    collected = collect_orphans()
+    logger.info(f"Collected {len(collected)} orphaned VM directories and disks, {sum(orphan.size for orphan in collected)} bytes")
+
+
+@shared_task
+def task_collect_orphans_on_all_hosts():
+    logger.debug("Received async task to collect orphaned VM directories and disks on every host")
+    hosts = list(HostMachine.objects.all())
+    if not hosts:
+        task_collect_orphans.delay()
+        return
+
+    for host in hosts:
+        task_collect_orphans.apply_async(queue=host_queue(host), expires=ORPHAN_GC_INTERVAL)
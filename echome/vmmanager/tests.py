@@ -1,4 +1,23 @@
+import os
+import tempfile
+import time
+import libvirt
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 from django.test import TestCase
+from django.utils import timezone
+from identity.models import Account, User
+from .image_store import ImageStore, chunked_digest, copy_file, CHUNK_SIZE
+from .host_image_cache import HostImageCache, choose_host, prefetch
+from .instance_definitions import InstanceDefinition
+from .models import Image, ImageBlob, HostMachine, HostImage, Volume, VirtualMachine, VirtualMachineStats, WarmPool
+from .vm_stats import HOURLY, get_vm_stats, record_stats
+from .reconciler import RECONCILE_GRACE_PERIOD, find_orphans, reconcile
+from .orphan_collector import ORPHAN_GC_GRACE_PERIOD, collect_orphans, remove_file
+from .exceptions import ImagePrepError
+from .vm_manager import VmManager
+from .warm_pool import WarmPoolManager
 from .xml_generator import (
     KvmXmlNetworkInterface,
     KvmXmlObject, 
@@ -49,9 +68,561 @@ class TestKvmXmlObject(TestCase):
 
 
     def test_render_xml(self):
-        rendered_xml = '<domain type="kvm">\n <name>vm-12345678</name>\n <memory unit="MB">512M</memory>\n <vcpu>1</vcpu>\n <os>\n  <type arch="x86_64">hvm</type>\n  <boot dev="hd"/>\n </os>\n <features>\n  <acpi/>\n  <apic/>\n </features>\n <cpu mode="host-passthrough" match="exact"/>\n <clock offset="utc">\n  <timer name="rtc" tickpolicy="catchup"/>\n  <timer name="pit" tickpolicy="delay"/>\n  <timer name="hpet" present="no"/>\n </clock>\n <devices>\n  <emulator>/usr/bin/kvm-spice</emulator>\n  <console type="pty"/>\n  <disk type="file" device="disk">\n   <driver name="qemu" type="qcow2"/>\n   <source file="/test/directory/vm-12345678/vm-12345678.qcow2"/>\n   <alias name="vol-1234567890f"/>\n   <target dev="vda" bus="virtio"/>\n  </disk>\n  <interface type="bridge">\n   <source bridge="br0"/>\n  </interface>\n </devices>\n</domain>'
+        rendered_xml = '<domain type="kvm">\n <name>vm-12345678</name>\n <memory unit="MB">512M</memory>\n <vcpu>1</vcpu>\n <os>\n  <type arch="x86_64">hvm</type>\n  <boot dev="hd"/>\n </os>\n <features>\n  <acpi/>\n  <apic/>\n </features>\n <cpu mode="host-passthrough" match="exact"/>\n <clock offset="utc">\n  <timer name="rtc" tickpolicy="catchup"/>\n  <timer name="pit" tickpolicy="delay"/>\n  <timer name="hpet" present="no"/>\n </clock>\n <devices>\n  <emulator>/usr/bin/kvm-spice</emulator>\n  <console type="pty"/>\n  <disk type="file" device="disk">\n   <driver name="qemu" type="qcow2"/>\n   <source file="/test/directory/vm-12345678/vm-12345678.qcow2"/>\n   <alias name="vol-1234567890f"/>\n   <target dev="vda" bus="virtio"/>\n  </disk>\n  <interface type="bridge">\n   <source bridge="br0"/>\n  </interface>\n  <channel type="unix">\n   <target type="virtio" name="org.qemu.guest_agent.0"/>\n  </channel>\n </devices>\n</domain>'
         self.assertEqual(self.kvm_xml_object_instance.render_xml(), rendered_xml)
 
-        rendered_xml_with_removable_media = '<domain type="kvm">\n <name>vm-12345678</name>\n <memory unit="MB">512M</memory>\n <vcpu>1</vcpu>\n <os>\n  <type arch="x86_64">hvm</type>\n  <boot dev="hd"/>\n </os>\n <features>\n  <acpi/>\n  <apic/>\n </features>\n <cpu mode="host-passthrough" match="exact"/>\n <clock offset="utc">\n  <timer name="rtc" tickpolicy="catchup"/>\n  <timer name="pit" tickpolicy="delay"/>\n  <timer name="hpet" present="no"/>\n </clock>\n <devices>\n  <emulator>/usr/bin/kvm-spice</emulator>\n  <console type="pty"/>\n  <disk type="file" device="disk">\n   <driver name="qemu" type="qcow2"/>\n   <source file="/test/directory/vm-12345678/vm-12345678.qcow2"/>\n   <alias name="vol-1234567890f"/>\n   <target dev="vda" bus="virtio"/>\n  </disk>\n  <disk type="file" device="cdrom">\n   <driver name="qemu" type="raw"/>\n   <source file="/test/directory/iso/daft-punk-live.iso"/>\n   <alias name="hda"/>\n   <target dev="hda" bus="ide"/>\n   <readonly/>\n  </disk>\n  <interface type="bridge">\n   <source bridge="br0"/>\n  </interface>\n </devices>\n</domain>'
+        rendered_xml_with_removable_media = '<domain type="kvm">\n <name>vm-12345678</name>\n <memory unit="MB">512M</memory>\n <vcpu>1</vcpu>\n <os>\n  <type arch="x86_64">hvm</type>\n  <boot dev="hd"/>\n </os>\n <features>\n  <acpi/>\n  <apic/>\n </features>\n <cpu mode="host-passthrough" match="exact"/>\n <clock offset="utc">\n  <timer name="rtc" tickpolicy="catchup"/>\n  <timer name="pit" tickpolicy="delay"/>\n  <timer name="hpet" present="no"/>\n </clock>\n <devices>\n  <emulator>/usr/bin/kvm-spice</emulator>\n  <console type="pty"/>\n  <disk type="file" device="disk">\n   <driver name="qemu" type="qcow2"/>\n   <source file="/test/directory/vm-12345678/vm-12345678.qcow2"/>\n   <alias name="vol-1234567890f"/>\n   <target dev="vda" bus="virtio"/>\n  </disk>\n  <disk type="file" device="cdrom">\n   <driver name="qemu" type="raw"/>\n   <source file="/test/directory/iso/daft-punk-live.iso"/>\n   <alias name="hda"/>\n   <target dev="hda" bus="ide"/>\n   <readonly/>\n  </disk>\n  <interface type="bridge">\n   <source bridge="br0"/>\n  </interface>\n  <channel type="unix">\n   <target type="virtio" name="org.qemu.guest_agent.0"/>\n  </channel>\n </devices>\n</domain>'
         self.assertEqual(self.kvm_xml_object_instance_with_remov_media.render_xml(), rendered_xml_with_removable_media)
 
+
+class TestImageStore(TestCase):
+
+    def setUp(self):
+        self.store = ImageStore(root=tempfile.mkdtemp())
+
+
+    def make_blob(self, digest:str) -> ImageBlob:
+        blob = ImageBlob.objects.create(digest=digest, path=str(self.store.blob_path(digest, "qcow2")), size=1, format="qcow2")
+        ImageBlob.objects.filter(pk=blob.pk).update(last_modified=timezone.now() - timedelta(days=1))
+        return blob
+
+
+    def test_chunked_digest_depends_on_content_only(self):
+        paths = []
+        for _ in range(2):
+            fd, path = tempfile.mkstemp()
+            with os.fdopen(fd, "wb") as f:
+                f.write(b"a" * (CHUNK_SIZE + 10))
+            paths.append(path)
+
+        self.assertEqual(chunked_digest(paths[0]), chunked_digest(paths[1]))
+
+        with open(paths[1], "ab") as f:
+            f.write(b"b")
+        self.assertNotEqual(chunked_digest(paths[0]), chunked_digest(paths[1]))
+
+
+    def test_copies_are_not_linked(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"a" * 10)
+        copy = f"{path}.copy"
+        copy_file(path, copy)
+
+        with open(path, "ab") as f:
+            f.write(b"b")
+        with open(copy, "rb") as f:
+            self.assertEqual(f.read(), b"a" * 10)
+        self.assertEqual(os.stat(copy).st_nlink, 1)
+
+
+    def test_collects_only_unreferenced_blobs(self):
+        referenced = self.make_blob("a" * 64)
+        unreferenced = self.make_blob("b" * 64)
+        deleted = self.make_blob("c" * 64)
+
+        image = Image(image_id="gmi-00000001", image_path=referenced.path, blob=referenced)
+        image.save()
+        Image(image_id="gmi-00000002", image_path=deleted.path, blob=deleted, state=Image.State.DELETED).save()
+
+        self.assertEqual(
+            {blob.digest for blob in self.store.collect_garbage(dry_run=True)},
+            {unreferenced.digest, deleted.digest}
+        )
+        self.store.collect_garbage()
+        self.assertEqual(list(ImageBlob.objects.values_list("digest", flat=True)), [referenced.digest])
+
+
+    def test_keeps_blobs_cached_on_hosts(self):
+        blob = self.make_blob("a" * 64)
+        host = HostMachine(name="first", ip="127.0.0.1")
+        host.generate_id()
+        host.save()
+        HostImage.objects.create(host=host, blob=blob, path=f"/cache/{blob.digest}.qcow2", state=HostImage.State.AVAILABLE)
+
+        self.assertEqual(self.store.collect_garbage(), [])
+        self.assertTrue(HostImage.objects.filter(host=host, blob=blob).exists())
+
+
+class TestHostImageCache(TestCase):
+
+    def setUp(self):
+        self.hosts = []
+        for name in ["first", "second"]:
+            host = HostMachine(name=name, ip="127.0.0.1", metadata={"image_cache_size": 100})
+            host.generate_id()
+            host.save()
+            self.hosts.append(host)
+
+        self.blobs = [
+            ImageBlob.objects.create(digest=str(i) * 64, path=f"/store/{i}.qcow2", size=40, format="qcow2") 
+            for i in range(3)
+        ]
+
+
+    def cache(self, host:HostMachine, blob:ImageBlob, minutes_ago:int) -> HostImage:
+        return HostImage.objects.create(
+            host = host, 
+            blob = blob, 
+            path = f"/nonexistent/{blob.digest}.qcow2", 
+            size = blob.size,
+            state = HostImage.State.AVAILABLE,
+            last_used = timezone.now() - timedelta(minutes=minutes_ago),
+        )
+
+
+    def test_evicts_least_recently_used_first(self):
+        host = self.hosts[0]
+        for minutes_ago, blob in zip([5, 10, 1], self.blobs):
+            self.cache(host, blob, minutes_ago)
+
+        evicted = HostImageCache(host).evict()
+        self.assertEqual([entry.blob_id for entry in evicted], [self.blobs[1].digest])
+
+
+    def test_keeps_images_backing_overlay_volumes(self):
+        host = self.hosts[0]
+        for minutes_ago, blob in zip([5, 10, 1], self.blobs):
+            self.cache(host, blob, minutes_ago)
+
+        account = Account(name="test")
+        account.generate_id()
+        account.save()
+        volume = Volume(account=account, host=host, blob=self.blobs[1], path="/vm/disk.qcow2")
+        volume.generate_id()
+        volume.save()
+
+        evicted = HostImageCache(host).evict()
+        self.assertEqual([entry.blob_id for entry in evicted], [self.blobs[0].digest])
+
+
+    def test_drops_unreferenced_images(self):
+        host = self.hosts[0]
+        for blob in self.blobs:
+            self.cache(host, blob, 0)
+        ImageBlob.objects.filter(pk__in=[self.blobs[0].pk, self.blobs[1].pk]).update(last_modified=timezone.now() - timedelta(days=1))
+        Image(image_id="gmi-00000001", image_path=self.blobs[0].path, blob=self.blobs[0]).save()
+
+        with mock.patch("vmmanager.host_image_cache.HOST_ID", host.host_id):
+            dropped = HostImageCache(host).drop_unreferenced()
+        # blobs[2] was stored too recently to be collected
+        self.assertEqual([entry.blob_id for entry in dropped], [self.blobs[1].digest])
+        self.assertEqual(
+            set(HostImage.objects.filter(host=host).values_list("blob_id", flat=True)),
+            {self.blobs[0].digest, self.blobs[2].digest}
+        )
+
+
+    def test_launches_on_this_host(self):
+        self.cache(self.hosts[0], self.blobs[0], 0)
+        with mock.patch("vmmanager.host_image_cache.HOST_ID", self.hosts[1].host_id):
+            self.assertEqual(choose_host(), self.hosts[1])
+        with mock.patch("vmmanager.host_image_cache.HOST_ID", ""):
+            self.assertEqual(choose_host(), self.hosts[0])
+
+
+    @mock.patch("vmmanager.tasks.task_prefetch_image.apply_async")
+    def test_prefetch_needs_a_host_id(self, apply_async):
+        image = Image(image_id="gmi-00000001", image_path=self.blobs[0].path, blob=self.blobs[0])
+        with mock.patch("vmmanager.host_image_cache.HOST_ID", ""):
+            self.assertEqual(prefetch(image, self.hosts), [])
+        apply_async.assert_not_called()
+
+        with mock.patch("vmmanager.host_image_cache.HOST_ID", self.hosts[0].host_id):
+            self.assertEqual(prefetch(image, self.hosts), self.hosts)
+        self.assertEqual(apply_async.call_count, 2)
+
+
+
+class TestWarmPool(TestCase):
+
+    def setUp(self):
+        account = Account(name="test")
+        account.generate_id()
+        account.save()
+        self.user = User(account=account, username="test")
+        self.user.generate_id()
+        self.user.save()
+
+        self.hosts = []
+        for name in ["first", "second"]:
+            host = HostMachine(name=name, ip="127.0.0.1")
+            host.generate_id()
+            host.save()
+            self.hosts.append(host)
+
+        self.pool = WarmPool(account=account, owner=self.user, image_id="gmi-00000001", 
+            instance_type="standard", instance_size="small", network_profile="home-network", disk_size="10G")
+        self.pool.generate_id()
+        self.pool.save()
+        self.warm = VirtualMachine(account=account, key_name="", state=VirtualMachine.State.WARM, 
+            host=self.hosts[0], metadata={"warm_pool": self.pool.pool_id})
+        self.warm.generate_id()
+        self.warm.save()
+
+
+    @mock.patch.object(VmManager, "launch_warm_vm", return_value="vm-launched")
+    def test_create_vm_launches_a_claimed_warm_vm(self, launch_warm_vm):
+        vm_id = VmManager().create_vm(self.user, InstanceDefinition("standard", "small"), 
+            ImageId="gmi-00000001", NetworkProfile="home-network", DiskSize="10G")
+
+        self.assertEqual(vm_id, "vm-launched")
+        self.assertEqual(launch_warm_vm.call_args.args[1].instance_id, self.warm.instance_id)
+        self.warm.refresh_from_db()
+        self.assertEqual(self.warm.state, VirtualMachine.State.CREATING)
+        self.assertEqual(self.warm.metadata["claimed_from"], self.pool.pool_id)
+
+
+    def test_only_matching_launches_claim_warm_vms(self):
+        manager = WarmPoolManager()
+        instance_def = InstanceDefinition("standard", "small")
+
+        self.assertIsNone(manager.claim(self.user, instance_def, "gmi-00000001", "home-network", "20G"))
+        self.assertEqual(manager.claim(self.user, instance_def, "gmi-00000001", "home-network", "10G"), self.warm)
+        # The pool's only warm VM was claimed
+        self.assertIsNone(manager.claim(self.user, instance_def, "gmi-00000001", "home-network", "10G"))
+
+
+    @mock.patch("vmmanager.warm_pool.HOST_ID", "host")
+    @mock.patch("vmmanager.tasks.task_fill_warm_pool.apply_async")
+    def test_claims_warm_vms_on_this_host_only(self, apply_async):
+        manager = WarmPoolManager()
+        instance_def = InstanceDefinition("standard", "small")
+
+        with mock.patch("vmmanager.host_image_cache.HOST_ID", self.hosts[1].host_id):
+            self.assertIsNone(manager.claim(self.user, instance_def, "gmi-00000001", "home-network", "10G"))
+
+        with mock.patch("vmmanager.host_image_cache.HOST_ID", self.hosts[0].host_id), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(manager.claim(self.user, instance_def, "gmi-00000001", "home-network", "10G"), self.warm)
+        # The pool is refilled on the host the VM was claimed on
+        apply_async.assert_called_once_with((self.pool.pool_id,), queue=f"host.{self.hosts[0].host_id}")
+
+
+class TestImageCreation(TestCase):
+
+    @mock.patch("vmmanager.vm_manager.IMAGE_COMPRESSION", "zstd")
+    @mock.patch("vmmanager.vm_manager.VirtTools")
+    @mock.patch("vmmanager.vm_manager.QemuImg")
+    def test_pipelined_image_is_written_in_one_convert(self, QemuImg, VirtTools):
+        steps = []
+
+        def create_overlay(path, backing_path):
+            path.write_bytes(b"overlay")
+            steps.append(("create_overlay", path, backing_path))
+            return True
+
+        def convert(source, destination, output_format, **kwargs):
+            destination.write_bytes(b"image")
+            steps.append(("convert", source, destination, kwargs["compression"]))
+            return True
+
+        QemuImg.return_value.create_overlay.side_effect = create_overlay
+        QemuImg.return_value.convert.side_effect = convert
+        VirtTools.return_value.sysprep.side_effect = lambda path: steps.append(("sysprep", path)) or True
+
+        with tempfile.TemporaryDirectory() as root:
+            source = Path(root, "vm-00000001.qcow2")
+            image = Path(root, "vmi-00000001.qcow2")
+            overlay = Path(root, "vmi-00000001.sysprep.qcow2")
+            stage_times = {}
+
+            VmManager()._write_image("pipelined", source, image, mock.Mock(), stage_times)
+
+            self.assertEqual(steps, [
+                ("create_overlay", overlay, source),
+                ("sysprep", overlay),
+                ("convert", overlay, image, "zstd"),
+            ])
+            VirtTools.return_value.sparsify.assert_not_called()
+            self.assertFalse(overlay.exists())
+            self.assertEqual(set(stage_times), {"sysprep", "convert"})
+
+
+    def live_image(self, root:str, steps:list, metadata:dict = None, error:Exception = None):
+        """Create an image of a running instance with live=True, with the instance and
+        the image writing mocked. The steps taken are added to steps. Returns the
+        prepared image manager."""
+        account = Account(name="test")
+        account.generate_id()
+        account.save()
+        user = User(account=account, username="test")
+        user.generate_id()
+        user.save()
+
+        image_manager = mock.Mock()
+        image_manager.image.image_id = "vmi-00000001"
+        image_manager.image.metadata = metadata if metadata is not None else {}
+
+        def create_disk_snapshot(disk_path, overlay_path, quiesce=False):
+            overlay_path.write_bytes(b"overlay")
+            steps.append(("snapshot", disk_path.name, overlay_path.name))
+            return "vda"
+
+        def write_image(pipeline, source_path, image_path, image_manager, stage_times, force_share=False):
+            steps.append(("write", source_path.name, image_path.name, force_share))
+            if error:
+                raise error
+            return 0
+
+        with mock.patch("vmmanager.vm_manager.VM_ROOT_DIR", root), \
+                mock.patch("vmmanager.vm_manager.VirtualMachineInstance") as VirtualMachineInstance, \
+                mock.patch.object(VmManager, "_write_image", side_effect=write_image):
+            instance = VirtualMachineInstance.return_value
+            instance.get_vm_state.return_value = ("running", 1, 1)
+            instance.get_disk_target.return_value = "vdb"
+            instance.create_disk_snapshot.side_effect = create_disk_snapshot
+            instance.commit_disk_snapshot.side_effect = lambda target: steps.append(("commit", target))
+
+            vm_path = Path(root, account.account_id, "vm-00000001")
+            vm_path.mkdir(parents=True)
+            if "source_state" in image_manager.image.metadata:
+                Path(vm_path, "vm-00000001-vmi-00000001.overlay.qcow2").write_bytes(b"overlay")
+
+            try:
+                VmManager().create_virtual_machine_image("vm-00000001", user, prepared_manager=image_manager, live=True)
+            finally:
+                instance.stop.assert_not_called()
+                self.assertFalse(Path(vm_path, "vm-00000001-vmi-00000001.overlay.qcow2").exists())
+
+        return image_manager
+
+
+    def test_live_image_is_written_from_a_snapshot(self):
+        steps = []
+        with tempfile.TemporaryDirectory() as root:
+            image_manager = self.live_image(root, steps)
+
+        self.assertEqual(steps, [
+            ("snapshot", "vm-00000001.qcow2", "vm-00000001-vmi-00000001.overlay.qcow2"),
+            ("write", "vm-00000001.qcow2", "vmi-00000001.qcow2", True),
+            ("commit", "vda"),
+        ])
+        self.assertEqual(image_manager.image.metadata["source_state"], "running")
+        image_manager.finish_user_image.assert_called_once()
+
+
+    def test_live_image_snapshot_is_committed_when_writing_fails(self):
+        steps = []
+        with tempfile.TemporaryDirectory() as root:
+            with self.assertRaises(ImagePrepError):
+                self.live_image(root, steps, error=ImagePrepError("sysprep failed"))
+
+        self.assertEqual(steps, [
+            ("snapshot", "vm-00000001.qcow2", "vm-00000001-vmi-00000001.overlay.qcow2"),
+            ("write", "vm-00000001.qcow2", "vmi-00000001.qcow2", True),
+            ("commit", "vda"),
+        ])
+
+
+    def test_live_image_retry_merges_leftover_snapshot(self):
+        steps = []
+        with tempfile.TemporaryDirectory() as root:
+            self.live_image(root, steps, metadata={"source_state": "running"})
+
+        self.assertEqual(steps, [
+            ("commit", "vdb"),
+            ("snapshot", "vm-00000001.qcow2", "vm-00000001-vmi-00000001.overlay.qcow2"),
+            ("write", "vm-00000001.qcow2", "vmi-00000001.qcow2", True),
+            ("commit", "vda"),
+        ])
+
+
+class TestVmStats(TestCase):
+
+    def setUp(self):
+        account = Account(name="test")
+        account.generate_id()
+        account.save()
+        self.vm = VirtualMachine(account=account, key_name="")
+        self.vm.generate_id()
+        self.vm.save()
+
+
+    def counters(self, time:float, cpu_seconds:float, disk_read:int) -> dict:
+        return {
+            "time": time, 
+            "cpu_time": int(cpu_seconds * 1e9), 
+            "vcpus": 2, 
+            "memory_used": 2**30,
+            "disk_read": disk_read, 
+            "disk_write": 0, 
+            "net_rx": 0, 
+            "net_tx": 0,
+        }
+
+
+    def test_samples_are_rates_between_collections(self):
+        start = 36000
+        record_stats({self.vm.instance_id: self.counters(start, 0, 0)})
+        self.assertEqual(get_vm_stats(self.vm), [])
+
+        record_stats({self.vm.instance_id: self.counters(start + 60, 60, 6000)})
+        self.assertEqual(get_vm_stats(self.vm), [[start + 60, 50.0, 2**30, 100.0, 0, 0, 0]])
+
+
+    def test_samples_are_rolled_up_hourly(self):
+        start = 36000
+        for minute in range(62):
+            # Busier in the first hour
+            cpu = minute * 60 if minute <= 60 else 3600 + (minute - 60) * 30
+            record_stats({self.vm.instance_id: self.counters(start + minute * 60, cpu, 0)})
+
+        self.assertEqual(len(get_vm_stats(self.vm)), 61)
+        self.assertEqual(get_vm_stats(self.vm, HOURLY), [[start, 50.0, 2**30, 0, 0, 0, 0]])
+        self.assertEqual(VirtualMachineStats.objects.filter(virtual_machine=self.vm).count(), 2)
+
+
+class TestReconciler(TestCase):
+
+    def setUp(self):
+        self.account = Account(name="test")
+        self.account.generate_id()
+        self.account.save()
+
+
+    def create_vm(self, state:str) -> VirtualMachine:
+        vm = VirtualMachine(account=self.account, key_name="", state=state)
+        vm.generate_id()
+        vm.save()
+        return vm
+
+
+    def test_state_is_updated_from_domains(self):
+        running = self.create_vm(VirtualMachine.State.AVAILABLE)
+        crashed = self.create_vm(VirtualMachine.State.AVAILABLE)
+        missing = self.create_vm(VirtualMachine.State.AVAILABLE)
+        creating = self.create_vm(VirtualMachine.State.CREATING)
+
+        report = reconcile({
+            running.instance_id: libvirt.VIR_DOMAIN_RUNNING,
+            crashed.instance_id: libvirt.VIR_DOMAIN_CRASHED,
+            "vm-0123456789": libvirt.VIR_DOMAIN_RUNNING,
+        })
+
+        for vm in (running, crashed, missing, creating):
+            vm.refresh_from_db()
+            self.assertIsNotNone(vm.state_checked)
+        self.assertEqual((running.state, running.power_state), (VirtualMachine.State.AVAILABLE, "running"))
+        self.assertEqual((crashed.state, crashed.power_state), (VirtualMachine.State.ERROR, "crashed"))
+        self.assertEqual((missing.state, missing.power_state), (VirtualMachine.State.ERROR, None))
+        # Its domain may not have been defined yet
+        self.assertEqual(creating.state, VirtualMachine.State.CREATING)
+
+        self.assertEqual(report.checked, 4)
+        self.assertEqual(len(report.updated), 3)
+        self.assertEqual(report.missing_domains, [missing.instance_id])
+        self.assertEqual(report.orphaned_domains, ["vm-0123456789"])
+
+
+    def test_state_is_restored_when_the_domain_recovers(self):
+        crashed = self.create_vm(VirtualMachine.State.AVAILABLE)
+        missing = self.create_vm(VirtualMachine.State.WARM)
+        failed = self.create_vm(VirtualMachine.State.ERROR)
+        reconcile({crashed.instance_id: libvirt.VIR_DOMAIN_CRASHED})
+
+        report = reconcile({
+            crashed.instance_id: libvirt.VIR_DOMAIN_RUNNING,
+            missing.instance_id: libvirt.VIR_DOMAIN_SHUTOFF,
+            failed.instance_id: libvirt.VIR_DOMAIN_RUNNING,
+        })
+
+        for vm in (crashed, missing, failed):
+            vm.refresh_from_db()
+        self.assertEqual((crashed.state, crashed.power_state), (VirtualMachine.State.AVAILABLE, "running"))
+        self.assertEqual((missing.state, missing.power_state), (VirtualMachine.State.WARM, "shutoff"))
+        # Not set to ERROR by the reconciler
+        self.assertEqual(failed.state, VirtualMachine.State.ERROR)
+        self.assertEqual(len(report.updated), 3)
+
+
+    def test_rows_without_a_host_need_a_local_domain(self):
+        host = HostMachine(name="host", ip="127.0.0.1")
+        host.generate_id()
+        host.save()
+        local = self.create_vm(VirtualMachine.State.AVAILABLE)
+        elsewhere = self.create_vm(VirtualMachine.State.AVAILABLE)
+
+        report = reconcile({local.instance_id: libvirt.VIR_DOMAIN_RUNNING}, host.host_id)
+
+        elsewhere.refresh_from_db()
+        self.assertEqual(elsewhere.state, VirtualMachine.State.AVAILABLE)
+        self.assertEqual(report.checked, 1)
+        self.assertEqual(report.missing_domains, [])
+
+
+    def test_find_orphans(self):
+        with tempfile.TemporaryDirectory() as root:
+            old = timezone.now().timestamp() - RECONCILE_GRACE_PERIOD - 60
+            paths = {}
+            for name in ("live/disk.qcow2", "live/scratch.qcow2", "live/cloudinit.iso", "gone/disk.qcow2", "new/disk.qcow2"):
+                vm_id = "vm-" + name.split("/")[0]
+                path = os.path.join(root, "acct-test", vm_id, name.split("/")[1])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, "w").close()
+                paths[name] = path
+            for name in ("live", "gone"):
+                os.utime(os.path.join(root, "acct-test", f"vm-{name}"), (old, old))
+            for name in ("live/disk.qcow2", "live/scratch.qcow2"):
+                os.utime(paths[name], (old, old))
+
+            directories, disks = find_orphans(
+                Path(root), {"vm-live"}, [paths["live/disk.qcow2"]])
+
+            # vm-new is within the grace period
+            self.assertEqual(directories, [Path(root, "acct-test", "vm-gone")])
+            self.assertEqual(disks, [Path(paths["live/scratch.qcow2"])])
+
+
+class TestOrphanCollector(TestCase):
+
+    def setUp(self):
+        account = Account(name="test")
+        account.generate_id()
+        account.save()
+        self.vm = VirtualMachine(account=account, key_name="", state=VirtualMachine.State.AVAILABLE)
+        self.vm.generate_id()
+        self.vm.save()
+        self.failed = VirtualMachine(account=account, key_name="", state=VirtualMachine.State.ERROR)
+        self.failed.generate_id()
+        self.failed.save()
+
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        old = timezone.now().timestamp() - ORPHAN_GC_GRACE_PERIOD - 60
+        for vm in (self.vm, self.failed):
+            disk = os.path.join(self.root.name, account.account_id, vm.instance_id, f"{vm.instance_id}.qcow2")
+            os.makedirs(os.path.dirname(disk))
+            with open(disk, "wb") as f:
+                f.write(b"\1" * 8192)
+            os.utime(disk, (old, old))
+            os.utime(os.path.dirname(disk), (old, old))
+        self.failed_dir = os.path.dirname(disk)
+
+
+    def test_dry_run_reports_without_deleting(self):
+        orphans = collect_orphans(dry_run=True, root=self.root.name, domains={})
+        self.assertEqual([orphan.path for orphan in orphans], [self.failed_dir])
+        self.assertGreaterEqual(orphans[0].size, 8192)
+        self.assertTrue(os.path.exists(self.failed_dir))
+
+
+    def test_collects_directories_without_a_domain(self):
+        # Still defined, so it may be started again
+        self.assertEqual(collect_orphans(root=self.root.name, domains={self.failed.instance_id: 5}), [])
+
+        orphans = collect_orphans(root=self.root.name, domains={})
+        self.assertEqual([orphan.path for orphan in orphans], [self.failed_dir])
+        self.assertFalse(os.path.exists(self.failed_dir))
+        self.assertEqual(len(os.listdir(os.path.dirname(self.failed_dir))), 1)
+
+
+    def test_remove_file_is_rate_limited(self):
+        path = os.path.join(self.root.name, "disk.img")
+        with open(path, "wb") as f:
+            f.write(b"\1" * 64 * 1024)
+
+        started = time.monotonic()
+        remove_file(Path(path), bytes_per_second=256 * 1024)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertFalse(os.path.exists(path))
@@ -2,6 +2,7 @@ from django.urls import path
 from .views import (
     CreateVM,
     DescribeVM,
+    DescribeVMMetrics,
     TerminateVM,
     ModifyVM,
     CreateVolume,
@@ -18,6 +19,7 @@ app_name = 'vmmanager'
 urlpatterns = [
     path('vm/create', CreateVM.as_view()),
     path('vm/describe/<str:vm_id>', DescribeVM.as_view()),
+    path('vm/describe/<str:vm_id>/metrics', DescribeVMMetrics.as_view()),
     path('vm/terminate/<str:vm_id>', TerminateVM.as_view()),
     path('vm/modify/<str:vm_id>', ModifyVM.as_view()),
     path('volume/create', CreateVolume.as_view()),
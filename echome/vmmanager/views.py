@@ -1,15 +1,19 @@
 import logging
+import libvirt
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework import status
 from api.api_view import HelperView
+from api.async_view import AsyncAPIView, run_in_db_pool, run_in_libvirt_pool
 from .instance_definitions import InstanceDefinition, InvalidInstanceType
-from .models import VirtualMachine, Volume, Image
-from .serializers import VirtualMachineSerializer, VolumeSerializer, ImageSerializer
+from .models import VirtualMachine, Volume, Image, HostMachine
+from .serializers import VirtualMachineValuesSerializer, VolumeValuesSerializer, ImageValuesSerializer
 from .image_manager import ImageManager
 from .vm_manager import VmManager
 from .tasks import task_create_image, task_terminate_instance
-from .vm_instance import VirtualMachineInstance
+from .vm_instance import VirtualMachineInstance, domain_state_str
+from .host_image_cache import prefetch
+from .vm_stats import FIELDS, HOURLY, VM_STATS_INTERVAL, get_vm_stats
 from .exceptions import (
     InvalidLaunchConfiguration, 
     LaunchError,
@@ -96,32 +100,20 @@ class CreateVM(HelperView, APIView):
         return self.success_response({"virtual_machine_id": vm_id})
 
 
-class DescribeVM(HelperView, APIView):
+class DescribeVM(HelperView, AsyncAPIView):
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, vm_id:str):
-        i = []
-
+    async def get(self, request, vm_id:str):
         try:
-            if vm_id == "all":
-                vms = VirtualMachine.objects.filter(
-                    account=request.user.account
-                )
-            else:
-                vms = []
-                vms.append(VirtualMachine.objects.get(
-                    account=request.user.account,
-                    instance_id=vm_id
-                ))
-            
-            for vm in vms:
-                j_obj = VirtualMachineSerializer(vm).data
-                state, state_int, _  = VirtualMachineInstance(vm.instance_id).get_vm_state()
-                j_obj["state"] = {
-                    "code": state_int,
-                    "state": state,
-                }
-                i.append(j_obj)
+            vms = self.get_queryset(request.user, vm_id)
+
+            # The domain state is kept in the database by lifecycle events and the
+            # reconciler, so the rows are all there is to compare.
+            etag, last_modified = await run_in_db_pool(self.get_cache_validators, vms)
+            if not_modified := self.not_modified_response(request, etag, last_modified):
+                return not_modified
+
+            i = await run_in_db_pool(self.serialize_vms, vms, vm_id)
         except VirtualMachine.DoesNotExist as e:
             logger.debug(e)
             return self.not_found_response()
@@ -129,37 +121,100 @@ class DescribeVM(HelperView, APIView):
             logger.exception(e)
             return self.internal_server_error_response()
 
-        return self.success_response(i)
+        return self.set_cache_validators(self.success_response(i), etag, last_modified)
+
 
+    def get_queryset(self, user, vm_id:str):
+        vms = VirtualMachine.objects.filter(
+            account=user.account
+        ).exclude(state=VirtualMachine.State.WARM)
+        if vm_id != "all":
+            vms = vms.filter(instance_id=vm_id)
+        return vms
 
-class TerminateVM(HelperView, APIView):
+
+    def serialize_vms(self, vms, vm_id:str) -> list:
+        i = VirtualMachineValuesSerializer.serialize(vms)
+        if vm_id != "all" and not i:
+            raise VirtualMachine.DoesNotExist(f"VirtualMachine {vm_id} does not exist")
+
+        for j_obj in i:
+            code = j_obj.pop("power_state_code")
+            j_obj.pop("power_state")
+            # When the reconciler last looked at it, not part of the VM's description
+            j_obj.pop("state_checked")
+            j_obj["state"] = {
+                "code": code if code is not None else libvirt.VIR_DOMAIN_NOSTATE,
+                "state": domain_state_str(code) if code is not None else "unknown",
+            }
+        return i
+
+
+class DescribeVMMetrics(HelperView, APIView):
+    """Resource usage history of a virtual machine. Resolution is `recent` (samples
+    taken every VM_STATS_INTERVAL seconds over the last day) or `hourly` (hourly
+    averages over the last 30 days). Since limits the samples to the ones taken
+    at or after a unix timestamp."""
     permission_classes = [IsAuthenticated]
 
-    def post(self, request, vm_id:str):
+    resolutions = {
+        "recent": VM_STATS_INTERVAL,
+        "hourly": HOURLY,
+    }
+
+    def get(self, request, vm_id:str):
+        resolution = self.resolutions.get(request.GET.get("Resolution", "recent"))
+        if resolution is None:
+            return self.bad_request(f"Resolution must be one of: {', '.join(self.resolutions)}")
+
+        try:
+            since = int(request.GET.get("Since", 0))
+        except ValueError:
+            return self.bad_request("Since must be a unix timestamp.")
 
         try:
-            VirtualMachineInstance(vm_id)
+            vm = VirtualMachine.objects.get(account=request.user.account, instance_id=vm_id)
+        except VirtualMachine.DoesNotExist as e:
+            logger.debug(e)
+            return self.not_found_response()
+
+        samples = [sample for sample in get_vm_stats(vm, resolution) if sample[0] >= since]
+        return self.success_response({
+            "virtual_machine_id": vm_id,
+            "resolution": resolution,
+            "fields": FIELDS,
+            "samples": samples,
+        })
+
+
+class TerminateVM(HelperView, AsyncAPIView):
+    permission_classes = [IsAuthenticated]
+
+    async def post(self, request, vm_id:str):
+
+        try:
+            await run_in_libvirt_pool(VirtualMachineInstance, vm_id)
         except VirtualMachineDoesNotExist:
             return self.not_found_response()
 
         try:
-            task_terminate_instance.delay(vm_id, request.user.user_id)
+            task = await run_in_db_pool(task_terminate_instance.delay, vm_id, request.user.user_id)
         except Exception as e:
             logger.exception(e)
             return self.internal_server_error_response()
         
-        return self.request_success_response()
+        return self.request_success_response(task_id=task.id)
 
 
-class ModifyVM(HelperView, APIView):
+class ModifyVM(HelperView, AsyncAPIView):
     permission_classes = [IsAuthenticated]
 
-    def post(self, request, vm_id:str):
+    async def post(self, request, vm_id:str):
         if missing_params := self.require_parameters(request, ["Action"]):
             return self.missing_parameter_response(missing_params)
 
         try:
-            instance = VirtualMachineInstance(vm_id)
+            instance = await run_in_libvirt_pool(VirtualMachineInstance, vm_id)
         except VirtualMachineDoesNotExist:
             return self.not_found_response()
 
@@ -168,14 +223,14 @@ class ModifyVM(HelperView, APIView):
 
         if action == 'stop':
             try:
-                instance.stop(wait=False)
+                await run_in_libvirt_pool(instance.stop, wait=False)
             except Exception:
                 return self.internal_server_error_response()
         
             return self.success_response()
         elif action == 'start':
             try:
-                instance.start()
+                await run_in_libvirt_pool(instance.start)
             except VirtualMachineConfigurationError:
                 return self.error_response(
                     "Could not start VM due to configuration issue. See logs for more details.",
@@ -193,7 +248,8 @@ class ModifyVM(HelperView, APIView):
                 return self.missing_parameter_response(missing_params)
             
             image_manager = ImageManager()
-            new_vmi_id = image_manager.prepare_user_image(
+            new_vmi_id = await run_in_db_pool(
+                image_manager.prepare_user_image,
                 request.user,
                 request.POST["Name"],
                 request.POST["Description"],
@@ -201,13 +257,18 @@ class ModifyVM(HelperView, APIView):
             )
             logger.debug(f"New VMI ID: {new_vmi_id}")
             
-            task_create_image.delay(
+            # Live copies the disk of a running VM without stopping it,
+            # Quiesce also freezes its filesystems while the copy is started
+            task = await run_in_db_pool(
+                task_create_image.delay,
                 vm_id, 
                 request.user.user_id, 
-                prepared_id = new_vmi_id
+                prepared_id = new_vmi_id,
+                live = request.POST.get("Live") == "true",
+                quiesce = request.POST.get("Quiesce") == "true",
             )
 
-            return self.request_success_response(new_vmi_id)
+            return self.request_success_response(new_vmi_id, task_id=task.id)
         else:
             return self.bad_request("Unknown action")
         return self.success_response()
@@ -225,22 +286,20 @@ class DescribeVolume(HelperView, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, vol_id:str):
-        i = []
-
         try:
-            if vol_id == "all":
-                vols = Volume.objects.filter(
-                    account=request.user.account
-                )
-            else:
-                vols = []
-                vols.append(Volume.objects.get(
-                    account=request.user.account,
-                    volume_id=vol_id
-                ))
-            
-            for vol in vols:
-                i.append(VolumeSerializer(vol).data)
+            vols = Volume.objects.filter(
+                account=request.user.account
+            )
+            if vol_id != "all":
+                vols = vols.filter(volume_id=vol_id)
+
+            etag, last_modified = self.get_cache_validators(vols)
+            if not_modified := self.not_modified_response(request, etag, last_modified):
+                return not_modified
+
+            i = VolumeValuesSerializer.serialize(vols)
+            if vol_id != "all" and not i:
+                raise Volume.DoesNotExist(f"Volume {vol_id} does not exist")
         except Volume.DoesNotExist as e:
             logger.debug(e)
             return self.not_found_response()
@@ -248,7 +307,7 @@ class DescribeVolume(HelperView, APIView):
             logger.exception(e)
             return self.internal_server_error_response()
 
-        return self.success_response(i)
+        return self.set_cache_validators(self.success_response(i), etag, last_modified)
 
 
 class ModifyVolume(HelperView, APIView):
@@ -299,8 +358,6 @@ class DescribeImage(HelperView, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, img_type:str, img_id:str):
-        i = []
-
         if img_type not in ["guest", "user"]:
             return self.error_response(
                 "Unknown type",
@@ -309,34 +366,27 @@ class DescribeImage(HelperView, APIView):
         
         try:
             if img_type == "guest":
-                if img_id == "all":
-                    images = Image.objects.filter(
-                        image_type=Image.ImageType.GUEST
-                    )
-                else:
-                    images = []
-                    images.append(Image.objects.get(
-                        image_type=Image.ImageType.GUEST,
-                        image_id=img_id
-                    ))
+                images = Image.objects.filter(
+                    image_type=Image.ImageType.GUEST
+                )
             elif img_type == "user":
-                if img_id == "all":
-                    images = Image.objects.filter(
-                        image_type=Image.ImageType.USER,
-                        account=request.user.account,
-                    )
-                else:
-                    images = []
-                    images.append(Image.objects.get(
-                        image_type=Image.ImageType.USER,
-                        image_id=img_id,
-                        account=request.user.account,
-                    ))
+                images = Image.objects.filter(
+                    image_type=Image.ImageType.USER,
+                    account=request.user.account,
+                )
             else:
                 return self.bad_request("Image is type other than Guest or User")
-            
-            for image in images:
-                i.append(ImageSerializer(image).data)
+
+            if img_id != "all":
+                images = images.filter(image_id=img_id)
+
+            etag, last_modified = self.get_cache_validators(images)
+            if not_modified := self.not_modified_response(request, etag, last_modified):
+                return not_modified
+
+            i = ImageValuesSerializer.serialize(images)
+            if img_id != "all" and not i:
+                raise Image.DoesNotExist(f"Image {img_id} does not exist")
         except Image.DoesNotExist as e:
             logger.debug(e)
             return self.not_found_response()
@@ -344,8 +394,51 @@ class DescribeImage(HelperView, APIView):
             logger.exception(e)
             return self.internal_server_error_response()
 
-        return self.success_response(i)
+        return self.set_cache_validators(self.success_response(i), etag, last_modified)
 
 
 class ModifyImage(HelperView, APIView):
-    pass
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, img_type:str, img_id:str):
+        if img_type not in ["guest", "user"]:
+            return self.error_response(
+                "Unknown type",
+                status = status.HTTP_404_NOT_FOUND
+            )
+
+        if missing_params := self.require_parameters(request, ["Action"]):
+            return self.missing_parameter_response(missing_params)
+
+        images = Image.objects.filter(image_id=img_id, deactivated=False)
+        if img_type == "guest":
+            images = images.filter(image_type=Image.ImageType.GUEST)
+        else:
+            images = images.filter(image_type=Image.ImageType.USER, account=request.user.account)
+
+        image = images.first()
+        if image is None:
+            return self.not_found_response()
+
+        action = request.POST['Action'].lower()
+        logger.debug(f"Action: {action}")
+
+        if action == 'prefetch':
+            # Copy the image to the given hosts' image caches (or every host's)
+            # ahead of launching virtual machines from it there
+            hosts = None
+            if request.POST.get("HostIds"):
+                host_ids = self.unpack_comma_separated_list("HostIds", request.POST)
+                hosts = list(HostMachine.objects.filter(host_id__in=host_ids))
+                if len(hosts) != len(set(host_ids)):
+                    return self.bad_request("Unknown HostIds")
+
+            try:
+                queued = prefetch(image, hosts)
+            except Exception as e:
+                logger.exception(e)
+                return self.internal_server_error_response()
+
+            return self.success_response({"host_ids": [host.host_id for host in queued]})
+        else:
+            return self.bad_request("Unknown action")
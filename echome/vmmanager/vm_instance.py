@@ -1,16 +1,61 @@
 import libvirt
 import xmltodict
 import logging
+import threading
 import time
 from typing import List, Dict
+from echome.metrics import timed
+from echome.tracing import traced
 from network.models import VirtualNetwork
 from .models import Volume, VirtualMachine
 from .instance_definitions import InstanceDefinition
+from .metrics import libvirt_call_duration
 from .xml_generator import KvmXmlRemovableMedia, KvmXmlCore, KvmXmlDisk, KvmXmlNetworkInterface, KvmXmlObject, KvmXmlVncConfiguration
 from .exceptions import VirtualMachineDoesNotExist, VirtualMachineConfigurationError
 
 logger = logging.getLogger(__name__)
 
+_thread_local = threading.local()
+
+def get_libvirt_connection() -> libvirt.virConnect:
+    """Returns a libvirt connection for the current thread, opening a new one only
+    if this thread doesn't have one yet or the previous one was closed."""
+    conn = getattr(_thread_local, "libvirt_conn", None)
+    if conn is None or not conn.isAlive():
+        logger.debug("Opening new libvirt connection")
+        conn = libvirt.open('qemu:///system')
+        _thread_local.libvirt_conn = conn
+    return conn
+
+
+@timed(libvirt_call_duration, "all_domain_stats")
+def get_domain_states() -> Dict[str, int]:
+    """Returns the state of every domain on this host (name: libvirt state), fetched
+    with a single bulk libvirt call."""
+    conn = get_libvirt_connection()
+    return {
+        dom.name(): domain_stats.get("state.state", libvirt.VIR_DOMAIN_NOSTATE)
+        for dom, domain_stats in conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE)
+    }
+
+
+DOMAIN_STATES = {
+    libvirt.VIR_DOMAIN_NOSTATE: "no_state",
+    libvirt.VIR_DOMAIN_RUNNING: "running",
+    libvirt.VIR_DOMAIN_BLOCKED: "blocked",
+    libvirt.VIR_DOMAIN_PAUSED: "paused",
+    libvirt.VIR_DOMAIN_SHUTDOWN: "shutdown",
+    libvirt.VIR_DOMAIN_SHUTOFF: "shutoff",
+    libvirt.VIR_DOMAIN_CRASHED: "crashed",
+    # power management (entered into s3 state)
+    libvirt.VIR_DOMAIN_PMSUSPENDED: "pm_suspended",
+}
+
+def domain_state_str(state_int:int) -> str:
+    """Returns the name for a libvirt domain state, as used in API responses."""
+    return DOMAIN_STATES.get(state_int, "unknown")
+
+
 class VirtualMachineInstance():
     """Class responsible for creating, managing, and deleting virtual machine instances directly through the libvirt API"""
 
@@ -24,7 +69,7 @@ class VirtualMachineInstance():
     vnc: KvmXmlVncConfiguration = None
 
     def __init__(self, vm_id:str = None):
-        self.libvirt_conn = libvirt.open('qemu:///system')
+        self.libvirt_conn = get_libvirt_connection()
 
         self.virtual_disks = {}
         self.removable_media = []
@@ -116,6 +161,8 @@ class VirtualMachineInstance():
         )
 
 
+    @traced("libvirt.define")
+    @timed(libvirt_call_duration, "define")
     def define(self, vm_db:VirtualMachine):
         """Generate an XML document with the virtual machine specs and define it with libvirt"""
         self.check_components()
@@ -175,35 +222,21 @@ class VirtualMachineInstance():
         return self.get_state()
 
 
+    @timed(libvirt_call_duration, "get_state")
     def get_state(self):
         """Get the state of the virtual machine as defined in libvirt."""
         state_int, reason = self.virsh_domain.state()
 
-        if state_int == libvirt.VIR_DOMAIN_NOSTATE:
-            state_str = "no_state"
-        elif state_int == libvirt.VIR_DOMAIN_RUNNING:
-            state_str = "running"
-        elif state_int == libvirt.VIR_DOMAIN_BLOCKED:
-            state_str = "blocked"
-        elif state_int == libvirt.VIR_DOMAIN_PAUSED:
-            state_str = "paused"
-        elif state_int == libvirt.VIR_DOMAIN_SHUTDOWN:
-            state_str = "shutdown"
-        elif state_int == libvirt.VIR_DOMAIN_SHUTOFF:
-            state_str = "shutoff"
-        elif state_int == libvirt.VIR_DOMAIN_CRASHED:
-            state_str = "crashed"
-        elif state_int == libvirt.VIR_DOMAIN_PMSUSPENDED:
-            # power management (entered into s3 state)
-            state_str = "pm_suspended"
-        else:
-            state_str = "unknown"
+        state_str = domain_state_str(state_int)
+        if state_str == "unknown":
             state_int = 0
             reason = "Unknown state"
 
         return state_str, state_int, str(reason)
 
 
+    @traced("libvirt.start")
+    @timed(libvirt_call_duration, "start")
     def start(self):
         """Start an instance and set autostart to 1 for host reboots"""
         if self.virsh_domain.isActive():
@@ -221,6 +254,7 @@ class VirtualMachineInstance():
         self.virsh_domain.setAutostart(1)
             
 
+    @timed(libvirt_call_duration, "stop")
     def stop(self, wait:bool = True):
         """Stop an instance"""
 
@@ -262,11 +296,96 @@ class VirtualMachineInstance():
                     raise VirtualMachineError(e)
     
 
+    @timed(libvirt_call_duration, "undefine")
     def terminate(self):
         if self.virsh_domain:
             self.virsh_domain.undefine()
 
 
+    def get_disk_target(self, file_path:str) -> str:
+        """Returns the target device (e.g. vda) of the disk backed by file_path."""
+        xmldoc = xmltodict.parse(self.virsh_domain.XMLDesc(), force_list=('disk',))
+        for disk in xmldoc['domain']['devices'].get('disk', []):
+            if disk.get('source', {}).get('@file') == str(file_path):
+                return disk['target']['@dev']
+
+        raise VirtualMachineConfigurationError(f"No disk with source {file_path} is attached to {self.id}")
+
+
+    @timed(libvirt_call_duration, "create_disk_snapshot")
+    def create_disk_snapshot(self, file_path:str, overlay_path:str, quiesce:bool = False) -> str:
+        """Take an external snapshot of a running instance's disk without stopping it. 
+        Writes go to a new overlay at overlay_path from then on, so file_path stops 
+        changing and can be copied. Merge the overlay back with commit_disk_snapshot().
+
+        With quiesce, the guest's filesystems are frozen for the snapshot through the
+        qemu guest agent. If the agent isn't running, a crash consistent snapshot
+        is taken instead. Returns the target device of the disk."""
+        target_dev = self.get_disk_target(file_path)
+        snapshot_xml = xmltodict.unparse({
+            'domainsnapshot': {
+                'disks': {
+                    'disk': {
+                        '@name': target_dev,
+                        '@snapshot': 'external',
+                        'driver': {'@type': 'qcow2'},
+                        'source': {'@file': str(overlay_path)},
+                    }
+                }
+            }
+        }, full_document=False)
+
+        flags = libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY \
+            | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA \
+            | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
+
+        logger.debug(f"Creating external snapshot of {target_dev} on {self.id}: {overlay_path}")
+        if quiesce:
+            try:
+                self.virsh_domain.snapshotCreateXML(snapshot_xml, flags | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE)
+                return target_dev
+            except libvirt.libvirtError as e:
+                logger.warning(f"Unable to quiesce {self.id}, taking a crash consistent snapshot instead: {e}")
+
+        try:
+            self.virsh_domain.snapshotCreateXML(snapshot_xml, flags)
+        except libvirt.libvirtError as e:
+            raise VirtualMachineError(e)
+        return target_dev
+
+
+    @timed(libvirt_call_duration, "commit_disk_snapshot")
+    def commit_disk_snapshot(self, target_dev:str, timeout:int = 3600):
+        """Merge the overlay created by create_disk_snapshot() back into the original
+        disk while the instance keeps running, then switch the instance back to it.
+        The overlay file can be deleted afterwards."""
+        flags = libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE | libvirt.VIR_DOMAIN_BLOCK_COMMIT_SHALLOW
+        logger.debug(f"Committing snapshot of {target_dev} on {self.id}")
+        try:
+            self.virsh_domain.blockCommit(target_dev, None, None, 0, flags)
+        except libvirt.libvirtError as e:
+            raise VirtualMachineError(e)
+
+        # An active commit never finishes on its own. Once the overlay is merged it keeps
+        # mirroring writes until we pivot back to the original disk.
+        seconds_waited = 0
+        while True:
+            info = self.virsh_domain.blockJobInfo(target_dev, 0)
+            if not info:
+                raise VirtualMachineError(f"Commit of {target_dev} on {self.id} stopped before it completed")
+            if info['end'] > 0 and info['cur'] == info['end']:
+                break
+            if seconds_waited >= timeout:
+                self.virsh_domain.blockJobAbort(target_dev, 0)
+                raise VirtualMachineError(f"Timed out committing snapshot of {target_dev} on {self.id}")
+            time.sleep(1)
+            seconds_waited += 1
+
+        self.virsh_domain.blockJobAbort(target_dev, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+        logger.debug(f"Committed snapshot of {target_dev} on {self.id} after {seconds_waited} seconds")
+
+
+    @timed(libvirt_call_duration, "lookup")
     def __get_libvirt_domain(self, vm_id:str):
         """Returns a libvirt connection object if the VM exists
 
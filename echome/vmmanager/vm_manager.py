@@ -2,19 +2,27 @@ import logging
 import shutil
 import base64
 import os
+import time
+import libvirt
+from contextlib import contextmanager
 from pathlib import Path
 from echome.config import ecHomeConfig
+from echome.tracing import traced
+from api.events import publish_event
 from commander.qemuimg import QemuImg
 from commander.virt_tools import VirtTools
+from commander.engine import record_commands
 from identity.models import User
 from network.models import VirtualNetwork
 from network.manager import VirtualNetworkManager
 from keys.models import UserKey
 from .image_manager import ImageManager
-from .models import VirtualMachine, HostMachine, Volume, Image
+from .host_image_cache import HostImageCache, choose_host
+from .metrics import observe_launch
+from .models import VirtualMachine, Volume, Image, WarmPool
 from .instance_definitions import InstanceDefinition
 from .cloudinit import CloudInit, CloudInitFailedValidation, CloudInitIsoCreationError
-from .vm_instance import VirtualMachineInstance
+from .vm_instance import VirtualMachineInstance, domain_state_str
 from .exceptions import (
     LaunchError, 
     InvalidLaunchConfiguration, 
@@ -34,6 +42,17 @@ VM_ROOT_DIR = ecHomeConfig.VirtualMachines().user_dir
 # and files wasting space for non-functioning VMs
 CLEAN_UP_ON_FAIL = os.getenv("VM_CLEAN_UP_ON_FAIL", 'true').lower() == 'true'
 
+# How images are written out from a virtual machine's disk:
+# "pipelined" sysprep's an overlay on the disk, then writes the image in a single convert.
+# "three-pass" copies the disk, then sysprep's and sparsifies the copy in place.
+IMAGE_CREATION_PIPELINE = os.getenv("IMAGE_CREATION_PIPELINE", "pipelined")
+# Compression for images written by the pipelined flow: zlib, zstd (qemu 5.1+) or none
+IMAGE_COMPRESSION = os.getenv("IMAGE_COMPRESSION", "zlib")
+
+# Create virtual machine disks as qcow2 overlays of their image in the image store
+# instead of full copies. The image's blob is kept for as long as the disk exists.
+VM_DISK_OVERLAYS = os.getenv("VM_DISK_OVERLAYS", 'false').lower() == 'true'
+
 # Flow for VM Creation
 # 1. Generate a VM Id
 # 2. Generate the cloudinit config
@@ -49,6 +68,7 @@ class VmManager:
     vm_db:VirtualMachine = None
     instance:VirtualMachineInstance = None
 
+    @traced("vm.create")
     def create_vm(self, user: User, instance_def:InstanceDefinition, **kwargs):
         """Create a virtual machine
         This function does not create the VM but instead passes all of the arguments to the internal
@@ -90,6 +110,20 @@ class VmManager:
         
         self.user = user
 
+        # Launch from a warm pool if there's a prepared VM for this configuration.
+        # Warm VMs are defined without VNC or EFI boot.
+        if kwargs.get("EnableVnc") not in (True, "true") and kwargs.get("EfiBoot") != "true":
+            from .warm_pool import WarmPoolManager
+            warm_vm = WarmPoolManager().claim(
+                user, 
+                instance_def, 
+                kwargs["ImageId"], 
+                kwargs.get("NetworkProfile"), 
+                kwargs.get("DiskSize")
+            )
+            if warm_vm:
+                return self.launch_warm_vm(user, warm_vm, **kwargs)
+
         # Create our VirtualMachine Database object
         instance_id = self.prepare_vm_db(user, instance_def, kwargs["Tags"] if "Tags" in kwargs else {})
 
@@ -127,23 +161,61 @@ class VmManager:
         
         # Determine host to run this VM on:
         try:
-            hosts = HostMachine.objects.all()
-            # TODO: Allow setting the host (or picking one that fits)
-        # When we can add multiple servers
-            self.vm_db.host = hosts[0]
+            self.vm_db.host = choose_host()
         except Exception as e:
             logger.exception(e)
             raise 
             
         # Prepare some variables
-        private_ip:str  = kwargs["PrivateIp"] if "PrivateIp" in kwargs else None
-        key_name:str    = kwargs["KeyName"] if "KeyName" in kwargs else None
         enable_vnc:bool = True if "EnableVnc" in kwargs and kwargs["EnableVnc"] == "true" else False
         vnc_port:str    = kwargs["VncPort"] if "VncPort" in kwargs else None
         efi_boot:bool   = True if "EfiBoot" in kwargs and kwargs["EfiBoot"] == "true" else False
 
-        # Prepare our boot disk image and save the metadata to the DB
-        self.vm_db.image_metadata = self.prepare_disk(kwargs["ImageId"], kwargs["DiskSize"])
+        stage_times = {}
+        # The tools run to prepare the VM are recorded in its metadata
+        with record_commands() as commands:
+            # Prepare our boot disk image and save the metadata to the DB
+            with self._timed(stage_times, "disk"):
+                self.vm_db.image_metadata = self.prepare_disk(kwargs["ImageId"], kwargs["DiskSize"])
+
+            # Networking, SSH keys, user data and metadata for cloud-init
+            with self._timed(stage_times, "cloudinit"):
+                cloudinit_iso_path = self.prepare_cloudinit(**kwargs)
+            
+        if cloudinit_iso_path:
+            self.instance.add_removable_media(cloudinit_iso_path, "hdb")
+    
+        # VNC?
+        metadata = {}
+        if enable_vnc:
+            metadata += self.configure_vnc(vnc_port)
+            
+        # Generate the virtual machine XML document and (try to) launch our VM!
+        self.instance.configure_core(instance_def, efi_boot)
+        with self._timed(stage_times, "define"):
+            self.instance.define(self.vm_db)
+        with self._timed(stage_times, "start"):
+            self.instance.start()
+        observe_launch(stage_times, "cold")
+
+        # Add the information for this VM in the db
+        metadata["commands"] = commands
+        metadata["stages"] = stage_times
+        self.vm_db.storage = {}
+        self.vm_db.metadata = metadata
+        self.finish_vm_db()
+
+        logger.debug(f"Successfully created VM: {self.vm_db.instance_id} : {self.vm_dir}")
+        return self.vm_db.instance_id
+
+
+    @traced("vm.prepare_cloudinit")
+    def prepare_cloudinit(self, **kwargs) -> str:
+        """Generates the cloud-init network config, user data and metadata for this virtual
+        machine and writes the cloud-init ISO. Takes the same kwargs as create_vm().
+        Returns the path to the ISO."""
+        private_ip:str  = kwargs["PrivateIp"] if "PrivateIp" in kwargs else None
+        key_name:str    = kwargs["KeyName"] if "KeyName" in kwargs else None
 
         # initialize our CloudInit object
         self.cloudinit = CloudInit(base_dir=self.vm_dir)
@@ -176,34 +248,103 @@ class VmManager:
 
         # Validate and create the cloudinit iso
         try:
-            cloudinit_iso_path = self.cloudinit.create_iso()
+            return self.cloudinit.create_iso()
         except CloudInitFailedValidation as e:
             logger.exception(e)
             raise VirtualMachineConfigurationError
         except CloudInitIsoCreationError as e:
             logger.exception(e)
             raise VirtualMachineConfigurationError
-            
-        if cloudinit_iso_path:
-            self.instance.add_removable_media(cloudinit_iso_path, "hdb")
-    
-        # VNC?
-        metadata = {}
-        if enable_vnc:
-            metadata += self.configure_vnc(vnc_port)
-            
-        # Generate the virtual machine XML document and (try to) launch our VM!
-        self.instance.configure_core(instance_def, efi_boot)
-        self.instance.define(self.vm_db)
-        self.instance.start()
 
-        # Add the information for this VM in the db
-        self.vm_db.storage = {}
-        self.vm_db.metadata = metadata
-        self.finish_vm_db()
 
-        logger.debug(f"Successfully created VM: {self.vm_db.instance_id} : {self.vm_dir}")
-        return self.vm_db.instance_id
+    @traced("vm.create_warm")
+    def create_warm_vm(self, pool:WarmPool) -> str:
+        """Prepare a virtual machine for a warm pool. The disk is copied and resized and the
+        domain is defined, but it's not started. Launch it with launch_warm_vm()."""
+        user = pool.owner
+        instance_def = InstanceDefinition(pool.instance_type, pool.instance_size)
+        self.user = user
+
+        instance_id = self.prepare_vm_db(user, instance_def)
+        self.vm_dir = self.__generate_vm_path(user.account, instance_id)
+        self.vm_db.path = self.vm_dir
+        # Marked as part of the pool right away so it's counted while it's being built
+        self.vm_db.metadata = {"warm_pool": pool.pool_id}
+        self.vm_db.save()
+
+        try:
+            self.instance = VirtualMachineInstance()
+            self.vm_db.host = choose_host()
+            with record_commands() as commands:
+                self.vm_db.image_metadata = self.prepare_disk(pool.image_id, pool.disk_size)
+
+            try:
+                vnet = VirtualNetwork.objects.get(name=pool.network_profile, account=user.account)
+            except VirtualNetwork.DoesNotExist:
+                raise InvalidLaunchConfiguration("Provided NetworkProfile does not exist.")
+            self.instance.configure_network(vnet)
+
+            # cloud-init only runs on first boot, so the ISO with the instance's
+            # configuration is written to this path when it's launched.
+            self.instance.add_removable_media(f"{self.vm_dir}/cloudinit.iso", "hdb")
+
+            self.instance.configure_core(instance_def)
+            self.instance.define(self.vm_db)
+
+            self.vm_db.storage = {}
+            self.vm_db.metadata["commands"] = commands
+            self.vm_db.state = VirtualMachine.State.WARM
+            self.vm_db.power_state_code = libvirt.VIR_DOMAIN_SHUTOFF
+            self.vm_db.power_state = domain_state_str(self.vm_db.power_state_code)
+            self.vm_db.save()
+        except Exception as e:
+            logger.exception(f"Unable to prepare warm virtual machine: {e}")
+            # Kept when VM_CLEAN_UP_ON_FAIL is off, it mustn't count towards the pool's size
+            self.vm_db.state = VirtualMachine.State.ERROR
+            self.vm_db.save()
+            self._clean_up(user, instance_id)
+            raise
+        finally:
+            self._del_objects()
+
+        logger.debug(f"Prepared warm VM {instance_id} for pool {pool.pool_id}")
+        return instance_id
+
+
+    @traced("vm.launch_warm")
+    def launch_warm_vm(self, user:User, vm_db:VirtualMachine, **kwargs) -> str:
+        """Launch a virtual machine claimed from a warm pool. Takes the same kwargs as create_vm();
+        ImageId, DiskSize and the instance definition were already set by the pool."""
+        self.user = user
+        self.vm_db = vm_db
+        self.vm_dir = vm_db.path
+
+        try:
+            self.instance = VirtualMachineInstance(vm_db.instance_id)
+            self.vm_db.tags = kwargs["Tags"] if "Tags" in kwargs else {}
+            stage_times = {}
+            with record_commands() as commands, self._timed(stage_times, "cloudinit"):
+                self.prepare_cloudinit(**kwargs)
+            with self._timed(stage_times, "start"):
+                self.instance.start()
+            observe_launch(stage_times, "warm")
+
+            # Recorded along with the ones run when it was prepared for the pool
+            self.vm_db.metadata = {
+                "commands": vm_db.metadata.get("commands", []) + commands,
+                "stages": stage_times,
+            }
+            self.finish_vm_db()
+        except Exception as e:
+            logger.exception(f"Unable to launch warm virtual machine {vm_db.instance_id}: {e}")
+            self.vm_db.state = VirtualMachine.State.ERROR
+            self.vm_db.save()
+            raise LaunchError(f"Unable to launch warm virtual machine {vm_db.instance_id}")
+        finally:
+            self._del_objects()
+
+        logger.debug(f"Launched warm VM: {vm_db.instance_id}")
+        return vm_db.instance_id
 
 
     def configure_vnc(self, vnc_port:str = None) -> dict:
@@ -224,6 +365,7 @@ class VmManager:
         }
 
 
+    @traced("vm.prepare_disk")
     def prepare_disk(self, image_id:str, disk_size:str = "10G") -> dict:
         """Given an image ID and disk size, will prepare a virtual disk for the VM."""
         # Get the image from the image id:
@@ -234,8 +376,13 @@ class VmManager:
         except ImageDoesNotExistError:
             raise
         
-        # Copy our image to the destination directory
-        image_iso_path = img_mgr.copy_image(image, Path(self.vm_dir), self.vm_db.instance_id)
+        # Copy our image to the destination directory, from the host's image cache if it has it
+        source_path = HostImageCache(self.vm_db.host).path_for(image)
+        overlay = VM_DISK_OVERLAYS and image.blob_id is not None
+        if overlay:
+            image_iso_path = img_mgr.overlay_image(image, Path(self.vm_dir), self.vm_db.instance_id, source_path)
+        else:
+            image_iso_path = img_mgr.copy_image(image, Path(self.vm_dir), self.vm_db.instance_id, source_path)
 
         new_vol = Volume(
             account=self.user.account,
@@ -245,6 +392,9 @@ class VmManager:
         )
         new_vol.generate_id()
         new_vol.new_volume_from_image(image)
+        if overlay:
+            new_vol.blob = image.blob
+            new_vol.format = "qcow2"
         new_vol.save()
 
         # resize our disk
@@ -270,6 +420,7 @@ class VmManager:
         }
 
 
+    @traced("vm.prepare_network_interface")
     def prepare_network_interface(self, network_name:str, private_ip:str = None) -> dict:
         """Networking
         For VMs launched with BridgeToLan, we'll need to create a cloudinit
@@ -308,6 +459,7 @@ class VmManager:
         }
 
 
+    @traced("vm.prepare_ssh_keys")
     def prepare_ssh_keys(self, key_name:str):
         """Adds SSH keys to the virtual machine"""
         logger.debug(f"Checking KeyName: {key_name}.")
@@ -329,10 +481,24 @@ class VmManager:
             raise VirtualMachineDoesNotExist
 
 
+    @traced("image.create")
     def create_virtual_machine_image(self, 
             vm_id:str, user:User, name:str = None, description:str = None, 
-            tags:dict = None, prepared_manager:ImageManager = None, terminate_after_creation = False):
-        """Create a virtual machine image to create new virtual machines from."""
+            tags:dict = None, prepared_manager:ImageManager = None, terminate_after_creation = False,
+            stage_times:dict = None, live:bool = False, quiesce:bool = False, pipeline:str = None):
+        """Create a virtual machine image to create new virtual machines from.
+
+        The instance is stopped while its disk is copied and started again afterwards.
+        With live, a running instance keeps running instead: its disk is copied from an
+        external snapshot that is merged back once the copy is done. quiesce freezes the
+        guest's filesystems for the snapshot if it runs the qemu guest agent.
+
+        pipeline overrides IMAGE_CREATION_PIPELINE. How long each stage took and the bytes
+        written are recorded in the image's metadata under `creation`, and added to 
+        stage_times if it's given."""
+        if stage_times is None:
+            stage_times = {}
+        pipeline = pipeline if pipeline else IMAGE_CREATION_PIPELINE
 
         logger.debug(f"Creating VMI from {vm_id}")
 
@@ -344,47 +510,166 @@ class VmManager:
             image_manager = prepared_manager
             new_vmi_id = image_manager.image.image_id
 
-
-        # Stop the instance (we can't copy a live machine, yet)
         instance = VirtualMachineInstance(vm_id)
-        # But first, get the current state so we can start it back up if it was on before.
-        before_state, _, _ = instance.get_vm_state()
+        # Get the current state so we can start it back up if it was on before. A retry
+        # of an attempt that stopped the instance uses the state from before that.
+        before_state = image_manager.image.metadata.get("source_state")
+        if before_state is None:
+            before_state, _, _ = instance.get_vm_state()
+            image_manager.image.metadata["source_state"] = before_state
+            image_manager.image.save(update_fields=["metadata", "last_modified"])
         logger.debug(f"Previous VM state: {before_state}")
-        instance.stop()
+        live = live and before_state == "running" and not terminate_after_creation
+        restart = before_state == "running" and not terminate_after_creation
 
         # Define the path to the account vmi directory & create it if doesn't exist
         user_vmi_dir = self.__return_account_user_images_path(user.account)
         logger.debug(f"User_vmi_dir: {user_vmi_dir}")
 
-        current_image_full_path = self.__return_vm_path(user.account, vm_id) / f"{vm_id}.qcow2"
+        vm_path = self.__return_vm_path(user.account, vm_id)
+        current_image_full_path = vm_path / f"{vm_id}.qcow2"
         logger.debug(f"Current image full path: {current_image_full_path}")
         new_image_full_path = user_vmi_dir / f"{new_vmi_id}.qcow2"
         logger.debug(f"New image full path: {new_image_full_path}")
 
-        # Copy the image to the new VM directory
-        if not QemuImg().convert(current_image_full_path, new_image_full_path, 'qcow2'):
-            raise ImagePrepError("Failed copying image with QemuImg() convert")
+        # The tools run for the image are recorded with it
+        with record_commands() as commands:
+            started = time.monotonic()
+            bytes_written = 0
+
+            if live:
+                overlay_path = vm_path / f"{vm_id}-{new_vmi_id}.overlay.qcow2"
+                if overlay_path.exists():
+                    # An earlier attempt died, possibly with the instance writing to its overlay
+                    try:
+                        previous_target = instance.get_disk_target(overlay_path)
+                        logger.debug(f"Merging the snapshot left by an earlier attempt: {overlay_path}")
+                        instance.commit_disk_snapshot(previous_target)
+                    except VirtualMachineConfigurationError:
+                        pass
+                    overlay_path.unlink(missing_ok=True)
+
+                image_manager.set_progress("snapshot")
+                with self._timed(stage_times, "snapshot"):
+                    target_dev = instance.create_disk_snapshot(current_image_full_path, overlay_path, quiesce=quiesce)
+
+                # The instance now writes to the overlay, the original disk is left as it is
+                # until the snapshot is committed.
+                try:
+                    bytes_written += self._write_image(
+                        pipeline, current_image_full_path, new_image_full_path, image_manager, stage_times, force_share=True)
+                finally:
+                    with self._timed(stage_times, "commit"):
+                        instance.commit_disk_snapshot(target_dev)
+                        overlay_path.unlink(missing_ok=True)
+            else:
+                image_manager.set_progress("stop")
+                with self._timed(stage_times, "stop"):
+                    instance.stop()
+
+                source_path = current_image_full_path
+                if restart:
+                    # Copy the disk so the instance can be started again while the image is prepared.
+                    # The three-pass flow prepares the copy in place.
+                    if pipeline == "three-pass":
+                        source_path = new_image_full_path
+                    else:
+                        source_path = user_vmi_dir / f"{new_vmi_id}.capture.qcow2"
+
+                    image_manager.set_progress("copy")
+                    with self._timed(stage_times, "copy"):
+                        if not QemuImg().convert(current_image_full_path, source_path, 'qcow2'):
+                            raise ImagePrepError("Failed copying image with QemuImg() convert")
+                    bytes_written += self._allocated_bytes(source_path)
+                    instance.start()
+
+                try:
+                    bytes_written += self._write_image(
+                        pipeline, source_path, new_image_full_path, image_manager, stage_times)
+                finally:
+                    if source_path not in (current_image_full_path, new_image_full_path):
+                        source_path.unlink(missing_ok=True)
+
+                if terminate_after_creation:
+                    logger.debug("terminate_after_creation set to True. Deleting instance")
+                    self.terminate_instance(vm_id, user)
+
+        image_manager.image.metadata["creation"] = {
+            "pipeline": pipeline,
+            "compression": IMAGE_COMPRESSION if pipeline != "three-pass" else "none",
+            "seconds": round(time.monotonic() - started, 2),
+            "stages": stage_times,
+            "bytes_written": bytes_written,
+            "commands": commands,
+        }
+        image_manager.finish_user_image(new_image_full_path)
 
-        
-        if terminate_after_creation:
-            logger.debug("terminate_after_creation set to True. Deleting instance")
-            self.terminate_instance(vm_id, user)
+        return {"vmi_id": new_vmi_id}
 
-        # Revert the state of the VM (if it was running, turn it back on)
-        if before_state == "running" and not terminate_after_creation:
-            instance.start()
 
-        # Prep the image for use in a new VM
-        if not VirtTools().sysprep(new_image_full_path):
-            raise ImagePrepError("Failed copying image with VirtTools() sysprep")
+    def _write_image(self, pipeline:str, source_path:Path, image_path:Path, 
+            image_manager:ImageManager, stage_times:dict, force_share:bool = False) -> int:
+        """Write out a prepared (sysprep'd and sparse) image from a virtual machine's disk.
+        Returns the bytes written to disk."""
+        if pipeline == "three-pass":
+            bytes_written = 0
+            if source_path != image_path:
+                image_manager.set_progress("convert")
+                with self._timed(stage_times, "convert"):
+                    if not QemuImg().convert(source_path, image_path, 'qcow2', force_share=force_share):
+                        raise ImagePrepError("Failed copying image with QemuImg() convert")
+                bytes_written += self._allocated_bytes(image_path)
+
+            # Prep the image for use in a new VM
+            image_manager.set_progress("sysprep")
+            with self._timed(stage_times, "sysprep"):
+                if not VirtTools().sysprep(image_path):
+                    raise ImagePrepError("Failed copying image with VirtTools() sysprep")
+
+            # Resize the image
+            image_manager.set_progress("sparsify")
+            with self._timed(stage_times, "sparsify"):
+                if not VirtTools().sparsify(image_path):
+                    raise ImagePrepError("Failed copying image with VirtTools() sparsify")
+
+            return bytes_written
+
+        # sysprep only writes its changes to an overlay, which is then written out in a single 
+        # pass that skips unallocated and zeroed blocks, in place of sparsifying.
+        overlay_path = image_path.with_name(f"{image_path.stem}.sysprep.qcow2")
+        try:
+            image_manager.set_progress("sysprep")
+            with self._timed(stage_times, "sysprep"):
+                if not QemuImg().create_overlay(overlay_path, source_path):
+                    raise ImagePrepError("Failed creating overlay with QemuImg() create")
+                if not VirtTools().sysprep(overlay_path):
+                    raise ImagePrepError("Failed copying image with VirtTools() sysprep")
+            bytes_written = self._allocated_bytes(overlay_path)
+
+            compression = IMAGE_COMPRESSION if IMAGE_COMPRESSION != "none" else None
+            image_manager.set_progress("convert", 0)
+            with self._timed(stage_times, "convert"):
+                if not QemuImg().convert(overlay_path, image_path, 'qcow2', force_share=force_share, 
+                        compression=compression, on_progress=lambda percent: image_manager.set_progress("convert", percent)):
+                    raise ImagePrepError("Failed copying image with QemuImg() convert")
+            bytes_written += self._allocated_bytes(image_path)
+        finally:
+            overlay_path.unlink(missing_ok=True)
 
-        # Resize the image
-        if not VirtTools().sparsify(new_image_full_path):
-            raise ImagePrepError("Failed copying image with VirtTools() sparsify")
-        
-        image_manager.finish_user_image(new_image_full_path)
+        return bytes_written
 
-        return {"vmi_id": new_vmi_id}
+
+    @contextmanager
+    def _timed(self, stage_times:dict, stage:str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            stage_times[stage] = round(time.monotonic() - started, 2)
+
+
+    def _allocated_bytes(self, path:Path) -> int:
+        return os.stat(path).st_blocks * 512
         
 
     def try_get_database_object(self, vm_id:str, user:User):
@@ -397,6 +682,7 @@ class VmManager:
             raise
 
 
+    @traced("vm.terminate")
     def terminate_instance(self, vm_id:str, user:User, force:bool = False):
         """Terminate the instance"""
         logger.debug(f"Terminating vm: {vm_id}")
@@ -405,10 +691,15 @@ class VmManager:
 
         vm_db = self.try_get_database_object(vm_id, user)
 
-        instance = VirtualMachineInstance(vm_id)
-        # Stop the instance and undefine (remove) from Virsh
-        instance.stop()
-        instance.terminate()
+        try:
+            instance = VirtualMachineInstance(vm_id)
+        except VirtualMachineDoesNotExist:
+            # Undefined by an earlier attempt that didn't get to finish
+            logger.debug(f"No domain for {vm_id}, cleaning up what's left")
+        else:
+            # Stop the instance and undefine (remove) from Virsh
+            instance.stop()
+            instance.terminate()
         
         # Delete folder/path
         self.__delete_vm_path(vm_db.instance_id, user)
@@ -419,6 +710,7 @@ class VmManager:
         # delete entry in db
         if vm_db: 
             vm_db.delete()
+            publish_event(vm_db.account_id, "vm", vm_id, VirtualMachine.State.TERMINATED)
 
         return True
     
@@ -444,7 +736,10 @@ class VmManager:
             raise VirtualMachineConfigurationError("No vm_db object to finish db with.")
         
         self.vm_db.state = VirtualMachine.State.AVAILABLE
+        self.vm_db.power_state_code = libvirt.VIR_DOMAIN_RUNNING
+        self.vm_db.power_state = domain_state_str(self.vm_db.power_state_code)
         self.vm_db.save()
+        publish_event(self.vm_db.account_id, "vm", self.vm_db.instance_id, self.vm_db.state)
         
 
     def __return_account_user_images_path(self, user_account:str) -> Path:
@@ -0,0 +1,156 @@
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+import libvirt
+from django.utils import timezone
+from .models import VirtualMachine, VirtualMachineStats
+from .vm_instance import get_libvirt_connection
+
+logger = logging.getLogger(__name__)
+
+# Seconds between samples. The collection task is scheduled on this interval.
+VM_STATS_INTERVAL = int(os.getenv("VM_STATS_INTERVAL", "60"))
+# Samples kept at the collection interval (a day, by default)
+VM_STATS_SAMPLES = int(os.getenv("VM_STATS_SAMPLES", "1440"))
+# Hourly averages kept (30 days)
+VM_STATS_HOURLY_SAMPLES = int(os.getenv("VM_STATS_HOURLY_SAMPLES", "720"))
+
+HOURLY = 3600
+
+# Columns of each sample. Rates are per second over the sample.
+FIELDS = [
+    "time",
+    "cpu_percent",
+    "memory_used_bytes",
+    "disk_read_bytes_per_second",
+    "disk_write_bytes_per_second",
+    "net_rx_bytes_per_second",
+    "net_tx_bytes_per_second",
+]
+
+STATS_TYPES = (
+    libvirt.VIR_DOMAIN_STATS_STATE
+    | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL
+    | libvirt.VIR_DOMAIN_STATS_BALLOON
+    | libvirt.VIR_DOMAIN_STATS_VCPU
+    | libvirt.VIR_DOMAIN_STATS_INTERFACE
+    | libvirt.VIR_DOMAIN_STATS_BLOCK
+)
+
+
+def collect_vm_stats(now:float = None) -> int:
+    """Sample every running domain on this host with a single getAllDomainStats call
+    and add the samples to the history of the virtual machines they belong to.
+    Returns the number of virtual machines sampled."""
+    now = now if now is not None else time.time()
+    conn = get_libvirt_connection()
+    domain_stats = conn.getAllDomainStats(STATS_TYPES, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+    return record_stats({dom.name(): read_counters(stats, now) for dom, stats in domain_stats})
+
+
+def read_counters(stats:dict, now:float) -> dict:
+    """Pick the counters samples are computed from out of a domain's stats."""
+    block_count = stats.get("block.count", 0)
+    net_count = stats.get("net.count", 0)
+
+    # Used memory as the guest sees it if it has a balloon driver reporting stats,
+    # otherwise the host memory backing it. Balloon stats are in KiB.
+    if "balloon.available" in stats and "balloon.usable" in stats:
+        memory_used = stats["balloon.available"] - stats["balloon.usable"]
+    else:
+        memory_used = stats.get("balloon.rss", stats.get("balloon.current", 0))
+
+    return {
+        "time": now,
+        "cpu_time": stats.get("cpu.time", 0),
+        "vcpus": stats.get("vcpu.current", 1),
+        "memory_used": memory_used * 1024,
+        "disk_read": sum(stats.get(f"block.{i}.rd.bytes", 0) for i in range(block_count)),
+        "disk_write": sum(stats.get(f"block.{i}.wr.bytes", 0) for i in range(block_count)),
+        "net_rx": sum(stats.get(f"net.{i}.rx.bytes", 0) for i in range(net_count)),
+        "net_tx": sum(stats.get(f"net.{i}.tx.bytes", 0) for i in range(net_count)),
+    }
+
+
+def record_stats(counters:Dict[str, dict]) -> int:
+    """Add a sample to each virtual machine's history from its current counters
+    (keyed by instance ID), rolling samples up into hourly averages as each hour
+    passes. Domains that aren't echome virtual machines are skipped."""
+    vm_ids = list(VirtualMachine.objects.filter(instance_id__in=list(counters)).values_list("instance_id", flat=True))
+    rows = {
+        (row.virtual_machine_id, row.resolution): row
+        for row in VirtualMachineStats.objects.filter(virtual_machine_id__in=vm_ids)
+    }
+
+    for vm_id in vm_ids:
+        recent = rows.setdefault((vm_id, VM_STATS_INTERVAL),
+            VirtualMachineStats(virtual_machine_id=vm_id, resolution=VM_STATS_INTERVAL))
+        hourly = rows.setdefault((vm_id, HOURLY),
+            VirtualMachineStats(virtual_machine_id=vm_id, resolution=HOURLY))
+
+        sample = compute_sample(recent.counters, counters[vm_id])
+        recent.counters = counters[vm_id]
+        if sample is None:
+            continue
+
+        previous = recent.samples[-1][0] if recent.samples else None
+        recent.samples = (recent.samples + [sample])[-VM_STATS_SAMPLES:]
+
+        # Roll the hour that just ended up into its average
+        if previous is not None and previous // HOURLY < sample[0] // HOURLY:
+            hour = previous // HOURLY * HOURLY
+            if rollup := average(recent.samples, hour, hour + HOURLY):
+                hourly.samples = (hourly.samples + [rollup])[-VM_STATS_HOURLY_SAMPLES:]
+
+    # bulk_update() doesn't set auto_now fields
+    modified = timezone.now()
+    for row in rows.values():
+        row.last_modified = modified
+    VirtualMachineStats.objects.bulk_create([row for row in rows.values() if row.pk is None])
+    VirtualMachineStats.objects.bulk_update(
+        [row for row in rows.values() if row.pk is not None], ["samples", "counters", "last_modified"])
+    return len(vm_ids)
+
+
+def compute_sample(previous:dict, current:dict) -> Optional[list]:
+    """A sample (a row of FIELDS) for the time between two readings of the counters,
+    or None if there's no earlier reading to compare with."""
+    if not previous or current["time"] <= previous["time"]:
+        return None
+
+    seconds = current["time"] - previous["time"]
+
+    def rate(counter:str) -> float:
+        # Counters start over when the domain is restarted
+        return round(max(current[counter] - previous[counter], 0) / seconds, 1)
+
+    cpu_seconds = max(current["cpu_time"] - previous["cpu_time"], 0) / 1e9
+    return [
+        int(current["time"]),
+        round(100 * cpu_seconds / seconds / max(current["vcpus"], 1), 2),
+        current["memory_used"],
+        rate("disk_read"),
+        rate("disk_write"),
+        rate("net_rx"),
+        rate("net_tx"),
+    ]
+
+
+def average(samples:List[list], start:int, end:int) -> Optional[list]:
+    """The average of the samples taken from start up to end, as a sample at start."""
+    window = [sample for sample in samples if start <= sample[0] < end]
+    if not window:
+        return None
+    columns = list(zip(*window))[1:]
+    return [start] + [round(sum(column) / len(window), 2) for column in columns]
+
+
+def get_vm_stats(vm:VirtualMachine, resolution:int = None) -> List[list]:
+    """The samples kept for a virtual machine at a resolution (VM_STATS_INTERVAL
+    or HOURLY), oldest first."""
+    resolution = resolution if resolution else VM_STATS_INTERVAL
+    try:
+        return VirtualMachineStats.objects.get(virtual_machine=vm, resolution=resolution).samples
+    except VirtualMachineStats.DoesNotExist:
+        return []
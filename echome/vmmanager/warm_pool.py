@@ -0,0 +1,158 @@
+import logging
+from datetime import timedelta
+from typing import Optional
+from django.db import transaction
+from django.utils import timezone
+from identity.models import User
+from network.models import VirtualNetwork
+from .image_manager import ImageManager
+from .host_image_cache import HOST_ID, choose_host, host_queue
+from .instance_definitions import InstanceDefinition
+from .models import HostMachine, VirtualMachine, WarmPool
+from .vm_manager import VmManager
+from .exceptions import InvalidLaunchConfiguration
+
+logger = logging.getLogger(__name__)
+
+class WarmPoolManager:
+    """Creates warm pools, keeps them filled and hands out their virtual machines."""
+
+    def create_pool(self, user:User, image_id:str, instance_def:InstanceDefinition, network_profile:str,
+            disk_size:str = "10G", size:int = 1, ttl:int = None, tags:dict = None) -> WarmPool:
+        """Create a pool, or resize the existing one for this configuration. Fill it with fill()."""
+        ImageManager().get_image_from_id(image_id, user)
+        if not VirtualNetwork.objects.filter(name=network_profile, account=user.account).exists():
+            raise InvalidLaunchConfiguration("Provided NetworkProfile does not exist.")
+
+        pool, created = WarmPool.objects.get_or_create(
+            account = user.account,
+            image_id = image_id,
+            instance_type = instance_def.instance_class,
+            instance_size = instance_def.instance_size,
+            network_profile = network_profile,
+            disk_size = disk_size,
+            defaults = {
+                "owner": user,
+                "size": size,
+                "tags": tags if tags else {},
+            }
+        )
+        if created:
+            pool.generate_id()
+        else:
+            pool.size = size
+        if ttl is not None:
+            pool.ttl = ttl
+        pool.save()
+
+        logger.debug(f"Warm pool {pool.pool_id} configured with size {size}")
+        return pool
+
+
+    def warm_count(self, pool:WarmPool) -> int:
+        """Number of virtual machines in the pool, including the ones still being built."""
+        return VirtualMachine.objects.filter(
+            metadata__warm_pool=pool.pool_id,
+            state__in=[VirtualMachine.State.WARM, VirtualMachine.State.CREATING],
+        ).count()
+
+
+    def evict(self, pool:WarmPool) -> int:
+        """Terminate the pool's warm virtual machines that have outlived the pool's TTL,
+        and the oldest ones beyond its size. Returns the number terminated."""
+        warm = VirtualMachine.objects.filter(
+            metadata__warm_pool=pool.pool_id,
+            state=VirtualMachine.State.WARM,
+        ).order_by("-created")
+        expired_before = timezone.now() - timedelta(seconds=pool.ttl)
+
+        evicted = 0
+        for index, vm_db in enumerate(warm):
+            if index < pool.size and vm_db.created >= expired_before:
+                continue
+
+            # Take it out of the pool first so it can't be claimed while it's terminated
+            updated = VirtualMachine.objects.filter(
+                pk=vm_db.pk, 
+                state=VirtualMachine.State.WARM
+            ).update(state=VirtualMachine.State.TERMINATING)
+            if not updated:
+                continue
+
+            logger.debug(f"Evicting warm VM {vm_db.instance_id} from pool {pool.pool_id}")
+            try:
+                VmManager().terminate_instance(vm_db.instance_id, pool.owner)
+                evicted += 1
+            except Exception as e:
+                logger.exception(f"Unable to terminate warm VM {vm_db.instance_id}: {e}")
+
+        return evicted
+
+
+    def maintain(self):
+        """Evict expired and excess warm virtual machines from every pool and queue a
+        refill for the pools that are short."""
+        for pool in WarmPool.objects.select_related("owner"):
+            self.evict(pool)
+            if self.warm_count(pool) < pool.size:
+                self.queue_fill(pool.pool_id, choose_host())
+
+
+    def queue_fill(self, pool_id:str, host:HostMachine):
+        """Queue filling a pool on a host. Warm virtual machines are defined on the host
+        the fill runs on and only launches on that host can claim them."""
+        from .tasks import task_fill_warm_pool
+        if not HOST_ID:
+            # Only workers started with a HOST_ID consume their host's queue
+            task_fill_warm_pool.delay(pool_id)
+            return
+        task_fill_warm_pool.apply_async((pool_id,), queue=host_queue(host))
+
+
+    def fill(self, pool:WarmPool) -> int:
+        """Build virtual machines until the pool is at its configured size. Returns
+        the number built."""
+        built = 0
+        while self.warm_count(pool) < pool.size:
+            VmManager().create_warm_vm(pool)
+            built += 1
+        return built
+
+
+    def claim(self, user:User, instance_def:InstanceDefinition, image_id:str,
+            network_profile:str, disk_size:str) -> Optional[VirtualMachine]:
+        """Take a warm virtual machine matching this launch configuration out of its pool,
+        or None if there isn't one. Only virtual machines defined on the host this launches
+        on are claimed. Launch it with VmManager.launch_warm_vm()."""
+        pool_ids = list(WarmPool.objects.filter(
+            account = user.account,
+            image_id = image_id,
+            instance_type = instance_def.instance_class,
+            instance_size = instance_def.instance_size,
+            network_profile = network_profile,
+            disk_size = disk_size,
+        ).values_list("pool_id", flat=True))
+        if not pool_ids:
+            return None
+
+        host = choose_host()
+        with transaction.atomic():
+            vm_db = VirtualMachine.objects.select_for_update(skip_locked=True).filter(
+                account = user.account,
+                host = host,
+                state = VirtualMachine.State.WARM,
+                metadata__warm_pool__in = pool_ids,
+            ).order_by("created").first()
+
+            if vm_db is None:
+                return None
+
+            pool_id = vm_db.metadata["warm_pool"]
+            vm_db.state = VirtualMachine.State.CREATING
+            vm_db.metadata = {"claimed_from": pool_id, "commands": vm_db.metadata.get("commands", [])}
+            vm_db.save()
+
+        logger.debug(f"Claimed warm VM {vm_db.instance_id} from pool {pool_id}")
+
+        transaction.on_commit(lambda: self.queue_fill(pool_id, host))
+        return vm_db
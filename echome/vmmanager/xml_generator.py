@@ -126,6 +126,16 @@ class KvmXmlObject():
             obj['interface'] = n
         
         
+        # Channel for the qemu guest agent, used to freeze the guest's
+        # filesystems while its disk is snapshotted
+        obj['channel'] = {
+            '@type': 'unix',
+            'target': {
+                '@type': 'virtio',
+                '@name': 'org.qemu.guest_agent.0'
+            }
+        }
+
         # VNC (If enabled)
         if self.vnc_configuration.enable:
             obj['graphics'] = self._generate_vnc_config()